@@ -2,10 +2,13 @@
 """OData core elements"""
 
 import base64
+import copy
 import decimal
 import itertools
 import json
 import math
+import threading
+import time
 import uuid
 import warnings
 
@@ -146,6 +149,16 @@ NUMERIC_TYPES = (
     edm.SimpleType.Int16,
     edm.SimpleType.Byte)
 
+INTEGER_TYPES = (
+    edm.SimpleType.Int64,
+    edm.SimpleType.Int32,
+    edm.SimpleType.Int16,
+    edm.SimpleType.Byte)
+
+INTEGER_RANGES = {
+    edm.SimpleType.Int32: (-2147483648, 2147483647),
+    edm.SimpleType.Int64: (-9223372036854775808, 9223372036854775807)}
+
 
 def promote_types(type_a, type_b):
     """Given two values from :py:class:`pyslet.mc_csdl.SimpleType`
@@ -183,6 +196,38 @@ def promote_types(type_a, type_b):
     # else must be both Byte - already got this case above
 
 
+def compile_cast(f, from_type, to_type):
+    """Returns a compiled function that casts the result of *f*
+
+    f
+        A compiled function, see :py:meth:`CommonExpression.compile`
+
+    from_type
+        The type of value returned by *f*
+
+    to_type
+        The numeric type to cast to, the result of
+        :py:func:`promote_types` applied to *from_type*
+
+    The values of integer types are all represented by Python integers
+    so no cast is required between them.  Raises NotImplementedError
+    for other casts."""
+    if from_type == to_type or from_type is None or (
+            from_type in INTEGER_TYPES and to_type in INTEGER_TYPES):
+        return f
+    if to_type in (edm.SimpleType.Double, edm.SimpleType.Single):
+        cast = float
+    elif to_type == edm.SimpleType.Decimal and from_type in INTEGER_TYPES:
+        cast = decimal.Decimal
+    else:
+        raise NotImplementedError
+
+    def cast_value(row):
+        value = f(row)
+        return None if value is None else cast(value)
+    return cast_value
+
+
 def can_cast_method_argument(type_a, type_b):
     """Given two values from :py:class:`pyslet.mc_csdl.SimpleType`
     returns True if *type_a* can be cast to *type_b*.
@@ -390,6 +435,52 @@ class CommonExpression(SortableMixin, UnicodeMixin, MigratedClass):
     def evaluate(self, context_entity):
         raise NotImplementedError
 
+    def compile(self, resolver):
+        """Compiles this expression into a Python function
+
+        resolver
+            A function that takes a tuple of property names (the path
+            to a simple property, e.g., ("Address", "City")) and
+            returns a tuple of (getter, type code) where getter is a
+            function that takes a single argument, the *row*, and
+            returns the Python value of the property (None for NULL).
+            The resolver returns None if the path cannot be resolved.
+
+        Returns a tuple of (function, type code).  The function takes
+        the same row argument as the getters and returns the Python
+        value of the expression.  The type code is the
+        :py:class:`~pyslet.odata2.csdl.SimpleType` of the result, or
+        None if the expression is NULL.  The row can be any object
+        understood by the resolver's getters, a data provider would
+        typically use a tuple of stored values so that entities can be
+        filtered without creating :py:class:`Entity` instances.
+
+        The compiled function follows the same rules as
+        :py:meth:`evaluate` but only a subset of expressions are
+        supported, NotImplementedError is raised if the expression
+        cannot be compiled and EvaluationError if the types of the
+        operands are incompatible."""
+        raise NotImplementedError
+
+    def compile_filter(self, resolver):
+        """Compiles this expression into a filter function
+
+        resolver
+            See :py:meth:`compile`
+
+        Returns a function that takes a row and returns a value that
+        is true if the row passes the filter (NULL is treated as False)
+        or None if this expression cannot be compiled, in which case
+        the expression must be evaluated using :py:meth:`evaluate`
+        instead."""
+        try:
+            f, type_code = self.compile(resolver)
+        except (NotImplementedError, EvaluationError):
+            return None
+        if type_code != edm.SimpleType.Boolean:
+            return None
+        return f
+
     def sortkey(self):
         """We implement comparisons based on operator precedence."""
         if self.operator is None:
@@ -453,6 +544,43 @@ class UnaryExpression(CommonExpression):
         rvalue = self.operands[0].evaluate(context_entity)
         return self.EvalMethod[self.operator](self, rvalue)
 
+    def compile(self, resolver):
+        f, type_code = self.operands[0].compile(resolver)
+        if self.operator == Operator.boolNot:
+            if type_code is None:
+                return (lambda row: None), edm.SimpleType.Boolean
+            elif type_code != edm.SimpleType.Boolean:
+                raise NotImplementedError
+
+            def compiled_not(row):
+                value = f(row)
+                return None if value is None else not value
+            return compiled_not, type_code
+        elif self.operator == Operator.negate:
+            if type_code is None:
+                return (lambda row: None), edm.SimpleType.Int32
+            elif type_code in (edm.SimpleType.Byte, edm.SimpleType.Int16):
+                type_code = edm.SimpleType.Int32
+            elif type_code == edm.SimpleType.Single:
+                f = compile_cast(f, type_code, edm.SimpleType.Double)
+                type_code = edm.SimpleType.Double
+            if type_code not in (edm.SimpleType.Int32, edm.SimpleType.Int64,
+                                 edm.SimpleType.Double):
+                raise NotImplementedError
+            limits = INTEGER_RANGES.get(type_code, None)
+
+            def compiled_negate(row):
+                value = f(row)
+                if value is None:
+                    return None
+                value = 0 - value
+                if limits and (value < limits[0] or value > limits[1]):
+                    raise ValueError("Illegal value for %s: %s" % (
+                        edm.SimpleType.to_str(type_code), str(value)))
+                return value
+            return compiled_negate, type_code
+        raise NotImplementedError
+
     def evaluate_negate(self, rvalue):
         type_code = rvalue.type_code
         if type_code in (edm.SimpleType.Byte, edm.SimpleType.Int16):
@@ -560,6 +688,125 @@ class BinaryExpression(CommonExpression):
             rvalue = self.operands[1].evaluate(context_entity)
             return self.EvalMethod[self.operator](self, lvalue, rvalue)
 
+    def compile(self, resolver):
+        if self.operator == Operator.member:
+            path = self.member_path()
+            if path is None:
+                raise NotImplementedError
+            result = resolver(path)
+            if result is None:
+                raise NotImplementedError
+            return result
+        elif self.operator in (Operator.isof, Operator.cast):
+            raise NotImplementedError
+        lf, ltype = self.operands[0].compile(resolver)
+        rf, rtype = self.operands[1].compile(resolver)
+        type_code = promote_types(ltype, rtype)
+        if self.operator in (Operator.boolAnd, Operator.boolOr):
+            if type_code is None:
+                return (lambda row: False), edm.SimpleType.Boolean
+            elif type_code != edm.SimpleType.Boolean:
+                raise NotImplementedError
+            if self.operator == Operator.boolAnd:
+                def compiled_bool(row):
+                    lvalue = lf(row)
+                    rvalue = rf(row)
+                    if lvalue is None or rvalue is None:
+                        return False
+                    return lvalue and rvalue
+            else:
+                def compiled_bool(row):
+                    lvalue = lf(row)
+                    rvalue = rf(row)
+                    if lvalue is None or rvalue is None:
+                        return False
+                    return lvalue or rvalue
+            return compiled_bool, edm.SimpleType.Boolean
+        numeric = type_code in (
+            edm.SimpleType.Int32, edm.SimpleType.Int64,
+            edm.SimpleType.Single, edm.SimpleType.Double,
+            edm.SimpleType.Decimal)
+        if numeric:
+            lf = compile_cast(lf, ltype, type_code)
+            rf = compile_cast(rf, rtype, type_code)
+        if self.operator in (Operator.eq, Operator.ne):
+            if type_code is None:
+                result = self.operator == Operator.eq
+                return (lambda row: result), edm.SimpleType.Boolean
+            elif not numeric and type_code not in (
+                    edm.SimpleType.String, edm.SimpleType.DateTime,
+                    edm.SimpleType.DateTimeOffset, edm.SimpleType.Guid,
+                    edm.SimpleType.Binary):
+                raise NotImplementedError
+            if self.operator == Operator.eq:
+                return (lambda row: lf(row) == rf(row)), edm.SimpleType.Boolean
+            else:
+                return (lambda row: lf(row) != rf(row)), edm.SimpleType.Boolean
+        relation = self.Relations.get(self.operator, None)
+        if relation is not None:
+            if type_code is None:
+                return (lambda row: False), edm.SimpleType.Boolean
+            elif not numeric and type_code not in (
+                    edm.SimpleType.String, edm.SimpleType.DateTime,
+                    edm.SimpleType.DateTimeOffset, edm.SimpleType.Guid):
+                raise NotImplementedError
+
+            def compiled_relation(row):
+                lvalue = lf(row)
+                rvalue = rf(row)
+                if lvalue is None or rvalue is None:
+                    return False
+                return relation(lvalue, rvalue)
+            return compiled_relation, edm.SimpleType.Boolean
+        arithmetic = self.Arithmetic.get(self.operator, None)
+        if arithmetic is not None:
+            if type_code is None:
+                return (lambda row: None), edm.SimpleType.Int32
+            elif type_code not in (edm.SimpleType.Int32, edm.SimpleType.Int64,
+                                   edm.SimpleType.Double):
+                raise NotImplementedError
+            limits = INTEGER_RANGES.get(type_code, None)
+            if limits is not None:
+                if self.operator == Operator.div:
+                    def arithmetic(x, y):
+                        return int(float(x) / float(y))
+                elif self.operator == Operator.mod:
+                    def arithmetic(x, y):
+                        return int(math.fmod(float(x), float(y)))
+
+            def compiled_arithmetic(row):
+                lvalue = lf(row)
+                rvalue = rf(row)
+                if lvalue is None or rvalue is None:
+                    return None
+                try:
+                    value = arithmetic(lvalue, rvalue)
+                except (ZeroDivisionError, ValueError) as e:
+                    raise EvaluationError(str(e))
+                if limits and (value < limits[0] or value > limits[1]):
+                    raise ValueError("Illegal value for %s: %s" % (
+                        edm.SimpleType.to_str(type_code), str(value)))
+                return value
+            return compiled_arithmetic, type_code
+        raise NotImplementedError
+
+    def member_path(self):
+        """Returns the path of property names represented by a chain
+        of member operators, or None if this expression is not a
+        simple path."""
+        if self.operator != Operator.member:
+            return None
+        lvalue, rvalue = self.operands
+        if not isinstance(rvalue, PropertyExpression):
+            return None
+        if isinstance(lvalue, PropertyExpression):
+            return (lvalue.name, rvalue.name)
+        elif isinstance(lvalue, BinaryExpression):
+            path = lvalue.member_path()
+            if path is not None:
+                return path + (rvalue.name, )
+        return None
+
     def promote_operands(self, lvalue, rvalue):
         if isinstance(lvalue, edm.SimpleValue) and \
                 isinstance(rvalue, edm.SimpleValue):
@@ -752,7 +999,11 @@ class BinaryExpression(CommonExpression):
                 edm.SimpleType.String, edm.SimpleType.DateTime,
                 edm.SimpleType.DateTimeOffset, edm.SimpleType.Guid):
             result = edm.EDMValue.from_type(edm.SimpleType.Boolean)
-            result.set_from_value(relation(lvalue.value, rvalue.value))
+            if lvalue and rvalue:
+                result.set_from_value(relation(lvalue.value, rvalue.value))
+            else:
+                # one of the operands is null => False
+                result.set_from_value(False)
             return result
         elif type_code is None:  # e.g., null lt null
             result = edm.EDMValue.from_type(edm.SimpleType.Boolean)
@@ -893,6 +1144,19 @@ BinaryExpression.EvalMethod = {
     Operator.boolAnd: BinaryExpression.evaluate_and,
     Operator.boolOr: BinaryExpression.evaluate_or}
 
+BinaryExpression.Relations = {
+    Operator.lt: lambda x, y: x < y,
+    Operator.gt: lambda x, y: x > y,
+    Operator.le: lambda x, y: x <= y,
+    Operator.ge: lambda x, y: x >= y}
+
+BinaryExpression.Arithmetic = {
+    Operator.mul: lambda x, y: x * y,
+    Operator.div: lambda x, y: x / y,
+    Operator.mod: math.fmod,
+    Operator.add: lambda x, y: x + y,
+    Operator.sub: lambda x, y: x - y}
+
 
 class LiteralExpression(CommonExpression):
 
@@ -935,6 +1199,11 @@ class LiteralExpression(CommonExpression):
         """A literal evaluates to itself."""
         return self.value
 
+    def compile(self, resolver):
+        # parameter values may be changed after compilation
+        value = self.value
+        return (lambda row: value.value), value.type_code
+
 
 class PropertyExpression(CommonExpression):
 
@@ -942,6 +1211,12 @@ class PropertyExpression(CommonExpression):
         super(PropertyExpression, self).__init__()
         self.name = name
 
+    def compile(self, resolver):
+        result = resolver((self.name, ))
+        if result is None:
+            raise NotImplementedError
+        return result
+
     def __unicode__(self):
         return to_text(self.name)
 
@@ -991,6 +1266,38 @@ class CallExpression(CommonExpression):
             self.method](self, list(x.evaluate(context_entity)
                                     for x in self.operands))
 
+    def compile(self, resolver):
+        method = self.CompileMethod.get(self.method, None)
+        if method is None:
+            raise NotImplementedError
+        nargs, strict, result_type, method = method
+        if len(self.operands) != nargs:
+            # let evaluate raise the error
+            raise NotImplementedError
+        args = []
+        for arg in self.operands:
+            f, type_code = arg.compile(resolver)
+            if type_code != edm.SimpleType.String and (
+                    strict or type_code is not None):
+                raise NotImplementedError
+            args.append(f)
+        if nargs == 1:
+            target = args[0]
+
+            def compiled_call(row):
+                value = target(row)
+                return None if value is None else method(value)
+        else:
+            target, arg = args
+
+            def compiled_call(row):
+                value = target(row)
+                avalue = arg(row)
+                if value is None or avalue is None:
+                    return None
+                return method(value, avalue)
+        return compiled_call, result_type
+
     def promote_param(self, arg, type_code):
         if isinstance(arg, edm.SimpleValue):
             if can_cast_method_argument(arg.type_code, type_code):
@@ -1315,6 +1622,23 @@ CallExpression.EvalMethod = {
     Method.ceiling: CallExpression.evaluate_ceiling
 }
 
+CallExpression.CompileMethod = {
+    # method: (number of arguments, strict String arguments, result type,
+    #          function of the (non-NULL) argument values)
+    Method.endswith: (2, False, edm.SimpleType.Boolean,
+                      lambda x, y: x.endswith(y)),
+    Method.indexof: (2, False, edm.SimpleType.Int32, lambda x, y: x.find(y)),
+    Method.startswith: (2, False, edm.SimpleType.Boolean,
+                        lambda x, y: x.startswith(y)),
+    Method.tolower: (1, False, edm.SimpleType.String, lambda x: x.lower()),
+    Method.toupper: (1, False, edm.SimpleType.String, lambda x: x.upper()),
+    Method.trim: (1, False, edm.SimpleType.String, lambda x: x.strip()),
+    Method.substringof: (2, False, edm.SimpleType.Boolean,
+                         lambda x, y: y.find(x) >= 0),
+    Method.concat: (2, True, edm.SimpleType.String, lambda x, y: x + y),
+    Method.length: (1, True, edm.SimpleType.Int32, len)
+}
+
 
 class Parser(edm.Parser):
 
@@ -2234,6 +2558,21 @@ class ODataURI(PEP8Compatibility):
                 else:
                     self.validate_sys_query_options(15)
 
+    def clone(self):
+        """Returns a copy of this instance
+
+        The copy has its own lists and dictionaries so it can be
+        modified without affecting the original but it shares the
+        parsed values of the system query options (such as the filter
+        expression) which must be treated as read-only.  Cloning an
+        instance is much quicker than parsing the URI again."""
+        result = copy.copy(self)
+        result.nav_path = list(self.nav_path)
+        result.query_options = list(self.query_options)
+        result.sys_query_options = dict(self.sys_query_options)
+        result.param_table = dict(self.param_table)
+        return result
+
     def parse_sys_query_option(self, param_name, param_value):
         """Returns a tuple of :py:class:`SystemQueryOption` constant and
         an appropriate representation of the value:
@@ -2440,6 +2779,164 @@ class StreamInfo(object):
         self.md5 = None
 
 
+class RequestStats(object):
+
+    """Records timings and counts for a single request
+
+    Instances are created by the server when instrumentation is enabled
+    (see :py:meth:`pyslet.odata2.server.Server.set_instrumentation`)
+    and bound to the thread handling the request, see
+    :py:func:`get_request_stats`.  Data layers can then record their
+    own activity without any reference to the server.
+
+    The phases recorded by pyslet are:
+
+    parse
+        Parsing the request URI
+
+    resource
+        Resolving the request URI to an entity, collection or value
+
+    serialise
+        Generating the body of a feed
+
+    sql
+        Executing SQL commands and fetching rows
+
+    Timings may overlap, for example, rows fetched while a feed is
+    being generated are included in both sql and serialise.  The
+    counters recorded by pyslet are:
+
+    queries
+        The number of SQL commands executed
+
+    rows
+        The number of rows fetched from SQL queries
+
+    bytes
+        The number of bytes in the response body"""
+
+    def __init__(self):
+        #: the time the request started
+        self.start = time.time()
+        #: the total time taken by the request (in seconds), None
+        #: until :py:meth:`stop` is called
+        self.elapsed = None
+        #: a dictionary mapping phase names on to times (in seconds)
+        self.timers = {}
+        #: a dictionary mapping counter names on to integers
+        self.counters = {}
+        #: the response status line (None until the response starts)
+        self.status = None
+
+    def timer(self, phase):
+        """Returns a context manager that times *phase*
+
+        The time spent in the with block is added to the time for
+        *phase*."""
+        return _PhaseTimer(self, phase)
+
+    def add_time(self, phase, seconds):
+        """Adds *seconds* to the time recorded for *phase*"""
+        self.timers[phase] = self.timers.get(phase, 0.0) + seconds
+
+    def count(self, name, n=1):
+        """Adds *n* to the counter *name*"""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def time_iterator(self, iterable, phase):
+        """Yields the items of *iterable*
+
+        The time spent waiting for each item is added to *phase*."""
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(phase, time.time() - start)
+                return
+            self.add_time(phase, time.time() - start)
+            yield item
+
+    def stop(self):
+        """Records the total time taken by the request"""
+        self.elapsed = time.time() - self.start
+
+    def server_timing(self):
+        """Returns the value of a Server-Timing header
+
+        Each phase is reported as a metric with a duration in
+        milliseconds, counters are reported as metrics with a
+        description, the total time so far is added as a metric
+        called total."""
+        metrics = []
+        for phase in sorted(self.timers):
+            metrics.append(
+                "%s;dur=%.3f" % (phase, self.timers[phase] * 1000.0))
+        for name in sorted(self.counters):
+            metrics.append('%s;desc="%i"' % (name, self.counters[name]))
+        metrics.append("total;dur=%.3f" %
+                       ((time.time() - self.start) * 1000.0))
+        return ", ".join(metrics)
+
+
+class _PhaseTimer(object):
+
+    def __init__(self, stats, phase):
+        self.stats = stats
+        self.phase = phase
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.add_time(self.phase, time.time() - self.start)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_null_timer = _NullTimer()
+
+_request_local = threading.local()
+
+
+def get_request_stats():
+    """Returns the :py:class:`RequestStats` for the current thread
+
+    Returns None if the current thread is not handling an instrumented
+    request.  Callers should do as little work as possible when None is
+    returned so that instrumentation has negligible cost when it is
+    disabled."""
+    return getattr(_request_local, 'stats', None)
+
+
+def set_request_stats(stats):
+    """Binds *stats* to the current thread (None unbinds)"""
+    _request_local.stats = stats
+
+
+def request_timer(phase):
+    """Returns a context manager that times *phase*
+
+    If the current thread has no :py:class:`RequestStats` then a
+    context manager that does nothing is returned."""
+    stats = get_request_stats()
+    if stats is None:
+        return _null_timer
+    else:
+        return stats.timer(phase)
+
+
 class Entity(edm.Entity):
 
     """We override Entity in order to provide OData serialisation."""
@@ -9,6 +9,7 @@ import copy
 import datetime
 import decimal
 import hashlib
+import heapq
 import io
 import itertools
 import logging
@@ -2644,11 +2645,7 @@ class Entity(SortableMixin, TypeInstance):
                 for k in self.data_keys():
                     self.selected.add(k)
             else:
-                # Force unselected values to NULL
-                for k, v in self.data_items():
-                    if k not in self.entity_set.keys and \
-                            k not in self.selected:
-                        v.set_null()
+                self.null_unselected()
         # Now expand this entity's navigation properties
         if expand:
             for k, v in self.navigation_items():
@@ -2663,6 +2660,16 @@ class Entity(SortableMixin, TypeInstance):
                         sub_select = None
                     v.expand_collection(expand[k], sub_select)
 
+    def null_unselected(self):
+        """Forces the values of unselected properties to NULL
+
+        Called by :py:meth:`expand` when a selection is in effect,
+        properties that comprise the key are never set to NULL."""
+        for k, v in self.data_items():
+            if k not in self.entity_set.keys and \
+                    k not in self.selected:
+                v.set_null()
+
     def Expanded(self, name):   # noqa
         warnings.warn("Entity.Expanded is deprecated, use, e.g., "
                       "customer['Orders'].isExpanded instead",
@@ -2825,6 +2832,43 @@ class Entity(SortableMixin, TypeInstance):
         return False
 
 
+class OrderKey(object):
+
+    """A composite sort key used when ordering entities
+
+    values
+        A list of the values to compare (in order of precedence)
+
+    directions
+        A list of the same length as values containing 1 (for ascending)
+        or -1 (for descending).
+
+    Used as the result of a key function when sorting so that a list of
+    entities can be sorted in one pass, even when the orderby rules mix
+    ascending and descending order.  NULL values (None) are treated as
+    being less than all other values."""
+
+    __slots__ = ('values', 'directions')
+
+    def __init__(self, values, directions):
+        self.values = values
+        self.directions = directions
+
+    def __lt__(self, other):
+        for a, b, d in zip(self.values, other.values, self.directions):
+            if a == b:
+                continue
+            if d < 0:
+                a, b = b, a
+            if a is None:
+                return True
+            elif b is None:
+                return False
+            else:
+                return a < b
+        return False
+
+
 class EntityCollection(DictionaryLike, PEP8Compatibility):
 
     """Represents a collection of entities from an :py:class:`EntitySet`.
@@ -2947,6 +2991,9 @@ class EntityCollection(DictionaryLike, PEP8Compatibility):
         will be called before iterating through the collection itself."""
         self.lastEntity = None
         self.paging = False
+        #: while paging, the maximum number of entities that will be
+        #: taken from :py:meth:`itervalues` (or None if unlimited)
+        self.page_limit = None
 
     def __enter__(self):
         return self
@@ -2975,6 +3022,17 @@ class EntityCollection(DictionaryLike, PEP8Compatibility):
         in the metadata model."""
         return self.entity_set.get_fqname()
 
+    def change_token(self):
+        """Returns a token that changes when the collection changes
+
+        The token is a character string that can be used to derive a
+        weak validator (an HTTP ETag) for responses generated from the
+        collection.  If the data layer can't detect changes cheaply it
+        returns None (the default implementation).  Otherwise the token
+        must change whenever an entity or link that could appear in
+        the collection, or in an expansion of it, is changed."""
+        return None
+
     @old_method('Expand')
     def set_expand(self, expand, select=None):
         """Sets the expand and select query options for this collection.
@@ -3104,27 +3162,40 @@ class EntityCollection(DictionaryLike, PEP8Compatibility):
         returns a generator function that returns the same entities in
         sorted order (according to the :py:attr:`orderby` object).
 
-        This implementation simply creates a list and then sorts it
-        based on the output of :py:meth:`calculate_order_key` so is not
-        suitable for use with long lists of entities.  However, if no
-        ordering is required then no list is created."""
-        elist = None
-        if self.paging:
-            elist = list(entity_iterable)
-            elist.sort(key=lambda x: x.key())
-        if self.orderby:
-            if elist is None:
-                elist = list(entity_iterable)
-            # we avoid Py3 warnings by doing multiple sorts with a key function
-            for rule, ruleDir in reversed(self.orderby):
-                elist.sort(key=lambda x: self.calculate_order_key(
-                    x, rule), reverse=True if ruleDir < 0 else False)
-        if elist:
-            for e in elist:
-                yield e
-        else:
+        This implementation sorts the entities using a single
+        :py:class:`OrderKey` per entity calculated from the output of
+        :py:meth:`calculate_order_key`.  When paging, entities are also
+        sorted by key (after any orderby rules) to ensure that pages
+        are consistent and, if :py:attr:`page_limit` is set, only the
+        entities required for the page are selected (using a heap)
+        rather than sorting the whole list.  This implementation is
+        still not suitable for use with long lists of entities but if
+        no ordering is required then no list is created."""
+        if not self.orderby and not self.paging:
             for e in entity_iterable:
                 yield e
+            return
+        if self.orderby:
+            directions = [rule_dir for rule, rule_dir in self.orderby]
+            if self.paging:
+                directions.append(1)
+
+            def sort_key(e):
+                values = [self.calculate_order_key(e, rule)
+                          for rule, rule_dir in self.orderby]
+                if self.paging:
+                    values.append(e.key())
+                return OrderKey(values, directions)
+        else:
+            def sort_key(e):
+                return e.key()
+        if self.paging and self.page_limit is not None:
+            elist = heapq.nsmallest(self.page_limit, entity_iterable,
+                                    key=sort_key)
+        else:
+            elist = sorted(entity_iterable, key=sort_key)
+        for e in elist:
+            yield e
 
     @old_method('SetInlineCount')
     def set_inlinecount(self, inlinecount):
@@ -3323,6 +3394,9 @@ class EntityCollection(DictionaryLike, PEP8Compatibility):
                 emax = emin + self.top
         try:
             self.paging = True
+            if emax is not None:
+                # we look one entity beyond the end of the page
+                self.page_limit = emax + 1
             if emax is None:
                 for e in self.itervalues():
                     self.lastEntity = e
@@ -3350,6 +3424,7 @@ class EntityCollection(DictionaryLike, PEP8Compatibility):
                         return
         finally:
             self.paging = False
+            self.page_limit = None
         # no more pages
         if set_next:
             self.top = self.skip = 0
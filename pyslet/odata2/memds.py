@@ -1,13 +1,22 @@
 #! /usr/bin/env python
 """A simple Entity store using a python dictionary"""
 
+import bisect
+import collections
 import hashlib
+import heapq
 import threading
 import logging
+import operator
+import pickle
+import random
+import sys
+import time
 
 from . import csdl as edm
 from . import core as odata
 from .. import iso8601 as iso
+from ..xml import xsdatatypes as xsi
 from ..py2 import (
     dict_items,
     dict_keys,
@@ -15,6 +24,162 @@ from ..py2 import (
     range3)
 
 
+class LogRecord(xsi.Enumeration):
+
+    """LogRecord defines constants for the types of record written to
+    the log of an :py:class:`InMemoryEntityContainer`::
+
+            LogRecord.put
+            LogRecord.DEFAULT == None
+
+    For more methods see :py:class:`~pyslet.xml.xsdatatypes.Enumeration`"""
+    decode = {
+        'put': 1,
+        'delete': 2,
+        'stream': 3,
+        'link': 4,
+        'unlink': 5
+    }
+
+
+class SegmentedDict(object):
+
+    """A dictionary that supports cheap copy-on-write snapshots
+
+    data (optional)
+        A dictionary (or other mapping) used to initialise the items.
+
+    The items are divided between a number of segments (plain python
+    dictionaries) using the hashes of their keys.  A snapshot (see
+    :py:meth:`snapshot`) shares all the segments, the first write to a
+    segment after a snapshot has been taken copies that segment only.
+    As the number of segments is doubled whenever the average segment
+    exceeds :py:attr:`SEGMENT_SIZE` items the cost of a write remains
+    small, regardless of the size of the dictionary, and taking a
+    snapshot is proportional to the number of segments.
+
+    Instances support the common dictionary operations.  Instances are
+    not thread safe."""
+
+    #: the average number of items per segment that triggers a split
+    SEGMENT_SIZE = 64
+
+    #: the initial number of segments (must be a power of 2)
+    MIN_SEGMENTS = 8
+
+    def __init__(self, data=None):
+        self._segments = [{} for i in range3(self.MIN_SEGMENTS)]
+        self._mask = self.MIN_SEGMENTS - 1
+        # the generation in which each segment was copied, a segment
+        # may only be modified in place if it was copied in the current
+        # generation
+        self._owners = [0] * self.MIN_SEGMENTS
+        self._generation = 0
+        self._len = 0
+        self._read_only = False
+        if data is not None:
+            for key in data:
+                self[key] = data[key]
+
+    def snapshot(self):
+        """Returns a read-only copy of this dictionary
+
+        The copy is not affected by subsequent changes to this
+        dictionary."""
+        result = SegmentedDict.__new__(SegmentedDict)
+        result._segments = list(self._segments)
+        result._mask = self._mask
+        result._owners = None
+        result._generation = None
+        result._len = self._len
+        result._read_only = True
+        # all segments are now shared with the snapshot
+        self._generation += 1
+        return result
+
+    def _writable(self, key):
+        if self._read_only:
+            raise TypeError("SegmentedDict snapshots are read only")
+        i = hash(key) & self._mask
+        if self._owners[i] != self._generation:
+            self._segments[i] = dict(self._segments[i])
+            self._owners[i] = self._generation
+        return self._segments[i]
+
+    def _split(self):
+        nsegments = 2 * len(self._segments)
+        mask = nsegments - 1
+        segments = [{} for i in range3(nsegments)]
+        for segment in self._segments:
+            for key, value in dict_items(segment):
+                segments[hash(key) & mask][key] = value
+        self._segments = segments
+        self._mask = mask
+        self._owners = [self._generation] * nsegments
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, key):
+        return key in self._segments[hash(key) & self._mask]
+
+    def __getitem__(self, key):
+        return self._segments[hash(key) & self._mask][key]
+
+    def get(self, key, default=None):
+        return self._segments[hash(key) & self._mask].get(key, default)
+
+    def __setitem__(self, key, value):
+        segment = self._writable(key)
+        if key not in segment:
+            self._len += 1
+        segment[key] = value
+        if self._len > self.SEGMENT_SIZE * len(self._segments):
+            self._split()
+
+    def __delitem__(self, key):
+        del self._writable(key)[key]
+        self._len -= 1
+
+    def pop(self, key, *args):
+        segment = self._writable(key)
+        if key in segment:
+            self._len -= 1
+        return segment.pop(key, *args)
+
+    def __iter__(self):
+        for segment in self._segments:
+            for key in segment:
+                yield key
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        for segment in self._segments:
+            for value in dict_values(segment):
+                yield value
+
+    def items(self):
+        for segment in self._segments:
+            for item in dict_items(segment):
+                yield item
+
+    iterkeys = keys
+    itervalues = values
+    iteritems = items
+
+    def __eq__(self, other):
+        if isinstance(other, SegmentedDict):
+            other = dict(other)
+        return dict(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+
 class InMemoryEntityStore(object):
 
     """Implements an in-memory entity set using a python dictionary.
@@ -30,14 +195,40 @@ class InMemoryEntityStore(object):
     this object can be called from multi-threaded programs.  Although
     individual collections must not be shared across threads multiple
     threads can open separate collections and access the entities
-    safely."""
+    safely.
+
+    If *row_view* is True the entities returned are
+    :py:class:`RowEntity` instances backed directly by the stored
+    tuples, their property values are only created when they are first
+    accessed.  This saves time and memory when only a few properties
+    of each entity are used, e.g., with $select or when only the keys
+    are required.
+
+    Readers iterate over a snapshot of the entities, see
+    :py:meth:`snapshot`, so they do not hold the container's lock while
+    entities are created and do not block writers.
 
-    def __init__(self, container, entity_set=None):
+    For cache-style use, entities can be made to expire (see
+    :py:meth:`set_expiry`) and the size of the entity set can be
+    bounded, with the least recently used entities being evicted (see
+    :py:meth:`set_bounds`)."""
+
+    #: the maximum number of reads remembered between writes for the
+    #: purposes of least recently used eviction
+    MAX_LRU_PENDING = 4096
+
+    def __init__(self, container, entity_set=None, row_view=False):
         self.container = container
         """the :py:class:`InMemoryEntityContainer` that contains this
         entity set"""
         self.entity_set = entity_set    #: the entity set we're bound to
-        self.data = {}                  #: simple dictionary of the values
+        #: True if entities are read as :py:class:`RowEntity` instances
+        self.row_view = row_view
+        #: a :py:class:`SegmentedDict` of the values
+        self.data = SegmentedDict()
+        # protects the snapshot generation of self.data from
+        # concurrent readers
+        self._snapshot_lock = threading.Lock()
         self.streams = {}               #: simple dictionary of streams
         self.associations = {}
         # a mapping of association set names to
@@ -48,9 +239,79 @@ class InMemoryEntityStore(object):
         # :py:class:`InMemoryAssociation` index instances *to* this
         # entity set
         self._deleting = set()
+        #: a mapping of property names to
+        #: :py:class:`InMemoryPropertyIndex` instances
+        self.indexes = {}
+        self._positions = None
+        #: the time to live (in seconds) of entities, see
+        #: :py:meth:`set_expiry`
+        self.ttl = None
+        self._expiry_position = None
+        # a mapping from key to expiry time
+        self._expires = {}
+        # a heap of (expiry time, key), may contain stale entries, None
+        # if entities don't expire
+        self._expiry_heap = None
+        #: the maximum number of entities, see :py:meth:`set_bounds`
+        self.max_entries = None
+        #: the maximum (estimated) size of the entities in bytes
+        self.max_bytes = None
+        #: the estimated size of the entities in bytes (only maintained
+        #: if the entity set is bounded)
+        self.nbytes = 0
+        # an OrderedDict mapping keys on to sizes in least recently
+        # used order, None if not bounded
+        self._lru = None
+        # keys read since the last write, readers only hold the shared
+        # lock so they can't reorder _lru themselves
+        self._lru_used = collections.deque(maxlen=self.MAX_LRU_PENDING)
+        #: the number of entities that have expired
+        self.nexpired = 0
+        #: the number of entities that have been evicted
+        self.nevicted = 0
         if entity_set is not None:
             self.bind_to_entity_set(entity_set)
 
+    def snapshot(self):
+        """Returns a snapshot of the stored values
+
+        The result is a read-only :py:class:`SegmentedDict` mapping keys
+        on to the stored tuples.  The snapshot is consistent with the
+        state of the entity set at the time of the call: subsequent
+        changes to the entity set are not reflected in it.  When you
+        have finished with the snapshot you should pass it to
+        :py:meth:`release_snapshot`.
+
+        Snapshots are implemented using copy-on-write, a snapshot
+        shares the segments of the current dictionary and a writer
+        only copies the segment it modifies.  The stored tuples
+        themselves are never modified so they are shared by all
+        copies."""
+        self._expire_due()
+        with self.container.read_lock:
+            with self._snapshot_lock:
+                return self.data.snapshot()
+
+    def release_snapshot(self, data):
+        """Releases a snapshot returned by :py:meth:`snapshot`
+
+        Snapshots hold no resources so this method does nothing, it
+        is provided for symmetry with :py:meth:`snapshot`."""
+        pass
+
+    def property_positions(self):
+        """Returns a dictionary describing the stored tuples
+
+        The dictionary maps property names on to tuples of (position,
+        property definition) where position is the index of the
+        property's value in the stored tuple."""
+        if self._positions is None:
+            positions = {}
+            for i, p in enumerate(self.entity_set.entityType.Property):
+                positions[p.name] = (i, p)
+            self._positions = positions
+        return self._positions
+
     def bind_to_entity_set(self, entity_set):
         """Binds this entity store to the given entity set.
 
@@ -68,8 +329,40 @@ class InMemoryEntityStore(object):
         else:
             self.associations[aindex.name] = aindex
 
+    def add_index(self, pname):
+        """Adds a secondary index on the property *pname*
+
+        The property must be a simple data property of the entity type,
+        properties of complex types cannot be indexed.  The index is
+        populated from the existing entities and then maintained as
+        entities are added, updated and deleted.  Collections use the
+        index when filtering on, or ordering by, the property.  Returns
+        the new :py:class:`InMemoryPropertyIndex` instance."""
+        with self.container.lock:
+            if pname in self.indexes:
+                return self.indexes[pname]
+            i, p = self.property_positions()[pname]
+            if p.simpleTypeCode is None:
+                raise ValueError(
+                    "Can't index complex property %s" % pname)
+            index = InMemoryPropertyIndex(pname, i, p.simpleTypeCode)
+            index.rebuild(self.data)
+            self.indexes[pname] = index
+            return index
+
     def add_entity(self, e):
         key = e.key()
+        value = self.tuple_from_entity(e)
+        with self.container.lock:
+            self._expire_due()
+            if key in self.data:
+                raise edm.ConstraintError("Duplicate key: %s", str(key))
+            self.put_tuple(key, value)
+            # At this point the entity exists
+            e.exists = True
+
+    def tuple_from_entity(self, e):
+        """Returns the tuple that would be stored for entity *e*"""
         value = []
         for pname in e.data_keys():
             p = e[pname]
@@ -89,56 +382,182 @@ class InMemoryEntityStore(object):
                 value.append(p.value)
             else:
                 raise RuntimeError("property not simple or complex")
-        with self.container.lock:
-            if key in self.data:
-                raise edm.ConstraintError("Duplicate key: %s", str(key))
-            self.data[key] = tuple(value)
-            # At this point the entity exists
-            e.exists = True
+        return tuple(value)
 
-    def count_entities(self):
-        with self.container.lock:
-            return len(self.data)
+    def check_size(self, e, stream_size=0):
+        """Checks that entity *e* fits within the bounds
 
-    def generate_entities(self, select=None):
-        """A generator function that returns the entities in the entity set
+        stream_size
+            The length of the media stream that will be stored with
+            the entity.
 
-        The implementation is a compromise, we don't lock the container
-        for the duration of the iteration, instead we work on a copy of
-        the list of keys.  This creates the slight paradox that an entity
-        deleted during the iteration *may* not be yielded but an entity
-        inserted during the iteration will never be yielded."""
+        Raises :py:class:`~pyslet.odata2.csdl.ConstraintError` if *e*
+        can't be written without exceeding the bounds on its own (see
+        :py:meth:`set_bounds`), used to check a media resource before
+        it is inserted."""
         with self.container.lock:
-            keys = dict_keys(self.data)
-        for k in keys:
-            e = self.read_entity(k, select)
-            if e is not None:
-                yield e
+            if self._lru is not None:
+                self._check_size(e.key(), self.tuple_size(
+                    self.tuple_from_entity(e)), stream_size)
+
+    def resolve_path(self, path):
+        """Resolves a property path for compiled filters
+
+        path
+            A tuple of property names, the path to a simple property
+            of the entity type.
+
+        Returns a tuple of (getter, type code) where getter is a
+        function that extracts the property's value from a stored
+        tuple, or None if *path* does not resolve to a simple property.
+        Suitable for passing as the resolver to
+        :py:meth:`pyslet.odata2.core.CommonExpression.compile`."""
+        type_def = self.entity_set.entityType
+        positions = []
+        p = None
+        for pname in path:
+            if type_def is None:
+                return None
+            i = 0
+            for p in type_def.Property:
+                if p.name == pname:
+                    break
+                i += 1
+            else:
+                return None
+            positions.append(i)
+            type_def = p.complexType
+        if p is None or p.simpleTypeCode is None:
+            return None
+        if len(positions) == 1:
+            return operator.itemgetter(positions[0]), p.simpleTypeCode
+
+        def getter(value):
+            for i in positions:
+                value = value[i]
+            return value
+        return getter, p.simpleTypeCode
+
+    def count_entities(self, filter_function=None, keys=None):
+        """Returns the number of entities in the entity set
+
+        filter_function
+            An optional function, compiled from a filter expression,
+            that is called with the stored tuple of each entity and
+            returns True if the entity is to be counted.
+
+        keys
+            An optional list of candidate keys, see
+            :py:meth:`generate_entities`."""
+        if filter_function is None:
+            self._expire_due()
+            with self.container.read_lock:
+                if keys is None:
+                    return len(self.data)
+                else:
+                    return len([k for k in keys if k in self.data])
+        data = self.snapshot()
+        try:
+            if keys is None:
+                values = dict_values(data)
+            else:
+                values = [data[k] for k in keys if k in data]
+            result = 0
+            for value in values:
+                if filter_function(value):
+                    result += 1
+            return result
+        finally:
+            self.release_snapshot(data)
 
-    def read_entity(self, key, select=None):
-        with self.container.lock:
+    def generate_entities(self, select=None, keys=None,
+                          filter_function=None):
+        """A generator function that returns the entities in the entity set
+
+        The entities are generated from a :py:meth:`snapshot` taken
+        when the generator is first started.  The container is not
+        locked during the iteration, entities inserted, updated or
+        deleted while the iteration is in progress do not affect the
+        entities yielded.
+
+        keys
+            An optional list of keys, typically obtained from an
+            :py:class:`InMemoryPropertyIndex`.  If given, only the
+            entities with these keys are generated, in the order
+            given.
+
+        filter_function
+            An optional function used to test the stored tuple of each
+            entity before it is created, see :py:meth:`read_entity`."""
+        data = self.snapshot()
+        try:
+            if keys is None:
+                values = dict_values(data)
+            else:
+                values = (data.get(k, None) for k in keys)
+            for value in values:
+                e = self.entity_from_tuple(value, select, filter_function)
+                if e is not None:
+                    yield e
+        finally:
+            self.release_snapshot(data)
+
+    def read_entity(self, key, select=None, filter_function=None):
+        """Returns the entity with *key* or None if there is no entity
+
+        filter_function
+            An optional function, typically obtained from
+            :py:meth:`pyslet.odata2.core.CommonExpression.compile_filter`,
+            that is called with the stored tuple of values.  If it
+            returns a false value None is returned instead of the
+            entity."""
+        self._expire_due()
+        with self.container.read_lock:
             value = self.data.get(key, None)
-            if value is None:
-                return None
-            e = Entity(self.entity_set, self)
+            if value is not None and self._lru is not None:
+                # recorded for the next writer, deque.append is atomic
+                self._lru_used.append(key)
+        return self.entity_from_tuple(value, select, filter_function)
+
+    def entity_from_tuple(self, value, select=None, filter_function=None):
+        """Returns a new entity created from a stored tuple
+
+        value
+            A tuple of stored values, or None, in which case None is
+            returned.
+
+        See :py:meth:`read_entity` for details of the other arguments.
+        The stored tuples are never modified so the container does not
+        need to be locked."""
+        if value is None:
+            return None
+        if filter_function is not None and not filter_function(value):
+            return None
+        if self.row_view:
+            e = RowEntity(self.entity_set, self, value)
             if select is not None:
                 e.expand(None, select)
-            for pname, pvalue in zip(e.data_keys(), value):
-                p = e[pname]
-                if (select is None or e.is_selected(pname) or
-                        pname in self.entity_set.keys):
-                    # for speed, check if selection is an issue first
-                    # we always include the keys
-                    if isinstance(p, edm.Complex):
-                        self.set_complex_from_tuple(p, pvalue)
-                    else:
-                        p.set_from_value(pvalue)
-                else:
-                    if isinstance(p, edm.Complex):
-                        p.set_null()
-                    else:
-                        p.set_from_value(None)
             e.exists = True
+            return e
+        e = Entity(self.entity_set, self)
+        if select is not None:
+            e.expand(None, select)
+        for pname, pvalue in zip(e.data_keys(), value):
+            p = e[pname]
+            if (select is None or e.is_selected(pname) or
+                    pname in self.entity_set.keys):
+                # for speed, check if selection is an issue first
+                # we always include the keys
+                if isinstance(p, edm.Complex):
+                    self.set_complex_from_tuple(p, pvalue)
+                else:
+                    p.set_from_value(pvalue)
+            else:
+                if isinstance(p, edm.Complex):
+                    p.set_null()
+                else:
+                    p.set_from_value(None)
+        e.exists = True
         return e
 
     def set_complex_from_tuple(self, complex_value, t):
@@ -153,7 +572,7 @@ class InMemoryEntityStore(object):
         """Returns a tuple of the entity's media stream
 
         The return value is a tuple: (data, StreamInfo)."""
-        with self.container.lock:
+        with self.container.read_lock:
             if key not in self.data:
                 raise KeyError
             if key in self.streams:
@@ -188,11 +607,318 @@ class InMemoryEntityStore(object):
                         v.set_default_value()
                         value[i] = v.value
                 i = i + 1
-            self.data[key] = tuple(value)
+            self.put_tuple(key, tuple(value))
+
+    def put_tuple(self, key, value):
+        """Stores the tuple *value* for the entity with *key*
+
+        Inserts a new entity or replaces the stored values of an
+        existing one, updating the indexes and writing the change to
+        the container's log (if any).  No constraints are checked."""
+        with self.container.lock:
+            if self._lru is not None:
+                self._check_size(key, self.tuple_size(value))
+            old_value = self.data.get(key, None)
+            self.data[key] = value
+            for index in dict_values(self.indexes):
+                if old_value is None:
+                    index.add(value[index.position], key)
+                elif old_value[index.position] != value[index.position]:
+                    index.remove(old_value[index.position], key)
+                    index.add(value[index.position], key)
+            self.container.log_change(
+                (LogRecord.put, self.entity_set.name, key, value))
+            if self._expiry_heap is not None:
+                self._set_expiry(key, value, time.time())
+            if self._lru is not None:
+                self._set_size(key)
+                self._evict(key)
 
     def update_entity_stream(self, key, stream, sinfo):
         with self.container.lock:
+            if self._lru is not None and key in self._lru:
+                self._check_size(key, self.tuple_size(self.data[key]),
+                                 len(stream))
             self.streams[key] = (stream, sinfo)
+            self.container.log_change(
+                (LogRecord.stream, self.entity_set.name, key, stream, sinfo))
+            if self._lru is not None and key in self._lru:
+                self._set_size(key)
+                self._evict(key)
+
+    def restore(self, data, streams):
+        """Replaces the contents of this entity set
+
+        data
+            A dictionary mapping keys on to stored tuples, e.g., a
+            value of :py:attr:`data` from a previous session.
+
+        streams
+            A dictionary mapping keys on to tuples of (stream data,
+            :py:class:`pyslet.odata2.core.StreamInfo`).
+
+        The property indexes are rebuilt, the association indexes are
+        not affected."""
+        with self.container.lock:
+            self.data = SegmentedDict(data)
+            self.streams = streams
+            for index in dict_values(self.indexes):
+                index.rebuild(self.data)
+            self._rebuild_expiry()
+            self._rebuild_lru()
+
+    def set_expiry(self, ttl=None, pname=None):
+        """Sets the rules for expiring entities
+
+        ttl
+            The time to live of each entity in seconds, measured from
+            the time it was last inserted or updated.
+
+        pname
+            The name of a DateTime or DateTimeOffset property that
+            contains the time at which each entity expires.  DateTime
+            values are assumed to be UTC.  Entities with a NULL value
+            expire according to *ttl* instead.
+
+        If both values are None entities never expire (the default).
+        Expiry times are kept in a heap so checking for expired
+        entities is fast, expired entities are deleted (see
+        :py:meth:`expire`) when the entity set is next accessed."""
+        with self.container.lock:
+            position = None
+            if pname is not None:
+                position, p = self.property_positions()[pname]
+                if p.simpleTypeCode not in (edm.SimpleType.DateTime,
+                                            edm.SimpleType.DateTimeOffset):
+                    raise ValueError(
+                        "Expiry property %s must be a DateTime" % pname)
+            self.ttl = ttl
+            self._expiry_position = position
+            self._rebuild_expiry()
+
+    def _rebuild_expiry(self):
+        self._expires = {}
+        self._expiry_heap = []
+        if self.ttl is None and self._expiry_position is None:
+            self._expiry_heap = None
+            return
+        now = time.time()
+        for key, value in dict_items(self.data):
+            self._set_expiry(key, value, now)
+
+    def _set_expiry(self, key, value, now):
+        t = None
+        if self._expiry_position is not None:
+            expires = value[self._expiry_position]
+            if expires is not None:
+                if expires.time.get_zone_offset() is None:
+                    expires = expires.with_zone(zdirection=0)
+                t = expires.get_unixtime()
+        if t is None and self.ttl is not None:
+            t = now + self.ttl
+        if t is None:
+            self._expires.pop(key, None)
+            return
+        self._expires[key] = t
+        heap = self._expiry_heap
+        heapq.heappush(heap, (t, key))
+        if len(heap) > 2 * len(self._expires) + 64:
+            # too many stale entries, rebuild the heap
+            heap[:] = [(t, k) for k, t in dict_items(self._expires)]
+            heapq.heapify(heap)
+
+    def _expire_due(self):
+        # expires entities if any are due, must not be called with the
+        # read lock as expiry requires the (write) lock
+        heap = self._expiry_heap
+        try:
+            due = heap is not None and heap[0][0] <= time.time()
+        except IndexError:
+            # empty, or emptied by another thread
+            due = False
+        if due:
+            self.expire()
+
+    def expire(self, now=None):
+        """Deletes all entities that have expired
+
+        now
+            The current time as a unix time value, defaults to the
+            value of time.time()
+
+        Returns the number of entities deleted.  Entities are deleted
+        with :py:meth:`delete_entity` so their links are removed but
+        no other constraints are checked.  There is no need to call
+        this method directly, expired entities are deleted
+        automatically when the entity set is accessed."""
+        if now is None:
+            now = time.time()
+        result = 0
+        with self.container.lock:
+            heap = self._expiry_heap
+            while heap and heap[0][0] <= now:
+                t, key = heapq.heappop(heap)
+                if self._expires.get(key, None) == t:
+                    self.delete_entity(key)
+                    result += 1
+            self.nexpired += result
+        return result
+
+    def set_bounds(self, max_entries=None, max_bytes=None):
+        """Sets the maximum size of the entity set
+
+        max_entries
+            The maximum number of entities
+
+        max_bytes
+            The maximum (estimated) size of the entities in bytes, see
+            :py:meth:`tuple_size` for details.
+
+        When a bound is exceeded the least recently used entities are
+        evicted (using :py:meth:`delete_entity`).  An entity is used
+        when it is inserted, updated or read by key, iterating through
+        the entity set does not count as use.  Reads only take the
+        container's shared lock so they are recorded and applied to the
+        eviction order by the next write, if more than
+        :py:attr:`MAX_LRU_PENDING` reads are made between writes the
+        oldest are forgotten.  The entity being written is never
+        evicted, instead, an attempt to write an entity that exceeds
+        *max_bytes* on its own (or any entity if *max_entries* is 0)
+        raises :py:class:`~pyslet.odata2.csdl.ConstraintError`.
+        Existing entities that exceed the new bounds are evicted
+        immediately.  If both values are None the entity set is
+        unbounded (the default)."""
+        with self.container.lock:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            if self._lru is None:
+                self._rebuild_lru()
+            elif max_entries is None and max_bytes is None:
+                self._lru = None
+                self.nbytes = 0
+            self._evict()
+
+    def _rebuild_lru(self):
+        self.nbytes = 0
+        if self.max_entries is None and self.max_bytes is None:
+            self._lru = None
+            return
+        self._lru = collections.OrderedDict()
+        for key in dict_keys(self.data):
+            self._set_size(key)
+
+    def _apply_lru_used(self):
+        # moves the keys read since the last write to the most recently
+        # used position, in the order they were read
+        lru = self._lru
+        used = self._lru_used
+        while used:
+            key = used.popleft()
+            if lru is not None and key in lru:
+                lru[key] = lru.pop(key)
+
+    def _set_size(self, key):
+        self._apply_lru_used()
+        size = self.tuple_size(self.data[key])
+        stream = self.streams.get(key, None)
+        if stream is not None:
+            size += len(stream[0])
+        self.nbytes += size - self._lru.pop(key, 0)
+        self._lru[key] = size
+
+    def _check_size(self, key, size, stream_size=None):
+        # raises ConstraintError if the entity with *key* can't be
+        # written without exceeding the bounds on its own
+        if self.max_entries == 0:
+            raise edm.ConstraintError(
+                "%s: entity set is bounded to 0 entities" %
+                self.entity_set.name)
+        if self.max_bytes is None:
+            return
+        if stream_size is None:
+            stream = self.streams.get(key, None)
+            stream_size = 0 if stream is None else len(stream[0])
+        if size + stream_size > self.max_bytes:
+            raise edm.ConstraintError(
+                "%s(%s): entity exceeds the maximum size of entity set" %
+                (self.entity_set.name, repr(key)))
+
+    def _evict(self, keep=None):
+        # evicts least recently used entities until the bounds are
+        # satisfied, never evicts *keep* (the entity being written)
+        self._apply_lru_used()
+        lru = self._lru
+        while lru and (
+                (self.max_entries is not None and
+                 len(lru) > self.max_entries) or
+                (self.max_bytes is not None and
+                 self.nbytes > self.max_bytes)):
+            key = next(iter(lru))
+            if key == keep:
+                break
+            self.delete_entity(key)
+            self.nevicted += 1
+
+    def stats(self):
+        """Returns a dictionary of statistics about this entity set
+
+        entities
+            The number of entities
+
+        data_bytes
+            The estimated size of the stored tuples, see
+            :py:meth:`tuple_size`
+
+        streams
+            The number of media streams
+
+        stream_bytes
+            The total length of the media streams
+
+        indexes
+            A dictionary mapping the names of indexed properties on to
+            the number of entries in the index
+
+        expired and evicted
+            The values of :py:attr:`nexpired` and :py:attr:`nevicted`
+
+        The tuples are sized using a snapshot so the container is not
+        locked during the calculation."""
+        data = self.snapshot()
+        try:
+            data_bytes = 0
+            for value in dict_values(data):
+                data_bytes += self.tuple_size(value)
+        finally:
+            self.release_snapshot(data)
+        with self.container.read_lock:
+            stream_bytes = 0
+            for stream, sinfo in dict_values(self.streams):
+                stream_bytes += len(stream)
+            indexes = {}
+            for pname, index in dict_items(self.indexes):
+                indexes[pname] = len(index.values) + len(index.null_keys)
+            return {'entities': len(data),
+                    'data_bytes': data_bytes,
+                    'streams': len(self.streams),
+                    'stream_bytes': stream_bytes,
+                    'indexes': indexes,
+                    'expired': self.nexpired,
+                    'evicted': self.nevicted}
+
+    def tuple_size(self, value):
+        """Returns the estimated size of a stored tuple in bytes
+
+        The estimate is the sum of the sizes of the tuple and the values
+        it contains as reported by sys.getsizeof.  Media streams are
+        counted separately, using their length."""
+        size = sys.getsizeof(value)
+        for v in value:
+            if isinstance(v, tuple):
+                size += self.tuple_size(v)
+            elif v is not None:
+                size += sys.getsizeof(v)
+        return size
 
     def get_tuple_from_complex(self, complex_value):
         value = []
@@ -247,14 +973,40 @@ class InMemoryEntityStore(object):
             self._deleting.remove(key)
 
     def delete_entity(self, key):
+        self.delete_entities((key, ))
+
+    def delete_entities(self, keys):
+        """Deletes the entities with the given *keys*
+
+        The links to and from the entities are removed from the
+        association indexes in a single pass for each association, no
+        other constraints are checked.  Raises KeyError if any of the
+        keys is missing, in which case nothing is deleted."""
         with self.container.lock:
+            keys = list(keys)
+            for key in keys:
+                if not self.test_key(key):
+                    raise KeyError(repr(key))
+            if len(set(keys)) < len(keys):
+                # remove duplicates, preserving order
+                seen = set()
+                keys = [k for k in keys if not (k in seen or seen.add(k))]
             for aindex in dict_values(self.associations):
-                aindex.delete_hook(key)
+                aindex.remove_links_from(keys)
             for aindex in dict_values(self.reverseAssociations):
-                aindex.rdelete_hook(key)
-            del self.data[key]
-            if key in self.streams:
-                del self.streams[key]
+                aindex.remove_links_to(keys)
+            data = self.data
+            for key in keys:
+                value = data.pop(key)
+                for index in dict_values(self.indexes):
+                    index.remove(value[index.position], key)
+                if key in self.streams:
+                    del self.streams[key]
+                self._expires.pop(key, None)
+                if self._lru is not None:
+                    self.nbytes -= self._lru.pop(key, 0)
+                self.container.log_change(
+                    (LogRecord.delete, self.entity_set.name, key))
 
     def test_key(self, key):
         """Return True if *key* is in the container.
@@ -264,6 +1016,151 @@ class InMemoryEntityStore(object):
         return key in self.data
 
 
+class InMemoryPropertyIndex(object):
+
+    """A sorted index of the values of a simple property
+
+    pname
+        The name of the property being indexed
+
+    position
+        The position of the property's value in the tuples stored by
+        the :py:class:`InMemoryEntityStore`
+
+    type_code
+        The :py:class:`~pyslet.odata2.csdl.SimpleType` of the property
+
+    The index is a sorted list of (value, key) tuples with the keys of
+    entities with NULL values kept separately.  Entities with the same
+    value are therefore always in key order, matching the order used
+    when paging through a collection.
+
+    Instances are created by :py:meth:`InMemoryEntityStore.add_index`
+    and are not thread safe, all methods must only be called if you
+    have acquired the container lock."""
+
+    #: the simple types that can be compared using Python integers
+    INTEGER_TYPES = frozenset((
+        edm.SimpleType.Byte, edm.SimpleType.SByte, edm.SimpleType.Int16,
+        edm.SimpleType.Int32, edm.SimpleType.Int64))
+
+    def __init__(self, pname, position, type_code):
+        #: the name of the indexed property
+        self.name = pname
+        #: the position of the property value in the stored tuple
+        self.position = position
+        #: the type of the property
+        self.type_code = type_code
+        #: a sorted list of (value, key) tuples
+        self.values = []
+        #: a sorted list of the keys of entities with NULL values
+        self.null_keys = []
+
+    def rebuild(self, data):
+        """Rebuilds the index from a dictionary of stored tuples
+
+        data
+            A dictionary mapping keys on to stored tuples, see
+            :py:attr:`InMemoryEntityStore.data`
+
+        Sorting the complete list of values is much faster than adding
+        each entity individually."""
+        values = []
+        null_keys = []
+        for key, value in dict_items(data):
+            value = value[self.position]
+            if value is None:
+                null_keys.append(key)
+            else:
+                values.append((value, key))
+        values.sort()
+        null_keys.sort()
+        self.values = values
+        self.null_keys = null_keys
+
+    def add(self, value, key):
+        """Adds *key* to the index with *value*"""
+        if value is None:
+            bisect.insort(self.null_keys, key)
+        else:
+            bisect.insort(self.values, (value, key))
+
+    def remove(self, value, key):
+        """Removes *key* from the index, *value* must be the value
+        the key was added with."""
+        if value is None:
+            vlist, item = self.null_keys, key
+        else:
+            vlist, item = self.values, (value, key)
+        i = bisect.bisect_left(vlist, item)
+        if i < len(vlist) and vlist[i] == item:
+            del vlist[i]
+
+    def comparable(self, literal):
+        """Returns True if the simple value *literal* can be compared
+        with the values in this index using Python's comparison
+        operators with the same result as the OData operators."""
+        if literal.value is None:
+            return False
+        if literal.type_code == self.type_code:
+            return True
+        return (literal.type_code in self.INTEGER_TYPES and
+                self.type_code in self.INTEGER_TYPES)
+
+    def _lower(self, value):
+        # the position of the first item with value >= *value*
+        return bisect.bisect_left(self.values, (value, ))
+
+    def _upper(self, value):
+        # the position of the first item with value > *value*
+        i = bisect.bisect_left(self.values, (value, ))
+        while i < len(self.values) and self.values[i][0] == value:
+            i += 1
+        return i
+
+    def lookup(self, operator, value):
+        """Returns a list of keys that match a comparison
+
+        operator
+            One of the :py:class:`~pyslet.odata2.core.Operator` values
+            eq, lt, le, gt or ge.
+
+        value
+            The (non-NULL) Python value to compare with
+
+        The keys are returned in the order of the index."""
+        if operator == odata.Operator.eq:
+            i, j = self._lower(value), self._upper(value)
+        elif operator == odata.Operator.lt:
+            i, j = 0, self._lower(value)
+        elif operator == odata.Operator.le:
+            i, j = 0, self._upper(value)
+        elif operator == odata.Operator.gt:
+            i, j = self._upper(value), len(self.values)
+        elif operator == odata.Operator.ge:
+            i, j = self._lower(value), len(self.values)
+        else:
+            raise ValueError("Can't lookup operator %s" %
+                             odata.Operator.to_str(operator))
+        return [k for v, k in self.values[i:j]]
+
+    def ordered_keys(self, reverse=False):
+        """Returns a list of all keys in order of value
+
+        NULL values sort before all other values, *reverse* reverses
+        the order of the values but entities with the same value are
+        still returned in key order."""
+        if not reverse:
+            return self.null_keys + [k for v, k in self.values]
+        result = []
+        j = len(self.values)
+        while j:
+            i = self._lower(self.values[j - 1][0])
+            result += [k for v, k in self.values[i:j]]
+            j = i
+        return result + self.null_keys
+
+
 class InMemoryAssociationIndex(object):
 
     """An in memory index that implements the association between two
@@ -330,51 +1227,129 @@ class InMemoryAssociationIndex(object):
 
     def add_link(self, from_key, to_key):
         """Adds a link from *from_key* to *to_key*"""
+        self.add_links(((from_key, to_key), ))
+
+    def add_links(self, links):
+        """Adds links in a single locked pass
+
+        links
+            An iterable of (from_key, to_key) tuples
+
+        No constraints are checked."""
         with self.container.lock:
-            self.index.setdefault(from_key, set()).add(to_key)
-            self.reverseIndex.setdefault(to_key, set()).add(from_key)
+            for from_key, to_key in links:
+                self.index.setdefault(from_key, set()).add(to_key)
+                self.reverseIndex.setdefault(to_key, set()).add(from_key)
+                self.container.log_change(
+                    (LogRecord.link, self.name, from_key, to_key))
 
     def get_links_from(self, from_key):
         """Returns a tuple of to_keys linked from *from_key*"""
-        with self.container.lock:
+        with self.container.read_lock:
             return tuple(self.index.get(from_key, ()))
 
     def get_links_to(self, to_key):
         """Returns a tuple of from_keys linked to *to_key*"""
-        with self.container.lock:
+        with self.container.read_lock:
             return tuple(self.reverseIndex.get(to_key, ()))
 
+    def stats(self):
+        """Returns a dictionary of statistics about this index
+
+        links
+            The number of links
+
+        sources and targets
+            The number of distinct source and target keys"""
+        with self.container.read_lock:
+            links = 0
+            for to_keys in dict_values(self.index):
+                links += len(to_keys)
+            return {'links': links,
+                    'sources': len(self.index),
+                    'targets': len(self.reverseIndex)}
+
+    def get_links_from_keys(self, from_keys):
+        """Returns the links from a set of keys in a single locked pass
+
+        from_keys
+            An iterable of source keys
+
+        Returns a dictionary mapping each key in *from_keys* on to a
+        tuple of the to_keys linked from it."""
+        with self.container.read_lock:
+            return dict((k, tuple(self.index.get(k, ()))) for k in from_keys)
+
+    def get_links_to_keys(self, to_keys):
+        """Returns the links to a set of keys in a single locked pass
+
+        The reverse of :py:meth:`get_links_from_keys`, returns a
+        dictionary mapping each key in *to_keys* on to a tuple of the
+        from_keys linked to it."""
+        with self.container.read_lock:
+            return dict((k, tuple(self.reverseIndex.get(k, ())))
+                        for k in to_keys)
+
     def remove_link(self, from_key, to_key):
         """Removes a link from *from_key* to *to_key*"""
         with self.container.lock:
             self.index.get(from_key, set()).discard(to_key)
             self.reverseIndex.get(to_key, set()).discard(from_key)
+            self.container.log_change(
+                (LogRecord.unlink, self.name, from_key, to_key))
+
+    def restore(self, index):
+        """Replaces the links in this index
+
+        index
+            A dictionary mapping source keys on to sets of target keys,
+            e.g., a value of :py:attr:`index` from a previous session.
+            The reverse index is rebuilt from it."""
+        with self.container.lock:
+            self.index = index
+            self.reverseIndex = {}
+            for from_key, to_keys in dict_items(index):
+                for to_key in to_keys:
+                    self.reverseIndex.setdefault(to_key, set()).add(from_key)
 
     def delete_hook(self, from_key):
         """Called only by :py:meth:`InMemoryEntityStore.delete_entity`"""
-        try:
-            to_keys = self.index[from_key]
-            for to_key in to_keys:
-                from_keys = self.reverseIndex[to_key]
-                from_keys.remove(from_key)
-                if len(from_keys) == 0:
-                    del self.reverseIndex[to_key]
-            del self.index[from_key]
-        except KeyError:
-            pass
+        self.remove_links_from((from_key, ))
 
     def rdelete_hook(self, to_key):
         """Called only by :py:meth:`InMemoryEntityStore.delete_entity`"""
-        try:
-            from_keys = self.reverseIndex[to_key]
+        self.remove_links_to((to_key, ))
+
+    def remove_links_from(self, from_keys):
+        """Removes all links from a set of keys in a single locked pass
+
+        Used when the source entities are deleted, these changes are
+        not logged as they are implied by the deletions."""
+        with self.container.lock:
             for from_key in from_keys:
-                to_keys = self.index[from_key]
-                to_keys.remove(to_key)
-                if len(to_keys) == 0:
-                    del self.index[from_key]
-            del self.reverseIndex[to_key]
-        except KeyError:
-            pass
+                to_keys = self.index.pop(from_key, ())
+                for to_key in to_keys:
+                    rkeys = self.reverseIndex.get(to_key, None)
+                    if rkeys is None:
+                        continue
+                    rkeys.discard(from_key)
+                    if not rkeys:
+                        del self.reverseIndex[to_key]
+
+    def remove_links_to(self, to_keys):
+        """Removes all links to a set of keys in a single locked pass
+
+        The reverse of :py:meth:`remove_links_from`."""
+        with self.container.lock:
+            for to_key in to_keys:
+                from_keys = self.reverseIndex.pop(to_key, ())
+                for from_key in from_keys:
+                    fkeys = self.index.get(from_key, None)
+                    if fkeys is None:
+                        continue
+                    fkeys.discard(to_key)
+                    if not fkeys:
+                        del self.index[from_key]
 
 
 # class WEntityStream(StringIO):
@@ -400,14 +1375,199 @@ class Entity(odata.Entity):
         self.entity_store = entity_store  # : points to the entity storage
 
 
+class RowEntity(Entity):
+
+    """An entity backed directly by a tuple of stored values
+
+    row
+        The tuple of values from the :py:class:`InMemoryEntityStore`
+
+    Unlike other entities, the property values are not created on
+    construction but on first access, values that are never accessed
+    are never created.  Once created, a value is independent of the
+    stored tuple and can be modified in the usual way.  The stored
+    tuples are never modified in place so the entity is not affected
+    by subsequent updates."""
+
+    def __init__(self, entity_set, entity_store, row):
+        # bypass the creation of the property values by Entity
+        edm.TypeInstance.__init__(self, None)
+        self.type_def = entity_set.entityType
+        self.entity_set = entity_set
+        self.entity_store = entity_store
+        self.exists = False
+        self.selected = None
+        self.row = row
+
+    def __getitem__(self, name):
+        value = self.data.get(name, None)
+        if value is not None:
+            return value
+        position = self.entity_store.property_positions().get(name, None)
+        if position is not None:
+            i, p = position
+            value = p()
+            if self.is_selected(name) or name in self.entity_set.keys:
+                if isinstance(value, edm.Complex):
+                    self.entity_store.set_complex_from_tuple(
+                        value, self.row[i])
+                else:
+                    value.set_from_value(self.row[i])
+            else:
+                value.set_null()
+        elif self.is_navigation_property(name):
+            value = edm.DeferredValue(name, self)
+        else:
+            raise KeyError(name)
+        self.data[name] = value
+        return value
+
+    def key(self):
+        positions = self.entity_store.property_positions()
+        k = []
+        for pref in self.type_def.Key.PropertyRef:
+            value = self.data.get(pref.name, None)
+            if value is None:
+                k.append(self.row[positions[pref.name][0]])
+            else:
+                k.append(value.value)
+        if len(k) == 1:
+            if k[0] is None:
+                raise KeyError("Entity with NULL key not allowed")
+            return k[0]
+        elif k.count(None) == len(k):
+            raise KeyError("Entity with NULL key not allowed")
+        return tuple(k)
+
+    def null_unselected(self):
+        # values that have not been created yet are created as NULLs
+        for k, v in dict_items(self.data):
+            if isinstance(v, edm.DeferredValue):
+                continue
+            if k not in self.entity_set.keys and k not in self.selected:
+                v.set_null()
+
+
 class EntityCollection(odata.EntityCollection):
 
     """An entity collection that provides access to entities stored in
     the :py:class:`InMemoryEntitySet` *entity_store*."""
 
     def __init__(self, entity_store, **kwargs):
-        super(EntityCollection, self).__init__(**kwargs)
         self.entity_store = entity_store
+        #: a function compiled from the filter, or None
+        self.filter_function = None
+        super(EntityCollection, self).__init__(**kwargs)
+
+    def set_filter(self, filter):
+        """Compiles the filter into a function if possible
+
+        Filters that can be compiled are evaluated directly against the
+        stored values, avoiding the creation of entities that do not
+        match the filter.  Other filters are evaluated in the usual way
+        using :py:meth:`check_filter`."""
+        super(EntityCollection, self).set_filter(filter)
+        if filter is None:
+            self.filter_function = None
+        else:
+            self.filter_function = filter.compile_filter(
+                self.entity_store.resolve_path)
+
+    #: the maximum number of entities expanded together, see
+    #: :py:meth:`expand_batches`
+    EXPAND_BATCH = 100
+
+    def expand_entities(self, entity_iterable):
+        if not self.expand:
+            return super(EntityCollection, self).expand_entities(
+                entity_iterable)
+        return self.expand_batches(entity_iterable, self.expand, self.select)
+
+    def expand_batches(self, entity_iterable, expand, select):
+        """Expands entities from this collection's entity set in batches
+
+        entity_iterable
+            An iterable of entities to expand
+
+        expand and select
+            The expand and select rules to apply, see
+            :py:meth:`Entity.expand`
+
+        A generator that yields the expanded entities in the same order
+        as *entity_iterable*.  The entities are grouped into batches of
+        at most :py:attr:`EXPAND_BATCH` entities and each batch is
+        expanded using :py:meth:`expand_batch`."""
+        batch = []
+        for e in entity_iterable:
+            batch.append(e)
+            if len(batch) >= self.EXPAND_BATCH:
+                self.expand_batch(batch, expand, select)
+                for e in batch:
+                    yield e
+                batch = []
+        if batch:
+            self.expand_batch(batch, expand, select)
+            for e in batch:
+                yield e
+
+    def expand_batch(self, entities, expand, select):
+        """Expands a list of entities from this collection's entity set
+
+        Navigation properties bound to an
+        :py:class:`InMemoryAssociationIndex` are expanded for all the
+        *entities* using a single pass of the index and the target
+        entities are read from a single snapshot.  The target entities
+        are then expanded recursively in the same way.  An entity that
+        is the target of more than one of the *entities* is shared
+        between their expansions.  Other navigation properties are
+        expanded individually."""
+        for e in entities:
+            e.expand(None, select)
+        if not expand:
+            return
+        if select is None:
+            select = {}
+        for name, sub_expand in dict_items(expand):
+            if name in select:
+                sub_select = select[name]
+                if sub_select is None:
+                    sub_select = {'*': None}
+            else:
+                sub_select = None
+            binding, kws = self.entity_set.navigation_bindings[name]
+            aindex = kws.get('aindex', None)
+            if binding is not NavigationCollection or aindex is None:
+                for e in entities:
+                    e[name].expand_collection(sub_expand, sub_select)
+                continue
+            keys = [e.key() for e in entities]
+            if kws['reverse']:
+                links = aindex.get_links_to_keys(keys)
+                target_store = aindex.from_store
+            else:
+                links = aindex.get_links_from_keys(keys)
+                target_store = aindex.to_store
+            target_keys = set()
+            for tkeys in dict_values(links):
+                target_keys.update(tkeys)
+            targets = {}
+            for t in target_store.generate_entities(keys=target_keys):
+                targets[t.key()] = t
+            with target_store.entity_set.open() as collection:
+                collection.expand_batch(
+                    list(dict_values(targets)), sub_expand, sub_select)
+            target_set = target_store.entity_set
+            for e in entities:
+                e[name].set_expansion(odata.ExpandedEntityCollection(
+                    from_entity=e, name=name, entity_set=target_set,
+                    entity_list=[targets[k] for k in links[e.key()]
+                                 if k in targets]))
+
+    def _filter_entities(self, entity_iterable):
+        if self.filter_function is not None:
+            # already filtered by the entity store
+            return entity_iterable
+        return self.filter_entities(entity_iterable)
 
     def new_entity(self):
         """Returns an OData aware instance"""
@@ -452,22 +1612,85 @@ class EntityCollection(odata.EntityCollection):
     def __len__(self):
         if self.filter is None:
             return self.entity_store.count_entities()
+        elif self.filter_function is not None:
+            return self.entity_store.count_entities(
+                self.filter_function, self._filter_keys(self.filter))
         else:
             result = 0
             for e in self.filter_entities(
-                    self.entity_store.generate_entities()):
+                    self.entity_store.generate_entities(
+                        keys=self._filter_keys(self.filter))):
                 result += 1
             return result
 
     def itervalues(self):
+        keys = self._orderby_keys()
+        if keys is not None:
+            # the keys are already in the required order
+            return self.expand_entities(
+                self._filter_entities(
+                    self.entity_store.generate_entities(
+                        self.select, keys, self.filter_function)))
         return self.order_entities(
             self.expand_entities(
-                self.filter_entities(
-                    self.entity_store.generate_entities(self.select))))
+                self._filter_entities(
+                    self.entity_store.generate_entities(
+                        self.select, self._filter_keys(self.filter),
+                        self.filter_function))))
+
+    _reverse_operator = {
+        odata.Operator.eq: odata.Operator.eq,
+        odata.Operator.lt: odata.Operator.gt,
+        odata.Operator.le: odata.Operator.ge,
+        odata.Operator.gt: odata.Operator.lt,
+        odata.Operator.ge: odata.Operator.le}
+
+    def _filter_keys(self, filter):
+        # Returns a list of candidate keys for entities that match
+        # filter using an index, or None if no index can be used.  The
+        # filter must still be applied to the resulting entities.
+        if filter is None or filter.operator is None:
+            return None
+        if filter.operator == odata.Operator.bool_and:
+            keys = self._filter_keys(filter.operands[0])
+            if keys is None:
+                keys = self._filter_keys(filter.operands[1])
+            return keys
+        if filter.operator not in self._reverse_operator:
+            return None
+        lvalue, rvalue = filter.operands
+        operator = filter.operator
+        if isinstance(lvalue, odata.LiteralExpression):
+            lvalue, rvalue = rvalue, lvalue
+            operator = self._reverse_operator[operator]
+        if not (isinstance(lvalue, odata.PropertyExpression) and
+                isinstance(rvalue, odata.LiteralExpression)):
+            return None
+        with self.entity_store.container.read_lock:
+            index = self.entity_store.indexes.get(lvalue.name, None)
+            if index is None or not index.comparable(rvalue.value):
+                return None
+            return index.lookup(operator, rvalue.value.value)
+
+    def _orderby_keys(self):
+        # Returns a list of all keys in the order defined by orderby
+        # using an index, or None if no index can be used.
+        if self.orderby is None or len(self.orderby) != 1:
+            return None
+        rule, rule_dir = self.orderby[0]
+        if not isinstance(rule, odata.PropertyExpression):
+            return None
+        with self.entity_store.container.read_lock:
+            index = self.entity_store.indexes.get(rule.name, None)
+            if index is None:
+                return None
+            return index.ordered_keys(reverse=rule_dir < 0)
 
     def __getitem__(self, key):
-        e = self.entity_store.read_entity(key, self.select)
-        if e is not None and self.check_filter(e):
+        e = self.entity_store.read_entity(key, self.select,
+                                          self.filter_function)
+        if e is not None and (self.filter_function is not None or
+                              self.check_filter(e)):
             e.expand(self.expand, self.select)
             return e
         else:
@@ -480,6 +1703,9 @@ class EntityCollection(odata.EntityCollection):
             # now process any bindings
             self.update_bindings(entity)
 
+    def change_token(self):
+        return self.entity_store.container.change_token()
+
     def __delitem__(self, key):
         """We do a cascade delete of everything that *must* be linked to
         us. We don't need to bother about deleting links because the
@@ -588,6 +1814,9 @@ class EntityCollection(odata.EntityCollection):
                 if not self.entity_store.test_key(key):
                     break
                 e.auto_key()
+            # check the bounds first so that an oversized stream doesn't
+            # leave an entity without its stream
+            self.entity_store.check_size(e, len(data))
             self.insert_entity(e)
             self.entity_store.update_entity_stream(key, data, sinfo)
         return e
@@ -666,6 +1895,9 @@ class NavigationCollection(odata.NavigationCollection):
         """Returns an OData aware instance"""
         return self.collection.new_entity()
 
+    def change_token(self):
+        return self.collection.change_token()
+
     def close(self):
         if self.collection is not None:
             self.collection.close()
@@ -690,10 +1922,10 @@ class NavigationCollection(odata.NavigationCollection):
             return result
 
     def entity_generator(self):
-        # we create a collection from the appropriate entity set first
+        # read all the target entities from a single snapshot
         result_set = self.lookupMethod(self.key)
-        for k in result_set:
-            yield self.collection[k]
+        return self.collection.entity_store.generate_entities(
+            keys=result_set)
 
     def itervalues(self):
         return self.order_entities(
@@ -701,6 +1933,13 @@ class NavigationCollection(odata.NavigationCollection):
                 self.filter_entities(
                     self.entity_generator())))
 
+    def expand_entities(self, entity_iterable):
+        if not self.expand:
+            return super(NavigationCollection, self).expand_entities(
+                entity_iterable)
+        return self.collection.expand_batches(
+            entity_iterable, self.expand, self.select)
+
     def __getitem__(self, key):
         result_set = self.lookupMethod(self.key)
         if key in result_set:
@@ -782,23 +2021,250 @@ class NavigationCollection(odata.NavigationCollection):
                         self.aindex.remove_link(self.key, oldKey)
 
 
+class InstrumentedLock(object):
+
+    """A re-entrant lock that records wait and hold times
+
+    Behaves like threading.RLock, including use in a with statement,
+    but also keeps a record of the number of times the lock was
+    acquired and the time spent waiting for it and holding it.  The
+    hold time is measured from the first (outermost) acquisition by a
+    thread to the matching release."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # the recursion depth of the thread holding the lock
+        self._depth = 0
+        self._acquired_at = 0.0
+        #: the number of times the lock has been acquired (excluding
+        #: recursive acquisitions)
+        self.nacquired = 0
+        #: the total time spent waiting for the lock in seconds
+        self.wait_time = 0.0
+        #: the longest time spent waiting for the lock
+        self.max_wait = 0.0
+        #: the total time the lock has been held in seconds
+        self.hold_time = 0.0
+        #: the longest time the lock has been held
+        self.max_hold = 0.0
+
+    def acquire(self, blocking=True):
+        start = time.time()
+        if not self._lock.acquire(blocking):
+            return False
+        if self._depth == 0:
+            now = time.time()
+            wait = now - start
+            self._acquired_at = now
+            self.nacquired += 1
+            self.wait_time += wait
+            if wait > self.max_wait:
+                self.max_wait = wait
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            hold = time.time() - self._acquired_at
+            self.hold_time += hold
+            if hold > self.max_hold:
+                self.max_hold = hold
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def stats(self):
+        """Returns a dictionary of the lock statistics
+
+        The keys are the names of the attributes: nacquired, wait_time,
+        max_wait, hold_time and max_hold."""
+        with self._lock:
+            return {'nacquired': self.nacquired,
+                    'wait_time': self.wait_time,
+                    'max_wait': self.max_wait,
+                    'hold_time': self.hold_time,
+                    'max_hold': self.max_hold}
+
+
+class ReadWriteLock(object):
+
+    """A re-entrant reader/writer lock
+
+    Used directly in a with statement, or with :py:meth:`acquire` and
+    :py:meth:`release`, the lock behaves like threading.RLock and grants
+    exclusive (write) access.  Shared (read) access is obtained using
+    the :py:attr:`reader` attribute::
+
+        with lock.reader:
+            # any number of threads may be reading here
+
+    A thread that holds the write lock may also acquire the read lock
+    and read locks may be nested but a thread that holds only a read
+    lock must not attempt to acquire the write lock, RuntimeError is
+    raised to prevent a deadlock.  Waiting writers take priority over
+    new readers so that writers are not starved."""
+
+    def __init__(self):
+        self._cv = threading.Condition(threading.Lock())
+        self._writer = None
+        self._wdepth = 0
+        self._wwaiting = 0
+        self._readers = 0
+        self._local = threading.local()
+        #: an object that acquires the lock for reading when used in a
+        #: with statement
+        self.reader = _ReadLock(self)
+
+    def acquire_read(self):
+        me = threading.current_thread()
+        depth = getattr(self._local, 'depth', 0)
+        with self._cv:
+            if not depth and self._writer is not me:
+                while self._writer is not None or self._wwaiting:
+                    self._cv.wait()
+            self._readers += 1
+        self._local.depth = depth + 1
+
+    def release_read(self):
+        self._local.depth -= 1
+        with self._cv:
+            self._readers -= 1
+            if not self._readers:
+                self._cv.notify_all()
+
+    def acquire(self):
+        me = threading.current_thread()
+        with self._cv:
+            if self._writer is me:
+                self._wdepth += 1
+                return True
+            if getattr(self._local, 'depth', 0):
+                raise RuntimeError("Can't upgrade a read lock")
+            self._wwaiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cv.wait()
+            finally:
+                self._wwaiting -= 1
+            self._writer = me
+            self._wdepth = 1
+            return True
+
+    def release(self):
+        with self._cv:
+            self._wdepth -= 1
+            if not self._wdepth:
+                self._writer = None
+                self._cv.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class _ReadLock(object):
+
+    def __init__(self, rwlock):
+        self.rwlock = rwlock
+
+    def __enter__(self):
+        self.rwlock.acquire_read()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.rwlock.release_read()
+
+
 class InMemoryEntityContainer(object):
 
-    def __init__(self, container_def):
+    """An entity container that stores its data in memory
+
+    container_def
+        The :py:class:`csdl.EntityContainer` that defines this
+        container.
+
+    row_view
+        Passed to the :py:class:`InMemoryEntityStore` created for each
+        entity set, defaults to False.
+
+    lock_stats
+        If True, the container's lock is an :py:class:`InstrumentedLock`
+        that records the time spent waiting for and holding the lock,
+        see :py:meth:`stats`.  Defaults to False.
+
+    rw_lock
+        If True, the container's lock is a :py:class:`ReadWriteLock`
+        allowing multiple threads to read the container at the same
+        time.  Defaults to False, a single mutex is used for both
+        reading and writing.  Can't be combined with *lock_stats*.
+
+    The contents of the container can be saved with :py:meth:`dump`
+    and loaded again with :py:meth:`restore`.  Changes made after a
+    dump can be recorded in an append-only log, see
+    :py:meth:`set_log`.  A typical service would restart with
+    something like this::
+
+        if snapshot_path.exists():
+            with snapshot_path.open('rb') as f:
+                container.restore(f)
+        if log_path.exists():
+            with log_path.open('rb') as f:
+                container.replay_log(f)
+        # take a new snapshot and start a new log
+        with snapshot_path.open('wb') as f:
+            container.dump(f)
+        container.set_log(log_path.open('wb'))"""
+
+    #: the version of the format written by :py:meth:`dump`
+    DUMP_VERSION = 1
+
+    def __init__(self, container_def, row_view=False, lock_stats=False,
+                 rw_lock=False):
         #: the :py:class:`csdl.EntityContainer` that defines this container
         self.container_def = container_def
-        """a lock that must be acquired before modifying any entity or
-        association in this container"""
-        self.lock = threading.RLock()
+        if rw_lock:
+            if lock_stats:
+                raise ValueError("lock_stats requires rw_lock=False")
+            lock = ReadWriteLock()
+            read_lock = lock.reader
+        else:
+            if lock_stats:
+                lock = InstrumentedLock()
+            else:
+                lock = threading.RLock()
+            read_lock = lock
+        #: a lock that must be acquired before modifying any entity or
+        #: association in this container
+        self.lock = lock
+        #: a lock that must be acquired before reading entities or
+        #: associations in this container, the same as :py:attr:`lock`
+        #: unless the container uses a :py:class:`ReadWriteLock`
+        self.read_lock = read_lock
         """a mapping from entity set names to
         :py:class:`InMemoryEntityStore` instances"""
         self.entityStorage = {}
         """a mapping from association set name to
         :py:class:`InMemoryAssociationIndex` instances"""
         self.associationStorage = {}
+        #: the binary file to which changes are logged, or None
+        self.log = None
+        #: the number of changes made to the container
+        self.nchanges = 0
+        # distinguishes change tokens from different containers
+        self._token_base = "%08x" % random.getrandbits(32)
         # for each entity set in this container, bind some storage
         for es in self.container_def.EntitySet:
-            self.entityStorage[es.name] = InMemoryEntityStore(self, es)
+            self.entityStorage[es.name] = InMemoryEntityStore(
+                self, es, row_view=row_view)
         for es in self.container_def.EntitySet:
             from_storage = self.entityStorage[es.name]
             if es.entityType is None:
@@ -829,3 +2295,182 @@ class InMemoryEntityContainer(object):
                         from_storage,
                         to_storage,
                         np.name)
+
+    def stats(self):
+        """Returns a dictionary of statistics about the container
+
+        The dictionary contains the following keys:
+
+        entity_sets
+            A dictionary mapping entity set names on to the result of
+            :py:meth:`InMemoryEntityStore.stats`
+
+        association_sets
+            A dictionary mapping association set names on to the result
+            of :py:meth:`InMemoryAssociationIndex.stats`
+
+        bytes
+            The total estimated size of the entities and streams in
+            bytes
+
+        lock
+            The result of :py:meth:`InstrumentedLock.stats` or None if
+            the container was created without *lock_stats*
+
+        Calculating the sizes requires a scan of all the stored data
+        so this method should not be called too frequently."""
+        entity_sets = {}
+        nbytes = 0
+        for name, store in dict_items(self.entityStorage):
+            store_stats = store.stats()
+            nbytes += store_stats['data_bytes'] + store_stats['stream_bytes']
+            entity_sets[name] = store_stats
+        association_sets = {}
+        for name, aindex in dict_items(self.associationStorage):
+            association_sets[name] = aindex.stats()
+        if isinstance(self.lock, InstrumentedLock):
+            lock = self.lock.stats()
+        else:
+            lock = None
+        return {'entity_sets': entity_sets,
+                'association_sets': association_sets,
+                'bytes': nbytes,
+                'lock': lock}
+
+    def change_token(self):
+        """Returns a token that changes whenever the container changes
+
+        The token combines a random value chosen when the container is
+        created with the number of changes made so far, see
+        :py:attr:`nchanges`.  Entities that are due to expire are
+        removed first so that the token reflects the data that would be
+        returned by a subsequent read."""
+        for store in dict_values(self.entityStorage):
+            store._expire_due()
+        return "%s-%i" % (self._token_base, self.nchanges)
+
+    def dump(self, f):
+        """Writes the contents of the container to a binary file
+
+        f
+            A file-like object opened for writing in binary mode.
+
+        The stored tuples and media streams of every entity set and the
+        links in every association set are written in a compact binary
+        form (using Python's pickle module) suitable for passing to
+        :py:meth:`restore`.  The container is locked (for reading) while
+        the data is written."""
+        with self.read_lock:
+            entities = {}
+            for name, store in dict_items(self.entityStorage):
+                entities[name] = (dict(store.data), store.streams)
+            links = {}
+            for name, aindex in dict_items(self.associationStorage):
+                links[name] = aindex.index
+            pickle.dump((self.DUMP_VERSION, entities, links), f,
+                        pickle.HIGHEST_PROTOCOL)
+
+    def restore(self, f):
+        """Replaces the contents of the container from a binary file
+
+        f
+            A file-like object opened for reading in binary mode
+            containing data previously written by :py:meth:`dump`.
+
+        Entity and association sets that are not present in the data
+        are emptied, data for entity sets and association sets that are
+        not present in the container is ignored.  The restored data is
+        not checked for consistency with the metadata model and no
+        changes are logged."""
+        version, entities, links = pickle.load(f)
+        if version != self.DUMP_VERSION:
+            raise ValueError("Unsupported dump version: %s" % str(version))
+        with self.lock:
+            for name, store in dict_items(self.entityStorage):
+                data, streams = entities.get(name, ({}, {}))
+                store.restore(data, streams)
+            for name, aindex in dict_items(self.associationStorage):
+                aindex.restore(links.get(name, {}))
+            self.nchanges += 1
+
+    def set_log(self, f):
+        """Sets the log to which changes are written
+
+        f
+            A file-like object opened for writing (or appending) in
+            binary mode or None to stop logging.  Any existing log is
+            *not* closed.
+
+        Each change to an entity, media stream or association set is
+        appended to the log and the file is flushed.  The log is
+        typically started immediately after a :py:meth:`dump`, the
+        changes it contains can then be reapplied to the restored
+        snapshot with :py:meth:`replay_log`."""
+        with self.lock:
+            self.log = f
+
+    def log_change(self, record):
+        """Writes *record* to the log
+
+        Called (with the lock acquired) by the entity stores and
+        association indexes after each change.  *record* is a tuple
+        starting with a :py:class:`LogRecord` constant followed by the
+        name of the entity set or association set that was changed.
+        The change is counted (see :py:meth:`change_token`) even if
+        there is no log."""
+        self.nchanges += 1
+        if self.log is not None:
+            pickle.dump(record, self.log, pickle.HIGHEST_PROTOCOL)
+            self.log.flush()
+
+    def replay_log(self, f):
+        """Applies the changes recorded in a log
+
+        f
+            A file-like object opened for reading in binary mode
+            containing records written to a log (see :py:meth:`set_log`).
+
+        Returns the number of records applied.  A truncated record at
+        the end of the log, for example, as a result of a crash while
+        the record was being written, is ignored.  Changes applied from
+        the log are not themselves logged."""
+        result = 0
+        with self.lock:
+            log, self.log = self.log, None
+            try:
+                while True:
+                    try:
+                        record = pickle.load(f)
+                    except EOFError:
+                        break
+                    except (pickle.UnpicklingError, ValueError,
+                            AttributeError, IndexError):
+                        logging.warning("Ignoring truncated record at end "
+                                        "of log after %i records", result)
+                        break
+                    self._replay_record(record)
+                    result += 1
+            finally:
+                self.log = log
+        return result
+
+    def _replay_record(self, record):
+        rtype = record[0]
+        if rtype in (LogRecord.link, LogRecord.unlink):
+            aindex = self.associationStorage[record[1]]
+            if rtype == LogRecord.link:
+                aindex.add_link(record[2], record[3])
+            else:
+                aindex.remove_link(record[2], record[3])
+            return
+        store = self.entityStorage[record[1]]
+        key = record[2]
+        if rtype == LogRecord.put:
+            store.put_tuple(key, record[3])
+        elif rtype == LogRecord.delete:
+            if store.test_key(key):
+                store.delete_entity(key)
+        elif rtype == LogRecord.stream:
+            store.update_entity_stream(key, record[3], record[4])
+        else:
+            raise ValueError("Unknown log record type: %s" % repr(rtype))
@@ -3,10 +3,16 @@
 
 import base64
 import codecs
+import collections
+import gzip
+import hashlib
+import io
 import json
 import logging
 import sys
+import threading
 import traceback
+import zlib
 
 from . import metadata as edmx
 from . import core as core
@@ -18,16 +24,38 @@ from .. import rfc4287 as atom
 from .. import rfc5023 as app
 from ..http import grammar
 from ..http import messages
+from ..http import multipart
 from ..http import params
 from ..pep8 import old_method
 from ..py2 import (
     byte_value,
+    dict_items,
     force_ascii,
     to_text)
 from ..unicode5 import detect_encoding
 from ..xml import structures as xml
 
 
+class ChangesetFailed(Exception):
+
+    """Raised when a request in a batch changeset fails
+
+    The *response* attribute contains the failed response as a triple
+    of status line, response headers and data."""
+
+    def __init__(self, response):
+        super(ChangesetFailed, self).__init__(response[0])
+        self.response = response
+
+
+class RequestTooLarge(ValueError):
+
+    """Raised when a decoded request body exceeds the maximum size
+
+    See :py:attr:`Server.max_decoded_size`."""
+    pass
+
+
 class WSGIWrapper(object):
 
     def __init__(self, environ, start_response, response_headers):
@@ -48,6 +76,153 @@ class WSGIWrapper(object):
         return self.start_response(status, response_headers, exc_info)
 
 
+class ResponseEncoder(object):
+
+    """Wraps a wsgi application to compress its response
+
+    start_response
+        The wsgi start_response function to wrap
+
+    encoding
+        The content coding to apply, "gzip" or "deflate"
+
+    threshold
+        The minimum size of a response body that will be compressed,
+        the size is only known when the response has a Content-Length,
+        streamed responses are always compressed.
+
+    level
+        The zlib compression level (1-9)
+
+    Only successful responses with a compressible content type (see
+    :py:meth:`compressible`) that do not already have a Content-Encoding
+    are compressed.  The application's call to start_response is
+    deferred until the response has been returned so that the
+    Content-Length of a buffered response can be replaced with the
+    length of the compressed data.  The write function of the wsgi
+    specification is not supported.
+
+    A strong ETag must change with the content coding so strong ETags
+    are weakened (see :py:meth:`weaken_etag`) in compressed responses
+    and in 304 responses, as the representation they validate may have
+    been compressed.  Conditional GETs use the weak comparison function
+    so clients that cached either form still match."""
+
+    #: the zlib wbits parameter to use for each content coding
+    WBITS = {'gzip': 31, 'deflate': 15}
+
+    def __init__(self, start_response, encoding, threshold, level):
+        self.start_response = start_response
+        self.encoding = encoding
+        self.threshold = threshold
+        self.level = level
+        self.status = None
+        self.response_headers = None
+        self.exc_info = None
+
+    def call(self, application, environ):
+        """Calls wsgi *application* returning the encoded response"""
+        data = application(environ, self.start_response_wrapper)
+        return self.encode(data)
+
+    def start_response_wrapper(self, status, response_headers, exc_info=None):
+        """Traps start_response, saving the arguments for later"""
+        self.status = status
+        self.response_headers = response_headers
+        self.exc_info = exc_info
+
+    @staticmethod
+    def compressible(status, response_headers):
+        """Returns True if a response should be compressed"""
+        if not status.startswith('2') or status.startswith('204'):
+            return False
+        mtype = None
+        for hname, hvalue in response_headers:
+            hname = hname.lower()
+            if hname == "content-encoding":
+                return False
+            elif hname == "content-type":
+                mtype = hvalue
+        if mtype is None:
+            return False
+        try:
+            mtype = params.MediaType.from_str(mtype)
+        except grammar.BadSyntax:
+            return False
+        return (mtype.type == "text" or mtype.subtype in ("xml", "json") or
+                mtype.subtype.endswith("+xml"))
+
+    @staticmethod
+    def weaken_etag(etag):
+        """Returns a weak version of the entity-tag *etag*"""
+        if etag.startswith('W/'):
+            return etag
+        else:
+            return 'W/' + etag
+
+    def encode(self, data):
+        status = self.status
+        response_headers = self.response_headers
+        if not self.compressible(status, response_headers):
+            if status.startswith('304'):
+                response_headers = [
+                    (hname, self.weaken_etag(hvalue)
+                     if hname.lower() == "etag" else hvalue)
+                    for hname, hvalue in response_headers]
+            self.start_response(status, response_headers, self.exc_info)
+            return data
+        clength = None
+        vary = False
+        headers = []
+        for hname, hvalue in response_headers:
+            lname = hname.lower()
+            if lname == "content-length":
+                clength = int(hvalue)
+                continue
+            elif lname == "vary":
+                vary = True
+            elif lname == "etag":
+                hvalue = self.weaken_etag(hvalue)
+            headers.append((hname, hvalue))
+        if clength is not None and clength < self.threshold:
+            self.start_response(status, response_headers, self.exc_info)
+            return data
+        headers.append(("Content-Encoding", self.encoding))
+        if not vary:
+            headers.append(("Vary", "Accept-Encoding"))
+        encoder = zlib.compressobj(self.level, zlib.DEFLATED,
+                                   self.WBITS[self.encoding])
+        if clength is not None and isinstance(data, list):
+            # a buffered response, compress it in one go; anything else
+            # (e.g., a media stream) is compressed as it is streamed
+            try:
+                data = b''.join(data)
+            finally:
+                self.close(data)
+            data = encoder.compress(data) + encoder.flush()
+            headers.append(("Content-Length", str(len(data))))
+            self.start_response(status, headers, self.exc_info)
+            return [data]
+        else:
+            self.start_response(status, headers, self.exc_info)
+            return self.generate_encoded(data, encoder)
+
+    def generate_encoded(self, data, encoder):
+        try:
+            for chunk in data:
+                chunk = encoder.compress(chunk)
+                if chunk:
+                    yield chunk
+            yield encoder.flush()
+        finally:
+            self.close(data)
+
+    @staticmethod
+    def close(data):
+        if hasattr(data, 'close'):
+            data.close()
+
+
 class Server(app.Server):
 
     """Extends py:class:`pyselt.rfc5023.Server` to provide an OData
@@ -170,6 +345,79 @@ class Server(app.Server):
         self.model = None
         #: the maximum number of entities to return per request
         self.topmax = 100
+        #: the size (in bytes) above which entity collections are
+        #: streamed rather than buffered, None means always buffer
+        self.stream_threshold = 262144
+        #: the approximate size (in bytes) of the chunks yielded when
+        #: a response is being streamed
+        self.stream_chunk = 8192
+        #: a function that returns diagnostic information, see
+        #: :py:meth:`set_diagnostics`
+        self.diagnostics = None
+        #: the path of the diagnostics resource, relative to the
+        #: service root
+        self.diagnostics_path = None
+        #: if True, responses without a concurrency token are given a
+        #: weak ETag derived from the data layer's change token (see
+        #: :py:meth:`~pyslet.odata2.csdl.EntityCollection.change_token`)
+        #: allowing clients to poll entity sets with conditional GETs
+        self.change_etags = False
+        #: the value of the Cache-Control header added to responses
+        #: that carry an ETag, or None to omit the header
+        self.cache_control = "no-cache"
+        #: the ETag of the metadata document, see
+        #: :py:meth:`cache_documents`
+        self.metadata_etag = None
+        #: a dictionary of pre-serialised documents, see
+        #: :py:meth:`cache_documents`
+        self.document_cache = {}
+        #: the size (in bytes) below which responses are not
+        #: compressed, None means never compress responses
+        self.compress_threshold = 1024
+        #: the zlib compression level (1-9) used for responses
+        self.compress_level = 6
+        #: the maximum size (in bytes) of a request body after any
+        #: Content-Encoding has been removed, None means no limit
+        self.max_decoded_size = 16777216
+        #: the maximum number of parsed request URIs to cache, see
+        #: :py:meth:`parse_uri`, 0 disables the cache
+        self.uri_cache_size = 256
+        self.uri_cache = collections.OrderedDict()
+        self.uri_cache_lock = threading.Lock()
+        #: the number of requests that were found in the URI cache
+        self.uri_cache_hits = 0
+        #: the number of requests that had to be parsed
+        self.uri_cache_misses = 0
+        #: a function called with the :py:class:`core.RequestStats` of
+        #: each request, see :py:meth:`set_instrumentation`
+        self.instrumentation = None
+        #: True if responses include a Server-Timing header
+        self.server_timing = False
+        self.cache_documents()
+
+    def set_diagnostics(self, diagnostics, path="$diagnostics"):
+        """Enables an optional diagnostics resource
+
+        diagnostics
+            A function that takes no arguments and returns a dictionary
+            that can be serialised using json, for example, the
+            :py:meth:`~pyslet.odata2.memds.InMemoryEntityContainer.stats`
+            method of an in-memory container.  Pass None to disable the
+            resource.
+
+        path
+            The path of the resource relative to the service root,
+            defaults to $diagnostics.
+
+        A GET request to the resource returns the result of calling
+        *diagnostics* serialised as a JSON object.  The resource may
+        reveal information about the service that you would not want
+        to make public so it is disabled by default."""
+        self.diagnostics = diagnostics
+        if diagnostics is None:
+            self.diagnostics_path = None
+        else:
+            self.diagnostics_path = self.path_prefix + '/' + path
 
     @old_method('SetModel')
     def set_model(self, model):
@@ -207,6 +455,104 @@ class Server(app.Server):
                     # update the locations following SetBase above
                     es.set_location()
         self.model = model
+        self.cache_documents()
+
+    def cache_documents(self):
+        """Pre-serialises the metadata and service documents
+
+        These documents only change when the model changes so they are
+        serialised once, when :py:meth:`set_model` is called, and
+        stored (along with a gzip-compressed copy) in
+        :py:attr:`document_cache`.  Each entry is keyed on the name of
+        the document and maps to a tuple of (data, gzip_data) where
+        gzip_data is None if compression doesn't reduce the size of the
+        data.  The cached documents are:
+
+        metadata
+            The metadata document returned by $metadata (the same data
+            is returned for all content types)
+
+        service
+            The XML service document
+
+        service_json
+            The JSON representation of the service root
+
+        If you modify the model or the service document after calling
+        set_model then you must call this method again to refresh the
+        cache."""
+        cache = {}
+        if self.model is not None:
+            data = str(self.model.get_document()).encode('utf-8')
+            self.metadata_etag = 'W/"%s"' % hashlib.sha1(data).hexdigest()
+            cache['metadata'] = self.compress_document(data)
+        else:
+            self.metadata_etag = None
+        cache['service'] = self.compress_document(
+            to_text(self.serviceDoc).encode('utf-8'))
+        cache['service_json'] = self.compress_document(
+            str('{"d":%s}' % json.dumps(
+                {'EntitySets': [x.href for x in self.ws.Collection]})
+                ).encode('utf-8'))
+        self.document_cache = cache
+
+    @staticmethod
+    def compress_document(data):
+        """Returns a tuple of *data* and its gzip-compressed form
+
+        The compressed form is replaced with None if it is no smaller
+        than *data*."""
+        buff = io.BytesIO()
+        with gzip.GzipFile(fileobj=buff, mode='wb', mtime=0) as f:
+            f.write(data)
+        gzip_data = buff.getvalue()
+        if len(gzip_data) >= len(data):
+            gzip_data = None
+        return data, gzip_data
+
+    def encoding_negotiation(self, environ, encodings):
+        """Returns the best match for the Accept-Encoding header
+
+        encodings
+            A list of content codings (as character strings) in order
+            of preference, it should include "identity".
+
+        If the header is missing or can't be parsed then "identity" is
+        returned.  If none of the *encodings* are acceptable we return
+        None."""
+        if "HTTP_ACCEPT_ENCODING" in environ:
+            try:
+                alist = messages.AcceptEncodingList.from_str(
+                    environ["HTTP_ACCEPT_ENCODING"])
+            except grammar.BadSyntax:
+                return "identity"
+            return alist.select_token(encodings)
+        else:
+            return "identity"
+
+    def return_cached(self, name, response_type, environ, start_response,
+                      response_headers):
+        """Returns a document from :py:attr:`document_cache`
+
+        name
+            The name of the cached document
+
+        response_type
+            The value of the Content-Type header
+
+        The gzip-compressed form of the document is returned if it is
+        available and acceptable to the client."""
+        data, gzip_data = self.document_cache[name]
+        response_headers.append(("Content-Type", str(response_type)))
+        if gzip_data is not None:
+            response_headers.append(("Vary", "Accept-Encoding"))
+            if self.encoding_negotiation(
+                    environ, ["gzip", "identity"]) == "gzip":
+                data = gzip_data
+                response_headers.append(("Content-Encoding", "gzip"))
+        response_headers.append(("Content-Length", str(len(data))))
+        start_response("%i %s" % (200, "Success"), response_headers)
+        return [data]
 
     @classmethod
     def encode_pathinfo(cls, pathinfo):
@@ -274,8 +620,219 @@ class Server(app.Server):
                 result.append(c)
         return ''.join(result)
 
+    def set_instrumentation(self, instrumentation, server_timing=False):
+        """Enables per-request instrumentation
+
+        instrumentation
+            A function that takes a single :py:class:`core.RequestStats`
+            argument or None.  It is called once for each request, after
+            the last byte of the response has been generated.
+
+        server_timing
+            If True, a Server-Timing header containing the statistics
+            gathered before the response started is added to each
+            response.  Streamed responses will not include the time
+            taken to generate the body.
+
+        When instrumentation is enabled a :py:class:`core.RequestStats`
+        instance is bound to the thread handling each request, see
+        :py:func:`core.get_request_stats`.  The server times the phases
+        of the request and the SQL data layer records the time spent
+        executing queries and the number of queries and rows.  The
+        number of bytes in the response body is counted after any
+        compression.  Requests in a batch are included in the
+        statistics for the batch.
+
+        Pass None and False to disable instrumentation (the default)."""
+        self.instrumentation = instrumentation
+        self.server_timing = server_timing
+
     def __call__(self, environ, start_response):
-        """wsgi interface for the server."""
+        """wsgi interface for the server.
+
+        If the client accepts a compressed response (and compression
+        has not been disabled by setting :py:attr:`compress_threshold`
+        to None) the response is compressed using gzip or deflate
+        encoding, see :py:class:`ResponseEncoder`."""
+        if ((self.instrumentation is not None or self.server_timing) and
+                core.get_request_stats() is None):
+            return self.instrumented_call(environ, start_response)
+        encoding = None
+        if (self.compress_threshold is not None and
+                environ["REQUEST_METHOD"].upper() != "HEAD"):
+            encoding = self.encoding_negotiation(
+                environ, ["gzip", "deflate", "identity"])
+        if encoding in ResponseEncoder.WBITS:
+            encoder = ResponseEncoder(start_response, encoding,
+                                      self.compress_threshold,
+                                      self.compress_level)
+            return encoder.call(self.dispatch, environ)
+        else:
+            return self.dispatch(environ, start_response)
+
+    def instrumented_call(self, environ, start_response):
+        """Handles a request with instrumentation enabled
+
+        See :py:meth:`set_instrumentation` for details."""
+        stats = core.RequestStats()
+
+        def start_response_wrapper(status, response_headers, exc_info=None):
+            stats.status = status
+            if self.server_timing:
+                response_headers = response_headers + [
+                    ("Server-Timing", stats.server_timing())]
+            return start_response(status, response_headers, exc_info)
+
+        core.set_request_stats(stats)
+        try:
+            data = self(environ, start_response_wrapper)
+        except Exception:
+            stats.stop()
+            if self.instrumentation is not None:
+                self.instrumentation(stats)
+            raise
+        finally:
+            core.set_request_stats(None)
+        return self.generate_instrumented(data, stats)
+
+    def generate_instrumented(self, data, stats):
+        """Yields the response *data* while counting the bytes
+
+        The stats are bound to the current thread while each chunk of
+        data is being generated as a streamed response may still be
+        reading data.  When the response is complete the stats are
+        passed to :py:attr:`instrumentation`."""
+        try:
+            iterator = iter(data)
+            while True:
+                core.set_request_stats(stats)
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    core.set_request_stats(None)
+                stats.count('bytes', len(chunk))
+                yield chunk
+        finally:
+            if hasattr(data, 'close'):
+                data.close()
+            stats.stop()
+            if self.instrumentation is not None:
+                self.instrumentation(stats)
+
+    def parse_uri(self, path, version):
+        """Returns a :py:class:`core.ODataURI` instance for a request
+
+        path
+            The URL-encoded path and query of the request
+
+        version
+            The protocol version of the request
+
+        Parsing the system query options is relatively expensive and
+        clients often make the same requests repeatedly so the most
+        recently used results are cached (up to a maximum of
+        :py:attr:`uri_cache_size`).  A clone of the cached instance is
+        returned on a cache hit, see :py:meth:`core.ODataURI.clone`.
+        URIs that fail to parse are not cached."""
+        if not self.uri_cache_size:
+            return core.ODataURI(path, self.path_prefix, version)
+        key = (path, version)
+        with self.uri_cache_lock:
+            request = self.uri_cache.pop(key, None)
+            if request is not None:
+                # re-insert to mark it as the most recently used
+                self.uri_cache[key] = request
+                self.uri_cache_hits += 1
+                return request.clone()
+            self.uri_cache_misses += 1
+        request = core.ODataURI(path, self.path_prefix, version)
+        with self.uri_cache_lock:
+            self.uri_cache[key] = request
+            while len(self.uri_cache) > self.uri_cache_size:
+                self.uri_cache.popitem(last=False)
+        return request.clone()
+
+    def uri_cache_stats(self):
+        """Returns a dictionary of statistics about the URI cache
+
+        size
+            The number of cached URIs
+
+        max_size
+            The value of :py:attr:`uri_cache_size`
+
+        hits and misses
+            The number of requests that were (or were not) found in the
+            cache
+
+        hit_rate
+            The proportion of requests found in the cache (0 if there
+            have been no requests)"""
+        with self.uri_cache_lock:
+            nrequests = self.uri_cache_hits + self.uri_cache_misses
+            return {'size': len(self.uri_cache),
+                    'max_size': self.uri_cache_size,
+                    'hits': self.uri_cache_hits,
+                    'misses': self.uri_cache_misses,
+                    'hit_rate': (float(self.uri_cache_hits) / nrequests
+                                 if nrequests else 0)}
+
+    def decode_request(self, environ):
+        """Removes any Content-Encoding from the request body
+
+        Returns *environ* unchanged if the request has no (or identity)
+        Content-Encoding.  A request body with gzip or deflate encoding
+        is decompressed and a copy of *environ* is returned with the
+        decompressed body as its input.  If the encoding is not
+        supported None is returned.  Raises ValueError if the body
+        can't be decompressed and :py:class:`RequestTooLarge` if the
+        decompressed body would exceed :py:attr:`max_decoded_size`.
+
+        The body is decompressed incrementally so that a small body
+        that expands to a very large one is rejected without first
+        being decompressed in full."""
+        encoding = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+        if encoding in ("", "identity"):
+            return environ
+        elif encoding not in ("gzip", "x-gzip", "deflate"):
+            return None
+        input = messages.WSGIInputWrapper(environ)
+        # wbits of 47 detects either a gzip or zlib header
+        decoder = zlib.decompressobj(47)
+        output = io.BytesIO()
+        try:
+            while not decoder.eof:
+                data = input.read(io.DEFAULT_BUFFER_SIZE)
+                if not data:
+                    break
+                while data:
+                    output.write(decoder.decompress(
+                        data, io.DEFAULT_BUFFER_SIZE))
+                    if (self.max_decoded_size is not None and
+                            output.tell() > self.max_decoded_size):
+                        raise RequestTooLarge(
+                            "decoded request body exceeds %i bytes" %
+                            self.max_decoded_size)
+                    data = decoder.unconsumed_tail
+            if not decoder.eof:
+                raise zlib.error("incomplete or truncated stream")
+        except zlib.error as e:
+            raise ValueError("Content-Encoding %s: %s" % (encoding, str(e)))
+        environ = dict(environ)
+        del environ["HTTP_CONTENT_ENCODING"]
+        environ.pop("HTTP_TRANSFER_ENCODING", None)
+        environ["CONTENT_LENGTH"] = str(output.tell())
+        output.seek(0)
+        environ["wsgi.input"] = output
+        return environ
+
+    def dispatch(self, environ, start_response):
+        """Handles a wsgi request
+
+        Called by :py:meth:`__call__` once any response encoding has
+        been negotiated."""
         response_headers = []
         try:
             version = self.check_capability_negotiation(
@@ -285,14 +842,31 @@ class Server(app.Server):
                     core.ODataURI('error'), environ, start_response,
                     "DataServiceVersionMismatch",
                     "Maximum supported protocol version: 2.0")
+            try:
+                decoded_environ = self.decode_request(environ)
+            except RequestTooLarge as e:
+                return self.odata_error(
+                    core.ODataURI('error'), environ, start_response,
+                    "Request Entity Too Large", to_text(e), 413)
+            if decoded_environ is None:
+                return self.odata_error(
+                    core.ODataURI('error'), environ, start_response,
+                    "Unsupported Media Type",
+                    "Content-Encoding not supported: %s" %
+                    environ["HTTP_CONTENT_ENCODING"], 415)
+            environ = decoded_environ
             app_path = environ.get('SCRIPT_NAME', "")
             path = app_path + environ['PATH_INFO']
+            if path == self.diagnostics_path:
+                return self.return_diagnostics(
+                    environ, start_response, response_headers)
             # we have to URL-encode PATH_INFO
             path = self.encode_pathinfo(path)
             query = environ.get('QUERY_STRING', None)
             if query:
                 path = path + '?' + query
-            request = core.ODataURI(path, self.path_prefix, version)
+            with core.request_timer('parse'):
+                request = self.parse_uri(path, version)
             if request.resource_path is None:
                 # this is not a URI for us, pass to our superclass
                 wrapper = WSGIWrapper(
@@ -364,6 +938,20 @@ class Server(app.Server):
                 core.ODataURI('error'), environ, start_response,
                 "UnexpectedError", "%s: %s" % (einfo[0], einfo[1]), 500)
 
+    def return_diagnostics(self, environ, start_response, response_headers):
+        """Returns the diagnostics resource as a JSON object"""
+        method = environ['REQUEST_METHOD'].upper()
+        if method != "GET":
+            raise core.InvalidMethod("%s not supported for diagnostics" %
+                                     method)
+        data = json.dumps(self.diagnostics(), sort_keys=True,
+                          default=to_text).encode('utf-8')
+        response_headers.append(("Content-Type", "application/json"))
+        response_headers.append(("Content-Length", str(len(data))))
+        response_headers.append(("Cache-Control", "no-cache"))
+        start_response("%i %s" % (200, "Success"), response_headers)
+        return [data]
+
     def odata_error(self, request, environ, start_response, sub_code,
                     message='', code=400):
         """Generates and OData error, typically as the result of a bad
@@ -539,6 +1127,94 @@ class Server(app.Server):
             etag = entity.format_etag(etag, entity.etag_is_strong())
             response_headers.append(("ETag", etag))
 
+    def collection_etag(self, collection, request, response_type):
+        """Returns a weak ETag for a response generated from *collection*
+
+        Returns None unless :py:attr:`change_etags` is True and the
+        collection returns a change token.  The ETag is derived from
+        the change token, the *response_type* and the version of the
+        request so that each representation has its own validator."""
+        if not self.change_etags:
+            return None
+        token = collection.change_token()
+        if token is None:
+            return None
+        h = hashlib.sha1(("%s;%s;%i" % (
+            token, str(response_type), request.version)).encode('utf-8'))
+        return 'W/"%s"' % h.hexdigest()
+
+    def entity_etag(self, entity, request, response_type):
+        """Returns an ETag for a response generated from *entity*
+
+        The ETag is calculated from the entity's concurrency tokens,
+        if it has none then we fall back to :py:meth:`collection_etag`
+        for the entity set.  The concurrency tokens do not change when
+        an expanded entity changes so requests with $expand always use
+        :py:meth:`collection_etag`.  Returns None if there is no
+        suitable validator."""
+        if core.SystemQueryOption.expand in request.sys_query_options:
+            etag = None
+        else:
+            etag = entity.etag()
+        if etag is not None:
+            return entity.format_etag(etag, entity.etag_is_strong())
+        elif self.change_etags:
+            with entity.entity_set.open() as collection:
+                return self.collection_etag(collection, request,
+                                            response_type)
+        else:
+            return None
+
+    def if_none_match(self, environ, etag):
+        """Returns True if the If-None-Match header matches *etag*
+
+        etag
+            A formatted entity-tag as a character string.
+
+        The weak comparison function is used as required for
+        conditional GET.  A malformed header is ignored."""
+        value = environ.get("HTTP_IF_NONE_MATCH", None)
+        if value is None:
+            return False
+        if value.strip() == "*":
+            return True
+        try:
+            tag = params.EntityTag.from_str(etag).tag
+            p = params.ParameterParser(value)
+            while True:
+                if p.require_entity_tag().tag == tag:
+                    return True
+                if not p.parse_separator(grammar.COMMA):
+                    break
+        except grammar.BadSyntax:
+            pass
+        return False
+
+    def check_etag(self, etag, environ, start_response, response_headers):
+        """Handles a conditional GET for a response with *etag*
+
+        etag
+            A formatted entity-tag as a character string or None if the
+            response has no validator, in which case no action is
+            taken.
+
+        Otherwise, the ETag (and any :py:attr:`cache_control`) headers
+        are added to *response_headers* and, if the request is a GET
+        or HEAD with a matching If-None-Match header, a 304 response
+        is started and an empty list is returned.  In all other cases
+        we return None and the caller generates the response as
+        usual."""
+        if etag is None:
+            return None
+        response_headers.append(("ETag", etag))
+        if self.cache_control is not None:
+            response_headers.append(("Cache-Control", self.cache_control))
+        if environ["REQUEST_METHOD"].upper() in ("GET", "HEAD") and \
+                self.if_none_match(environ, etag):
+            start_response("%i %s" % (304, "Not Modified"), response_headers)
+            return []
+        return None
+
     @old_method('HandleRequest')
     def handle_request(self, request, environ, start_response,
                        response_headers):
@@ -549,14 +1225,14 @@ class Server(app.Server):
             resource_path."""
         method = environ["REQUEST_METHOD"].upper()
         try:
-            resource, parent_entity = self.get_resource(request)
+            with core.request_timer('resource'):
+                resource, parent_entity = self.get_resource(request)
             if request.path_option == core.PathOption.metadata:
                 return self.return_metadata(
                     request, environ, start_response, response_headers)
             elif request.path_option == core.PathOption.batch:
-                return self.odata_error(
-                    request, environ, start_response, "Bad Request",
-                    "Batch requests not supported", 404)
+                return self.return_batch(
+                    request, environ, start_response, response_headers)
             elif request.path_option == core.PathOption.count:
                 if isinstance(resource, edm.Entity):
                     return self.return_count(
@@ -866,12 +1542,9 @@ class Server(app.Server):
                 else:
                     # override the default handling of service root to improve
                     # content negotiation
-                    data = to_text(self.serviceDoc).encode('utf-8')
-                    response_headers.append(
-                        ("Content-Type", str(response_type)))
-                    response_headers.append(("Content-Length", str(len(data))))
-                    start_response("200 Ok", response_headers)
-                    return [data]
+                    return self.return_cached(
+                        "service", response_type, environ, start_response,
+                        response_headers)
         except core.MissingURISegment as e:
             return self.odata_error(
                 request, environ, start_response, "Resource not found",
@@ -893,6 +1566,277 @@ class Server(app.Server):
                 request, environ, start_response, "NotImplementedError",
                 str(e), 405)
 
+    def return_batch(self, request, environ, start_response,
+                     response_headers):
+        """Processes a batch request
+
+        The request body must be a multipart/mixed entity, each part is
+        either a single query operation (a GET request) or a changeset.
+        A changeset is itself a multipart/mixed entity containing a
+        sequence of change requests (typically POST, PUT, MERGE or
+        DELETE).
+
+        The requests are executed in order by calling this server
+        recursively and the responses are returned as the parts of a
+        multipart/mixed response entity.  The changesets are executed
+        with :py:meth:`run_changeset`."""
+        method = environ["REQUEST_METHOD"].upper()
+        if method != "POST":
+            raise core.InvalidMethod("%s not supported for $batch" % method)
+        try:
+            batch = self.read_batch(environ)
+        except (messages.HTTPException, ValueError) as e:
+            return self.odata_error(
+                request, environ, start_response, "Bad Request",
+                "Malformed batch request: %s" % to_text(e), 400)
+        parts = []
+        for item in batch:
+            if isinstance(item, list):
+                parts.append(self.run_changeset(item, environ))
+            else:
+                part, message, body = item
+                if message.method.upper() != "GET":
+                    response = self.batch_error(
+                        environ, "Bad Request",
+                        "%s not allowed outside of a changeset" %
+                        message.method, 400)
+                else:
+                    response = self.call_batch_request(
+                        environ, message, body)
+                parts.append(self.batch_response_part(*response))
+        mtype, data = self.batch_multipart(parts, b"batchresponse_")
+        response_headers.append(("Content-Type", str(mtype)))
+        response_headers.append(("Content-Length", str(len(data))))
+        start_response("%i %s" % (202, "Accepted"), response_headers)
+        return [data]
+
+    def read_batch(self, environ):
+        """Reads the body of a batch request
+
+        Returns a list of items.  Each item is either a triple of::
+
+            (:py:class:`pyslet.http.multipart.MessagePart`,
+             :py:class:`pyslet.http.messages.Request`,
+             body as a binary string)
+
+        representing a single request or a list of such triples
+        representing a changeset.  The whole request body is read
+        before any of the requests are executed.
+
+        Malformed request bodies raise an HTTPException or ValueError."""
+        if "CONTENT_TYPE" not in environ:
+            raise multipart.MultipartError(
+                "$batch requires a multipart request body")
+        mtype = params.MediaType.from_str(environ["CONTENT_TYPE"])
+        input = messages.WSGIInputWrapper(environ)
+        return self.read_batch_parts(
+            multipart.MultipartRecvWrapper(input, mtype), True)
+
+    def read_batch_parts(self, mstream, allow_changesets):
+        result = []
+        for part in mstream.read_parts():
+            ptype = part.message.get_content_type()
+            if ptype.type == "multipart":
+                if not allow_changesets:
+                    raise multipart.MultipartError("nested changeset")
+                result.append(self.read_batch_parts(
+                    multipart.MultipartRecvWrapper(part, ptype), False))
+            elif ptype.type == "application" and ptype.subtype == "http":
+                rstream = messages.RecvWrapper(part, messages.Request)
+                message = rstream.read_message_header()
+                body = rstream.read()
+                result.append((part.message, message, body))
+            else:
+                raise multipart.MultipartError(
+                    "expected application/http in batch, found %s" %
+                    str(ptype))
+        return result
+
+    def run_changeset(self, changeset, environ):
+        """Runs a changeset from a batch request
+
+        changeset
+            A list of triples as returned by :py:meth:`read_batch`
+
+        Returns a :py:class:`pyslet.http.multipart.MessagePart`
+        containing either a multipart/mixed entity with the responses to
+        the change requests or, if any of the requests fail, a single
+        response describing the failure.
+
+        The requests are executed within the changesets of any data
+        containers returned by :py:meth:`get_changeset_containers`.  If
+        a request fails the changesets are rolled back, ensuring that
+        the changeset is executed atomically.  Data containers that do
+        not support changesets are left in the state they were in
+        following the failed request."""
+        try:
+            parts = self.run_changeset_requests(
+                changeset, environ, self.get_changeset_containers())
+        except ChangesetFailed as e:
+            return self.batch_response_part(*e.response)
+        except Exception as e:
+            logging.error(
+                "UnexpectedError in OData changeset: %s",
+                "".join(traceback.format_exception(*sys.exc_info())))
+            return self.batch_response_part(*self.batch_error(
+                environ, "UnexpectedError", "%s: %s" % (type(e), str(e)),
+                500))
+        mtype, data = self.batch_multipart(parts, b"changesetresponse_")
+        part = multipart.MessagePart(entity_body=data)
+        part.set_content_type(mtype)
+        return part
+
+    def run_changeset_requests(self, changeset, environ, containers):
+        if containers:
+            with containers[0].changeset():
+                return self.run_changeset_requests(changeset, environ,
+                                                   containers[1:])
+        content_ids = {}
+        parts = []
+        for part, message, body in changeset:
+            content_id = part.get_header('Content-ID')
+            if content_id is None:
+                content_id = message.get_header('Content-ID')
+            if content_id is not None:
+                content_id = content_id.decode('iso-8859-1').strip("<> ")
+            if message.method.upper() == "GET":
+                response = self.batch_error(
+                    environ, "Bad Request", "GET not allowed in changeset",
+                    400)
+            else:
+                response = self.call_batch_request(
+                    environ, message, body, content_ids)
+            status, headers, data = response
+            if int(status.split()[0]) >= 400:
+                raise ChangesetFailed(response)
+            response_part = self.batch_response_part(*response)
+            if content_id:
+                response_part.set_header('Content-ID', content_id)
+                for hname, hvalue in headers:
+                    if hname.lower() == "location":
+                        content_ids[content_id] = hvalue
+            parts.append(response_part)
+        return parts
+
+    def get_changeset_containers(self):
+        """Returns a list of data containers that support changesets
+
+        The data containers are discovered by looking at the bindings of
+        all the entity sets in the model.  Entity sets bound with a
+        *container* keyword argument that refers to an object with a
+        changeset method are assumed to be backed by a transactional
+        data container.  The changeset method must return a context
+        manager that makes the operations executed by the current
+        thread atomic, see
+        :py:meth:`pyslet.odata2.sqlds.SQLEntityContainer.changeset` for
+        an example."""
+        result = []
+        if self.model is None:
+            return result
+        for s in self.model.DataServices.Schema:
+            for container in s.EntityContainer:
+                for es in container.EntitySet:
+                    binding, kws = es.binding
+                    dc = kws.get('container', None)
+                    if dc is None or not hasattr(dc, 'changeset'):
+                        continue
+                    if not any(dc is c for c in result):
+                        result.append(dc)
+        return result
+
+    def call_batch_request(self, environ, message, body, content_ids=None):
+        """Executes a single request from a batch
+
+        environ
+            The environment of the batch request itself.
+
+        message
+            A :py:class:`pyslet.http.messages.Request` instance.
+
+        body
+            The binary string containing the request body.
+
+        content_ids
+            An optional dictionary mapping Content-ID values onto
+            resource locations.  Request URIs that start with $<id> are
+            interpreted relative to these locations.
+
+        Returns a triple of status line, response headers and response
+        body."""
+        request_uri = message.request_uri
+        if content_ids and request_uri.startswith('$'):
+            ref = request_uri[1:].split('/', 1)
+            if ref[0] in content_ids:
+                ref[0] = content_ids[ref[0]]
+                request_uri = '/'.join(ref)
+        href = uri.URI.from_octets(request_uri)
+        if not href.is_absolute():
+            href = href.resolve(self.service_root)
+        sub_environ = {}
+        for key, value in dict_items(environ):
+            if key.startswith('HTTP_') or key.startswith('CONTENT_'):
+                continue
+            sub_environ[key] = value
+        sub_environ['REQUEST_METHOD'] = message.method.upper()
+        sub_environ['SCRIPT_NAME'] = ''
+        sub_environ['PATH_INFO'] = uri.unescape_data(
+            href.abs_path).decode('utf-8')
+        sub_environ['QUERY_STRING'] = href.query
+        for hname in message.get_headerlist():
+            hvalue = message.get_header(hname).decode('iso-8859-1')
+            hname = hname.decode('iso-8859-1').upper().replace('-', '_')
+            if hname in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                sub_environ[hname] = hvalue
+            else:
+                sub_environ['HTTP_' + hname] = hvalue
+        sub_environ['CONTENT_LENGTH'] = str(len(body))
+        sub_environ['wsgi.input'] = io.BytesIO(body)
+        response = []
+
+        def start_response(status, response_headers, exc_info=None):
+            response[:] = [status, response_headers]
+        data = b''.join(self(sub_environ, start_response))
+        return response[0], response[1], data
+
+    def batch_error(self, environ, sub_code, message, code):
+        """Returns an error response suitable for inclusion in a batch
+
+        The result is a triple as per :py:meth:`call_batch_request`."""
+        response = []
+
+        def start_response(status, response_headers, exc_info=None):
+            response[:] = [status, response_headers]
+        data = b''.join(self.odata_error(
+            core.ODataURI('error'), environ, start_response, sub_code,
+            message, code))
+        return response[0], response[1], data
+
+    def batch_response_part(self, status, response_headers, data):
+        """Returns a message part containing an HTTP response
+
+        The part has type application/http and contains a serialised
+        HTTP response with the given status line, headers and data."""
+        lines = ["HTTP/1.1 %s" % status]
+        for hname, hvalue in response_headers:
+            lines.append("%s: %s" % (hname, hvalue))
+        lines.append('')
+        lines.append('')
+        part = multipart.MessagePart(
+            entity_body='\r\n'.join(lines).encode('iso-8859-1') + data)
+        part.set_content_type("application/http")
+        part.set_content_transfer_encoding("binary")
+        return part
+
+    def batch_multipart(self, parts, prefix):
+        """Returns a multipart/mixed entity containing parts
+
+        Returns a tuple of the media type and the binary data."""
+        boundary = multipart.make_boundary_delimiter(prefix)
+        mtype = params.MediaType(
+            "multipart", "mixed", {"boundary": ("boundary", boundary)})
+        data = multipart.MultipartSendWrapper(mtype, parts).read()
+        return mtype, data
+
     def expand_resource(self, resource, sys_query_options):
         try:
             expand = sys_query_options.get(core.SystemQueryOption.expand, None)
@@ -912,28 +1856,23 @@ class Server(app.Server):
 
     def return_json_root(self, request, environ, start_response,
                          response_headers):
-        data = str('{"d":%s}' % json.dumps(
-            {'EntitySets': [x.href for x in self.ws.Collection]}))
-        data = data.encode('utf-8')
-        response_headers.append(("Content-Type", "application/json"))
-        response_headers.append(("Content-Length", str(len(data))))
-        start_response("%i %s" % (200, "Success"), response_headers)
-        return [data]
+        return self.return_cached("service_json", "application/json",
+                                  environ, start_response, response_headers)
 
     def return_metadata(self, request, environ, start_response,
                         response_headers):
-        doc = self.model.get_document()
         response_type = self.content_negotiation(
             request, environ, self.MetadataTypes)
         if response_type is None:
             return self.odata_error(
                 request, environ, start_response, "Not Acceptable",
                 'xml or plain text formats supported', 406)
-        data = str(doc).encode('utf-8')
-        response_headers.append(("Content-Type", str(response_type)))
-        response_headers.append(("Content-Length", str(len(data))))
-        start_response("%i %s" % (200, "Success"), response_headers)
-        return [data]
+        result = self.check_etag(self.metadata_etag, environ, start_response,
+                                 response_headers)
+        if result is not None:
+            return result
+        return self.return_cached("metadata", response_type, environ,
+                                  start_response, response_headers)
 
     def return_links(self, entities, request, environ, start_response,
                      response_headers):
@@ -1008,23 +1947,96 @@ class Server(app.Server):
             return self.odata_error(
                 request, environ, start_response, "Not Acceptable",
                 'xml, json or plain text formats supported', 406)
+        result = self.check_etag(
+            self.collection_etag(entities, request, response_type),
+            environ, start_response, response_headers)
+        if result is not None:
+            return result
         entities.set_topmax(self.topmax)
         if response_type == "application/json":
-            data = str('{"d":%s}' % ''.join(
-                entities.generate_entity_set_in_json(request.version)))
+            data = self.generate_json_feed(entities, request.version)
         else:
-            # Here's a challenge, we want to pull data through the feed
-            # by yielding strings just load in to memory at the moment
+            # we pull data through the feed by yielding strings, the
+            # entities are only read from the collection as they are
+            # serialised
             f = core.Feed(None, entities)
             doc = core.Document(root=f)
             f.collection = entities
             f.set_base(str(self.service_root))
-            data = str(doc)
-        data = data.encode('utf-8')
+            data = doc.generate_xml(xml.escape_char_data)
         response_headers.append(("Content-Type", str(response_type)))
-        response_headers.append(("Content-Length", str(len(data))))
-        start_response("%i %s" % (200, "Success"), response_headers)
-        return [data]
+        return self.buffer_or_stream(data, start_response, response_headers)
+
+    def generate_json_feed(self, entities, version):
+        """Generates the security-wrapped JSON form of *entities*"""
+        yield '{"d":'
+        for s in entities.generate_entity_set_in_json(version):
+            yield s
+        yield '}'
+
+    def buffer_or_stream(self, data, start_response, response_headers):
+        """Returns a WSGI iterable for a generated response
+
+        data
+            An iterable of character strings that make up the response
+            body, they are encoded with UTF-8.
+
+        The data is buffered until either it is exhausted, in which case
+        the response is sent with a Content-Length in the usual way, or
+        the buffered data exceeds :py:attr:`stream_threshold` bytes.  In
+        the latter case the response is started without a
+        Content-Length, allowing the WSGI server to use chunked transfer
+        encoding, and the remaining data is yielded in chunks of
+        approximately :py:attr:`stream_chunk` bytes as it is generated.
+
+        Note that once streaming has started it is too late to change
+        the response status, errors raised during generation abort the
+        response instead."""
+        stats = core.get_request_stats()
+        if stats is not None:
+            data = stats.time_iterator(data, 'serialise')
+        data = iter(data)
+        buff = []
+        blen = 0
+        streaming = False
+        for s in data:
+            s = s.encode('utf-8')
+            buff.append(s)
+            blen += len(s)
+            if self.stream_threshold is not None and \
+                    blen > self.stream_threshold:
+                streaming = True
+                break
+        if streaming:
+            start_response("%i %s" % (200, "Success"), response_headers)
+            return self.generate_chunks(buff, data)
+        else:
+            data = b''.join(buff)
+            response_headers.append(("Content-Length", str(len(data))))
+            start_response("%i %s" % (200, "Success"), response_headers)
+            return [data]
+
+    def generate_chunks(self, buff, data):
+        """Yields the encoded data from :py:meth:`buffer_or_stream`
+
+        buff
+            A list of the data already encoded
+
+        data
+            An iterator yielding the remaining character strings"""
+        yield b''.join(buff)
+        buff = []
+        blen = 0
+        for s in data:
+            s = s.encode('utf-8')
+            buff.append(s)
+            blen += len(s)
+            if blen >= self.stream_chunk:
+                yield b''.join(buff)
+                buff = []
+                blen = 0
+        if buff:
+            yield b''.join(buff)
 
     def read_xml_or_json(self, environ):
         """Reads either an XML document or a JSON object from environ."""
@@ -1108,6 +2120,11 @@ class Server(app.Server):
             return self.odata_error(
                 request, environ, start_response, "Not Acceptable",
                 'xml, json or plain text formats supported', 406)
+        result = self.check_etag(
+            self.entity_etag(entity, request, response_type), environ,
+            start_response, response_headers)
+        if result is not None:
+            return result
         # Here's a challenge, we want to pull data through the feed by
         # yielding strings just load in to memory at the moment
         if response_type == "application/json":
@@ -1122,13 +2139,17 @@ class Server(app.Server):
         data = data.encode('utf-8')
         response_headers.append(("Content-Type", str(response_type)))
         response_headers.append(("Content-Length", str(len(data))))
-        self.set_etag(entity, response_headers)
         start_response("%i %s" % (status, status_msg), response_headers)
         return [data]
 
     def return_stream(self, entity, request, environ, start_response,
                       response_headers, method):
         """Returns a media stream."""
+        result = self.check_etag(
+            self.entity_etag(entity, request, None), environ,
+            start_response, response_headers)
+        if result is not None:
+            return result
         coll = entity.entity_set.open()
         try:
             if method == "GET":
@@ -1155,7 +2176,6 @@ class Server(app.Server):
         if sinfo.md5 is not None:
             response_headers.append(
                 ("Content-MD5", force_ascii(base64.b64encode(sinfo.md5))))
-        self.set_etag(entity, response_headers)
         start_response("%i %s" % (200, "Success"), response_headers)
         return sgen
 
@@ -1183,6 +2203,12 @@ class Server(app.Server):
             return self.odata_error(
                 request, environ, start_response, "Not Acceptable",
                 'xml, json or plain text formats supported', 406)
+        if entity is not None:
+            result = self.check_etag(
+                self.entity_etag(entity, request, response_type), environ,
+                start_response, response_headers)
+            if result is not None:
+                return result
         if response_type == "application/json":
             if isinstance(value, edm.Complex):
                 if request.version == 2:
@@ -1208,8 +2234,6 @@ class Server(app.Server):
         data = data.encode('utf-8')
         response_headers.append(("Content-Type", str(response_type)))
         response_headers.append(("Content-Length", str(len(data))))
-        if entity is not None:
-            self.set_etag(entity, response_headers)
         start_response("%i %s" % (200, "Success"), response_headers)
         return [data]
 
@@ -1276,10 +2300,14 @@ class Server(app.Server):
             return self.odata_error(
                 request, environ, start_response, "Not Acceptable",
                 '$value requires plain text or octet-stream formats', 406)
+        if entity is not None:
+            result = self.check_etag(
+                self.entity_etag(entity, request, response_type), environ,
+                start_response, response_headers)
+            if result is not None:
+                return result
         response_headers.append(("Content-Type", str(response_type)))
         response_headers.append(("Content-Length", str(len(data))))
-        if entity is not None:
-            self.set_etag(entity, response_headers)
         start_response("%i %s" % (200, "Success"), response_headers)
         return [data]
 
@@ -3,6 +3,7 @@
 
 
 import binascii
+import collections
 import decimal
 import hashlib
 import io
@@ -17,6 +18,11 @@ import time
 import traceback
 import warnings
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 from .. import blockstore
 from .. import iso8601 as iso
 from ..http import params
@@ -40,6 +46,24 @@ logging = logging.getLogger('pyslet.odata2.sqlds')
 # : the standard timeout while waiting for a database connection, in seconds
 SQL_TIMEOUT = 90
 
+#: namespace for SQL-specific annotations in the metadata model
+SQL_NAMESPACE = "http://www.pyslet.org/ns/odata2/sqlds"
+
+INDEX = (SQL_NAMESPACE, "Index")
+"""The attribute used to declare indexes in the metadata model
+
+When used on a Property with the value "true" an index is created on
+the property.  When used on an EntityType the value is a list of one or
+more index declarations separated by semicolons, each index being a list
+of property paths separated by commas.  The paths may be followed by
+"asc" or "desc" to set the direction of the column in the index, for
+example::
+
+    <EntityType Name="Employee" sql:Index="Name; Address/City desc"
+        xmlns:sql="http://www.pyslet.org/ns/odata2/sqlds">
+
+See :py:meth:`SQLEntityCollection.create_index_queries` for details."""
+
 
 class SQLError(Exception):
 
@@ -216,11 +240,90 @@ class PyFormatParams(SQLParams):
         return literal.replace("%", "%%")
 
 
+class SQLBindingPlan(SQLParams):
+
+    """A class for recording how parameters are bound to a query
+
+    container
+        The :py:class:`SQLEntityContainer` that the query is being
+        generated for.
+
+    values
+        A list of :py:class:`~pyslet.odata2.csdl.SimpleValue` instances
+        that are expected to be passed as parameters to the query.
+
+    A binding plan is used in place of the container's usual
+    :py:attr:`SQLEntityContainer.ParamsClass` instance while a query is
+    being generated.  It behaves like an ordinary parameter list but, in
+    addition, it records the position in *values* of each parameter
+    added with :py:meth:`add_value`.  The query can then be cached and
+    re-executed with a new list of values (of the same shape) without
+    having to generate the query again, see :py:meth:`bind`.
+
+    Parameters added directly with :py:meth:`add_param`, or values that
+    were not in the original *values* list, cannot be rebound and
+    result in a plan that is not :py:attr:`cacheable`."""
+
+    def __init__(self, container, values):
+        super(SQLBindingPlan, self).__init__()
+        self.container = container
+        self._params = container.ParamsClass()
+        self.params = self._params.params
+        self._slots = {}
+        for i, v in enumerate(values):
+            self._slots.setdefault(id(v), i)
+        #: the list of indices into values, one per query parameter
+        self.plan = []
+        #: True if all parameters can be rebound by :py:meth:`bind`
+        self.cacheable = True
+
+    def add_param(self, value):
+        self.cacheable = False
+        return self._params.add_param(value)
+
+    def add_value(self, value):
+        """Adds a value to this set of parameters
+
+        value
+            A :py:class:`~pyslet.odata2.csdl.SimpleValue` instance.
+
+        The value is converted to a parameter using
+        :py:meth:`SQLEntityContainer.prepare_sql_value` and its position
+        in the original list of values is recorded."""
+        i = self._slots.get(id(value), None)
+        if i is None:
+            self.cacheable = False
+        else:
+            self.plan.append(i)
+        return self._params.add_param(
+            self.container.prepare_sql_value(value))
+
+    def bind(self, values):
+        """Returns a new parameter list for the query
+
+        values
+            A list of :py:class:`~pyslet.odata2.csdl.SimpleValue`
+            instances that corresponds (in length and in type) to the
+            list passed on construction.
+
+        The result is an instance of the container's
+        :py:attr:`SQLEntityContainer.ParamsClass`."""
+        params = self.container.ParamsClass()
+        for i in self.plan:
+            params.add_param(self.container.prepare_sql_value(values[i]))
+        return params
+
+
 def retry_decorator(tmethod):
-    """Decorates a transaction method with retry handling"""
+    """Decorates a transaction method with retry handling
+
+    Methods are only retried if the transaction has not yet executed
+    any queries.  Transactions that are part of a changeset are never
+    retried as reopening the connection would discard the uncommitted
+    changes already made by the changeset."""
 
     def retry(self, *args, **kwargs):
-        if self.query_count:
+        if self.query_count or self.connection.transaction is not None:
             return tmethod(self, *args, **kwargs)
         else:
             strike = 0
@@ -310,23 +413,77 @@ class SQLTransaction(object):
         params
                 A :py:class:`SQLParams` object containing any
                 parameterized values."""
-        self.cursor.execute(sqlcmd,
-                            params.params if params is not None else None)
+        stats = core.get_request_stats()
+        if stats is None:
+            self.cursor.execute(sqlcmd,
+                                params.params if params is not None else None)
+        else:
+            with stats.timer('sql'):
+                self.cursor.execute(
+                    sqlcmd, params.params if params is not None else None)
+            stats.count('queries')
+        self.query_count += 1
+        if not sqlcmd.startswith("SELECT"):
+            self.modified()
+
+    @retry_decorator
+    def executemany(self, sqlcmd, params_list):
+        """Executes *sqlcmd* repeatedly as part of this transaction.
+
+        sqlcmd
+                A string containing the query
+
+        params_list
+                A list of :py:class:`SQLParams` objects, *sqlcmd* is
+                executed once for each set of parameterized values."""
+        stats = core.get_request_stats()
+        if stats is None:
+            self.cursor.executemany(sqlcmd, [p.params for p in params_list])
+        else:
+            with stats.timer('sql'):
+                self.cursor.executemany(
+                    sqlcmd, [p.params for p in params_list])
+            stats.count('queries', len(params_list))
         self.query_count += 1
+        self.modified()
+
+    def modified(self):
+        """Records that this transaction has modified data
+
+        Any counts cached by the container are invalidated immediately
+        and again when the transaction is committed, see
+        :py:meth:`SQLEntityContainer.invalidate_counts`."""
+        self.connection.modified = True
+        self.container.invalidate_counts()
 
     def commit(self):
         """Ends this transaction with a commit
 
-        Nested transactions do nothing."""
-        if self.no_commit:
+        Nested transactions do nothing, neither do transactions that are
+        enclosed by a :py:class:`SQLChangeset` as the commit is delayed
+        until the changeset itself is committed."""
+        if self.no_commit or self.enclosed():
             return
         self.connection.dbc.commit()
+        if self.connection.modified:
+            self.connection.modified = False
+            self.container.invalidate_counts()
+
+    def enclosed(self):
+        """Returns True if this transaction is part of a changeset
+
+        The connection's enclosing transaction is set by
+        :py:class:`SQLChangeset`."""
+        return (self.connection.transaction is not None and
+                self.connection.transaction is not self)
 
     def rollback(self, err=None, swallow=False):
         """Calls the underlying database connection rollback method.
 
         Nested transactions do not rollback the connection, they do
-        nothing except re-raise *err* (if required).
+        nothing except re-raise *err* (if required).  The same applies to
+        transactions enclosed by a :py:class:`SQLChangeset`, in which
+        case the rollback is left to the changeset itself.
 
         If rollback is not supported the resulting error is absorbed.
 
@@ -342,9 +499,10 @@ class SQLTransaction(object):
         swallow
             A flag (defaults to False) indicating that *err* should be
             swallowed, rather than re-raised."""
-        if not self.no_commit:
+        if not self.no_commit and not self.enclosed():
             try:
                 self.connection.dbc.rollback()
+                self.connection.modified = False
                 if err is not None:
                     logging.info(
                         "rollback invoked for transaction following error %s",
@@ -409,6 +567,14 @@ class SQLCollectionBase(core.EntityCollection):
     values defined in the metadata model are ignored by the
     collection object."""
 
+    EXPAND_BATCH_SIZE = 100
+    """The maximum number of entities expanded with a single query
+
+    When expanding navigation properties the entities are processed in
+    batches and each navigation property is loaded with a single query
+    per batch.  The size of the batch is limited by this value to keep
+    the number of query parameters manageable."""
+
     def __init__(self, container, **kwargs):
         super(SQLCollectionBase, self).__init__(**kwargs)
         #: the parent container (database) for this collection
@@ -426,6 +592,8 @@ class SQLCollectionBase(core.EntityCollection):
         #: a connection to the database acquired with
         #: :meth:`SQLEntityContainer.acquire_connection`
         self.connection = None
+        # True if the connection has been temporarily released
+        self._released = False
         self._sqlLen = None
         self._sqlGen = None
         try:
@@ -439,21 +607,156 @@ class SQLCollectionBase(core.EntityCollection):
 
     def close(self):
         """Closes the cursor and database connection if they are open."""
+        self._released = False
         if self.connection is not None:
             self.container.release_connection(self.connection)
             self.connection = None
 
+    def release_connection(self):
+        """Temporarily releases the collection's database connection
+
+        The connection is returned to the container's pool where it
+        can be recycled by other threads if required.  You must call
+        :py:meth:`reacquire_connection` before using the collection
+        again."""
+        if self.connection is not None:
+            self.container.release_connection(self.connection)
+            self.connection = None
+            self._released = True
+
+    def reacquire_connection(self):
+        """Reacquires a connection released by :py:meth:`release_connection`
+
+        If the connection was not released (or the collection has been
+        closed in the meantime) this method does nothing."""
+        if self._released:
+            self.connection = self.container.acquire_connection(SQL_TIMEOUT)
+            if self.connection is None:
+                raise DatabaseBusy(
+                    "Failed to acquire connection after %is" % SQL_TIMEOUT)
+            self._released = False
+
+    def query_shape(self):
+        """Returns the shape of the queries generated by this collection
+
+        The result is a tuple of (shape, values).  The shape is a
+        hashable object that captures everything about the collection's
+        current state (its type, select, filter and ordering rules and
+        the shape of any skiptoken) that affects the text of the SQL
+        queries it generates.  The values are a list of
+        :py:class:`~pyslet.odata2.csdl.SimpleValue` instances that will
+        be passed as parameters to those queries.
+
+        Collections with the same shape generate the same SQL, only
+        the values bound to the parameters differ.  Derived classes
+        that add state to their queries must extend the shape (and
+        values) accordingly."""
+        values = []
+        if self.orderby is None:
+            orderby = None
+        else:
+            orderby = tuple((self.expression_shape(expression, values), d)
+                            for expression, d in self.orderby)
+        if self.skiptoken is None:
+            skiptoken = None
+        else:
+            skiptoken = tuple(v.type_code for v in self.skiptoken)
+            values += self.skiptoken
+        shape = (self.__class__, self.entity_set.name,
+                 self.select_shape(self.select),
+                 self.expression_shape(self.filter, values), orderby,
+                 skiptoken)
+        return shape, values
+
+    @classmethod
+    def select_shape(cls, select):
+        """Returns a hashable version of a select rule
+
+        select
+            A dictionary of select rules (or None), see
+            :py:meth:`~pyslet.odata2.csdl.EntityCollection.set_expand`"""
+        if select is None:
+            return None
+        return tuple(sorted((k, cls.select_shape(v))
+                            for k, v in dict_items(select)))
+
+    @classmethod
+    def expression_shape(cls, expression, values):
+        """Returns a hashable version of an expression
+
+        expression
+            A :py:class:`~pyslet.odata2.core.CommonExpression` (or None)
+
+        values
+            A list to which the value of each parameterized literal
+            expression is appended.
+
+        The result is a nested tuple that matches any other expression
+        of the same structure, irrespective of the values of its
+        (parameterized) literals."""
+        if expression is None:
+            return None
+        elif isinstance(expression, UnparameterizedLiteral):
+            return (UnparameterizedLiteral, to_text(expression.value))
+        elif isinstance(expression, core.LiteralExpression):
+            values.append(expression.value)
+            return (core.LiteralExpression, expression.value.type_code,
+                    expression.value.is_null())
+        elif isinstance(expression, core.PropertyExpression):
+            return (core.PropertyExpression, expression.name)
+        else:
+            return (expression.__class__, expression.operator,
+                    getattr(expression, 'method', None),
+                    tuple(cls.expression_shape(x, values)
+                          for x in expression.operands))
+
+    def cached_query(self, key, generator):
+        """Returns a query from the container's cache
+
+        key
+            A hashable object that identifies the type of query being
+            generated (e.g., a count or a page of results).  The key is
+            combined with the result of :py:meth:`query_shape`.
+
+        generator
+            A function that generates the query, it is called with a
+            single :py:class:`SQLParams` instance as an argument and
+            must return the query string.
+
+        Returns a tuple of (query, params).  If a query with the same
+        shape has been generated before the query string is taken from
+        the container's cache (see
+        :py:meth:`SQLEntityContainer.cached_sql`) and only the
+        parameter values are bound, otherwise the query is generated by
+        calling *generator* and the result is added to the cache."""
+        shape, values = self.query_shape()
+        key = (key, shape)
+        cached = self.container.cached_sql(key)
+        if cached is not None:
+            query, plan = cached
+            return query, plan.bind(values)
+        plan = SQLBindingPlan(self.container, values)
+        query = generator(plan)
+        if plan.cacheable:
+            self.container.cache_sql(key, query, plan)
+        return query, plan
+
     def __len__(self):
         if self._sqlLen is None:
-            query = ["SELECT COUNT(*) FROM %s" % self.table_name]
-            params = self.container.ParamsClass()
-            where = self.where_clause(None, params)
-            query.append(self.join_clause())
-            query.append(where)
-            query = ''.join(query)
-            self._sqlLen = (query, params)
-        else:
-            query, params = self._sqlLen
+
+            def generator(params):
+                query = ["SELECT COUNT(*) FROM %s" % self.table_name]
+                where = self.where_clause(None, params)
+                query.append(self.join_clause())
+                query.append(where)
+                return ''.join(query)
+
+            self._sqlLen = self.cached_query('len', generator)
+        query, params = self._sqlLen
+        result = self.container.cached_count(query, params)
+        if result is not None:
+            return result
+        generation = self.container.count_generation
         transaction = SQLTransaction(self.container, self.connection)
         try:
             transaction.begin()
@@ -464,6 +767,10 @@ class SQLCollectionBase(core.EntityCollection):
             # we haven't changed the database, but we don't want to
             # leave the connection idle in transaction
             transaction.commit()
+            if not self.connection.modified:
+                # don't cache counts of uncommitted data
+                self.container.cache_count(query, params, result,
+                                           generation)
             return result
         except Exception as e:
             # we catch (almost) all exceptions and re-raise after rollback
@@ -471,50 +778,106 @@ class SQLCollectionBase(core.EntityCollection):
         finally:
             transaction.close()
 
+    FETCH_SIZE = 100
+    """The number of rows to fetch from the database at a time
+
+    Query results are read from the cursor using the DB API's fetchmany
+    method, this value is passed as the size of each fetch."""
+
+    def fetch_rows(self, transaction):
+        """A generator of the rows returned by a query
+
+        transaction
+            An :py:class:`SQLTransaction` instance that has just
+            executed a query.
+
+        The rows are fetched from the cursor :py:attr:`FETCH_SIZE` rows
+        at a time."""
+        cursor = transaction.cursor
+        stats = core.get_request_stats()
+        while True:
+            if stats is None:
+                rows = cursor.fetchmany(self.FETCH_SIZE)
+            else:
+                with stats.timer('sql'):
+                    rows = cursor.fetchmany(self.FETCH_SIZE)
+                stats.count('rows', len(rows))
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+    def select_plan(self):
+        """Returns a plan for reading a row into an entity
+
+        The result is a list of property paths, one for each column
+        yielded by :py:meth:`select_fields` for a new entity.  Each
+        path is a tuple of property names, a single name for simple
+        properties and a longer tuple for properties of complex values.
+
+        The plan is used by :py:meth:`read_row`."""
+        entity = self.new_entity()
+        paths = {}
+        for k, v in entity.data_items():
+            if isinstance(v, edm.SimpleValue):
+                paths[id(v)] = (k, )
+            else:
+                for sub_path, fv in self._complex_field_generator(v):
+                    paths[id(fv)] = tuple([k] + sub_path)
+        return [paths[id(v)] for c, v in self.select_fields(entity)]
+
+    def read_row(self, plan, row):
+        """Returns a new entity created from a row of data
+
+        plan
+            The plan returned by :py:meth:`select_plan`
+
+        row
+            A row returned by the DB API (extra values in the row are
+            ignored)
+
+        The resulting entity is marked as existing."""
+        entity = self.new_entity()
+        read_sql_value = self.container.read_sql_value
+        for path, new_value in zip(plan, row):
+            value = entity
+            for name in path:
+                value = value[name]
+            read_sql_value(value, new_value)
+        entity.exists = True
+        return entity
+
     def entity_generator(self):
-        entity, values = None, None
         if self._sqlGen is None:
-            entity = self.new_entity()
-            query = ["SELECT "]
-            params = self.container.ParamsClass()
-            column_names, values = zip(*list(self.select_fields(entity)))
-            # values is used later for the first result
-            column_names = list(column_names)
-            self.orderby_cols(column_names, params)
-            query.append(", ".join(column_names))
-            query.append(' FROM ')
-            query.append(self.table_name)
-            # we force where and orderby to be calculated before the
-            # join clause is added as they may add to the joins
-            where = self.where_clause(
-                None, params, use_filter=True, use_skip=False)
-            orderby = self.orderby_clause()
-            query.append(self.join_clause())
-            query.append(where)
-            query.append(orderby)
-            query = ''.join(query)
-            self._sqlGen = query, params
-        else:
-            query, params = self._sqlGen
+
+            def generator(params):
+                query = ["SELECT "]
+                column_names = [
+                    f[0] for f in self.select_fields(self.new_entity())]
+                self.orderby_cols(column_names, params)
+                query.append(", ".join(column_names))
+                query.append(' FROM ')
+                query.append(self.table_name)
+                # we force where and orderby to be calculated before the
+                # join clause is added as they may add to the joins
+                where = self.where_clause(
+                    None, params, use_filter=True, use_skip=False)
+                orderby = self.orderby_clause()
+                query.append(self.join_clause())
+                query.append(where)
+                query.append(orderby)
+                return ''.join(query)
+
+            self._sqlGen = self.cached_query('gen', generator)
+        query, params = self._sqlGen
         transaction = SQLTransaction(self.container, self.connection)
         try:
             transaction.begin()
             logging.info("%s; %s", query, to_text(params.params))
             transaction.execute(query, params)
-            while True:
-                row = transaction.cursor.fetchone()
-                if row is None:
-                    break
-                if entity is None:
-                    entity = self.new_entity()
-                    values = next(
-                        itertools.islice(
-                            zip(*list(self.select_fields(entity))), 1, None))
-                for value, new_value in zip(values, row):
-                    self.container.read_sql_value(value, new_value)
-                entity.exists = True
-                yield entity
-                entity, values = None, None
+            plan = self.select_plan()
+            for row in self.fetch_rows(transaction):
+                yield self.read_row(plan, row)
             # we haven't changed the database, but we don't want to
             # leave the connection idle in transaction
             transaction.commit()
@@ -527,6 +890,81 @@ class SQLCollectionBase(core.EntityCollection):
         return self.expand_entities(
             self.entity_generator())
 
+    def expand_entities(self, entity_iterable):
+        """Overridden to expand entities in batches
+
+        The default implementation calls :py:meth:`Entity.expand` on
+        each entity which results in a separate query for each entity
+        and each expanded navigation property.  Instead, we read up to
+        :py:attr:`EXPAND_BATCH_SIZE` entities at a time and use
+        :py:meth:`expand_batch` to load each navigation property for the
+        whole batch with a single query."""
+        if not self.expand:
+            for e in super(SQLCollectionBase, self).expand_entities(
+                    entity_iterable):
+                yield e
+            return
+        batch = []
+        for e in entity_iterable:
+            batch.append(e)
+            if len(batch) >= self.EXPAND_BATCH_SIZE:
+                self.expand_batch(batch)
+                for be in batch:
+                    yield be
+                batch = []
+        if batch:
+            self.expand_batch(batch)
+            for be in batch:
+                yield be
+
+    def expand_batch(self, entities):
+        """Expands a list of entities
+
+        entities
+            A list of :py:class:`~pyslet.odata2.csdl.Entity` instances
+            from this collection.
+
+        The current :py:attr:`expand` and :py:attr:`select` rules are
+        applied to all the entities in the list.  The entities linked by
+        each expanded navigation property are read using
+        :py:meth:`SQLNavigationCollection.expansion_generator` and are
+        then themselves expanded (in batches) if the expand rule is
+        chained.
+
+        Navigation properties that are not bound to SQL navigation
+        collections are expanded one entity at a time."""
+        select = self.select
+        for e in entities:
+            # apply any select rules but don't expand yet
+            e.expand(None, select)
+        if select is None:
+            select = {}
+        for k, sub_expand in dict_items(self.expand):
+            if k in select:
+                sub_select = select[k]
+                if sub_select is None:
+                    sub_select = {'*': None}
+            else:
+                sub_select = None
+            with self.entity_set.open_navigation(k, entities[0]) as \
+                    collection:
+                if not isinstance(collection, SQLNavigationCollection):
+                    for e in entities:
+                        e[k].expand_collection(sub_expand, sub_select)
+                    continue
+                collection.set_expand(sub_expand, sub_select)
+                targets = {}
+                target_list = []
+                for from_key, target in collection.expansion_generator(
+                        entities):
+                    targets.setdefault(from_key, []).append(target)
+                    target_list.append(target)
+                # now expand the targets themselves
+                for target in collection.expand_entities(target_list):
+                    pass
+            for e in entities:
+                e[k].set_expansion_values(targets.get(e.key(), []))
+
     def set_page(self, top, skip=0, skiptoken=None):
         """Sets the values for paging.
 
@@ -602,53 +1040,45 @@ class SQLCollectionBase(core.EntityCollection):
                 limit = topmax
         else:
             limit = top
-        entity = self.new_entity()
-        query = ["SELECT "]
-        skip, limit_clause = self.container.select_limit_clause(skip, limit)
-        if limit_clause:
-            query.append(limit_clause)
-        params = self.container.ParamsClass()
-        column_names, values = zip(*list(self.select_fields(entity)))
-        column_names = list(column_names)
-        self.orderby_cols(column_names, params, True)
-        query.append(", ".join(column_names))
-        query.append(' FROM ')
-        query.append(self.table_name)
-        where = self.where_clause(None, params, use_filter=True, use_skip=True)
-        orderby = self.orderby_clause()
-        query.append(self.join_clause())
-        query.append(where)
-        query.append(orderby)
+        # the limit clauses may consume some or all of the skip
+        skip, select_limit_clause = self.container.select_limit_clause(
+            skip, limit)
         skip, limit_clause = self.container.limit_clause(skip, limit)
-        if limit_clause:
-            query.append(limit_clause)
-        query = ''.join(query)
+
+        def generator(params):
+            query = ["SELECT "]
+            if select_limit_clause:
+                query.append(select_limit_clause)
+            column_names = [
+                f[0] for f in self.select_fields(self.new_entity())]
+            self.orderby_cols(column_names, params, True)
+            query.append(", ".join(column_names))
+            query.append(' FROM ')
+            query.append(self.table_name)
+            where = self.where_clause(
+                None, params, use_filter=True, use_skip=True)
+            orderby = self.orderby_clause()
+            query.append(self.join_clause())
+            query.append(where)
+            query.append(orderby)
+            if limit_clause:
+                query.append(limit_clause)
+            return ''.join(query)
+
+        query, params = self.cached_query(
+            ('page', select_limit_clause, limit_clause), generator)
         transaction = SQLTransaction(self.container, self.connection)
         try:
             transaction.begin()
             logging.info("%s; %s", query, to_text(params.params))
             transaction.execute(query, params)
-            while True:
-                row = transaction.cursor.fetchone()
-                if row is None:
-                    # no more pages
-                    if set_next:
-                        self.top = self.skip = 0
-                        self.skipToken = None
-                    break
+            plan = self.select_plan()
+            for row in self.fetch_rows(transaction):
                 if skip:
                     skip = skip - 1
                     continue
-                if entity is None:
-                    entity = self.new_entity()
-                    values = next(
-                        itertools.islice(
-                            zip(*list(self.select_fields(entity))), 1, None))
                 row_values = list(row)
-                for value, new_value in zip(values, row_values):
-                    self.container.read_sql_value(value, new_value)
-                entity.exists = True
-                yield entity
+                yield self.read_row(plan, row_values)
                 if topmax is not None:
                     topmax = topmax - 1
                     if topmax < 1:
@@ -684,7 +1114,11 @@ class SQLCollectionBase(core.EntityCollection):
                             else:
                                 self.skip = self.top
                         break
-                entity = None
+            else:
+                # no more pages
+                if set_next:
+                    self.top = self.skip = 0
+                    self.skipToken = None
             # we haven't changed the database, but we don't want to
             # leave the connection idle in transaction
             transaction.commit()
@@ -697,6 +1131,49 @@ class SQLCollectionBase(core.EntityCollection):
         return self.expand_entities(
             self.page_generator(set_next))
 
+    def iterkeyset(self, chunk_size=1000):
+        """Iterates through all entities in the collection in chunks
+
+        chunk_size
+            The maximum number of entities to read from the database in
+            each query.
+
+        This method is an alternative to :py:meth:`itervalues` designed
+        for iterating over very large collections, e.g., for exporting
+        data.  itervalues executes a single query and holds the
+        transaction open until iteration is complete.  This method uses
+        keyset pagination instead: the entities are read in chunks, each
+        chunk is read using a short transaction and the next chunk is
+        read by constraining the query to entities beyond the last
+        entity in the current chunk (using the same mechanism as
+        :py:meth:`next_skiptoken`).  The collection's database
+        connection is released back to the pool while the entities in
+        each chunk are being yielded.
+
+        The current filter, ordering and expansion options are
+        honoured but the current page settings are ignored (and are
+        restored when iteration is complete).  Changes made to the
+        collection during iteration may or may not be reflected in the
+        results."""
+        page = (self.top, self.skip, self.skiptoken, self.topmax,
+                self.nextSkiptoken)
+        try:
+            self.set_page(None)
+            self.topmax = chunk_size
+            while True:
+                self.reacquire_connection()
+                chunk = list(self.expand_entities(
+                    self.page_generator(set_next=True)))
+                if not chunk:
+                    break
+                self.release_connection()
+                for entity in chunk:
+                    yield entity
+        finally:
+            self.reacquire_connection()
+            (self.top, self.skip, self.skiptoken, self.topmax,
+             self.nextSkiptoken) = page
+
     def __getitem__(self, key):
         entity = self.new_entity()
         entity.set_key(key)
@@ -1143,7 +1620,7 @@ class SQLCollectionBase(core.EntityCollection):
                 '%s.%s=%s' %
                 (self.table_name,
                  self.container.mangled_names[(self.entity_set.name, k)],
-                 params.add_param(self.container.prepare_sql_value(v))))
+                 self.sql_param(params, v)))
 
     def where_skiptoken_clause(self, where, params):
         """Adds the entity constraint expression to a list of SQL expressions.
@@ -1166,10 +1643,7 @@ class SQLCollectionBase(core.EntityCollection):
                 o_expression = oname
             skip_expression.append(
                 "(%s %s %s" %
-                (o_expression,
-                 op,
-                 params.add_param(
-                     self.container.prepare_sql_value(v))))
+                (o_expression, op, self.sql_param(params, v)))
             ket += 1
             i += 1
             if i < len(self.orderNames):
@@ -1179,8 +1653,7 @@ class SQLCollectionBase(core.EntityCollection):
                     o_expression = self.sql_expression(expression, params, '=')
                 skip_expression.append(
                     " OR (%s = %s AND " %
-                    (o_expression, params.add_param(
-                        self.container.prepare_sql_value(v))))
+                    (o_expression, self.sql_param(params, v)))
                 ket += 1
                 continue
             else:
@@ -1484,6 +1957,24 @@ class SQLCollectionBase(core.EntityCollection):
     SQLBinaryExpressionMethod = {}
     SQLCallExpressionMethod = {}
 
+    def sql_param(self, params, value):
+        """Adds a value to a parameter list
+
+        params
+            The :py:class:`SQLParams` object to add the value to.
+
+        value
+            A :py:class:`~pyslet.odata2.csdl.SimpleValue` instance.
+
+        Returns the string to include in the query in place of the
+        value.  Methods that generate queries should use this method
+        rather than adding values to *params* directly as it allows
+        *params* to be a :py:class:`SQLBindingPlan`."""
+        if isinstance(params, SQLBindingPlan):
+            return params.add_value(value)
+        else:
+            return params.add_param(self.container.prepare_sql_value(value))
+
     def sql_expression(self, expression, params, context="AND"):
         """Converts an expression into a SQL expression string.
 
@@ -1531,9 +2022,7 @@ class SQLCollectionBase(core.EntityCollection):
             return self.container.ParamsClass.escape_literal(
                 to_text(expression.value))
         elif isinstance(expression, core.LiteralExpression):
-            return params.add_param(
-                self.container.prepare_sql_value(
-                    expression.value))
+            return self.sql_param(params, expression.value)
         elif isinstance(expression, core.PropertyExpression):
             try:
                 p = self.entity_set.entityType[expression.name]
@@ -2014,6 +2503,152 @@ class SQLEntityCollection(SQLCollectionBase):
         implementation that takes additional arguments."""
         self.insert_entity_sql(entity)
 
+    def __len__(self):
+        """Extended to support approximate counts
+
+        If the container was created with approximate_counts set and
+        no filter is in force then the container's
+        :py:meth:`SQLEntityContainer.approximate_count` is used to
+        estimate the number of entities in the collection without
+        counting them."""
+        if self.container.approximate_counts and self.filter is None:
+            transaction = SQLTransaction(self.container, self.connection)
+            try:
+                transaction.begin()
+                result = self.container.approximate_count(
+                    self.table_name, transaction)
+                transaction.commit()
+            except Exception as e:
+                transaction.rollback(e)
+            finally:
+                transaction.close()
+            if result is not None:
+                return result
+        return super(SQLEntityCollection, self).__len__()
+
+    def insert_entities(self, entities, batch_size=100):
+        """Inserts multiple entities into the collection.
+
+        entities
+            An iterable of :py:class:`~pyslet.odata2.csdl.Entity`
+            instances created with :py:meth:`new_entity`.
+
+        batch_size
+            The maximum number of entities to insert with a single call
+            to the DB API's executemany method.
+
+        This method is an extension to the basic EntityCollection API
+        designed for loading large amounts of data.  All the entities
+        are inserted as part of a single transaction so either all of
+        them are inserted or, if an error occurs, none of them are (for
+        databases that support transactions).
+
+        Entities are grouped into batches and each batch is inserted
+        with a single executemany call.  Entities that can't be
+        inserted with a simple INSERT statement are inserted
+        individually (within the same transaction) using
+        :py:meth:`insert_entity_sql` instead.  These are entities that
+        have navigation properties bound (or required bindings), are
+        missing key values or have automatically generated fields that
+        must be read back from the database after insertion.
+
+        If any of the entities can't be inserted ConstraintError is
+        raised."""
+        required = False
+        for link_end, nav_name in dict_items(self.entity_set.linkEnds):
+            if (link_end.otherEnd.associationEnd.multiplicity ==
+                    edm.Multiplicity.One):
+                required = True
+                break
+        transaction = SQLTransaction(self.container, self.connection)
+        done = []
+        committed = False
+        try:
+            transaction.begin()
+            batch = []
+            batch_query = None
+            for entity in entities:
+                if entity.exists:
+                    raise edm.EntityExists(str(entity.get_location()))
+                done.append(entity)
+                if required or not self.is_simple_insert(entity):
+                    self.insert_batch(batch_query, batch, transaction)
+                    batch = []
+                    self.insert_entity_sql(entity, transaction=transaction)
+                    continue
+                entity.set_concurrency_tokens()
+                params = self.container.ParamsClass()
+                column_names = []
+                column_values = []
+                for c, v in self.insert_fields(entity):
+                    column_names.append(c)
+                    column_values.append(
+                        params.add_param(self.container.prepare_sql_value(v)))
+                query = "INSERT INTO %s (%s) VALUES (%s)" % (
+                    self.table_name, ", ".join(column_names),
+                    ", ".join(column_values))
+                if query != batch_query or len(batch) >= batch_size:
+                    self.insert_batch(batch_query, batch, transaction)
+                    batch = []
+                    batch_query = query
+                batch.append((entity, params))
+            self.insert_batch(batch_query, batch, transaction)
+            transaction.commit()
+            committed = True
+        except (self.container.dbapi.IntegrityError,
+                self.container.dbapi.InternalError) as e:
+            transaction.rollback(e, swallow=True)
+            raise edm.ConstraintError(
+                "insert_entities failed for %s : %s" %
+                (self.entity_set.name, str(e)))
+        except Exception as e:
+            transaction.rollback(e)
+        finally:
+            if not committed:
+                # nothing was inserted
+                for entity in done:
+                    entity.exists = False
+            transaction.close()
+
+    def is_simple_insert(self, entity):
+        """Returns True if *entity* can be inserted in bulk
+
+        Used by :py:meth:`insert_entities` to determine if *entity* can
+        be inserted using a single INSERT statement with no follow-up
+        queries."""
+        try:
+            entity.key()
+        except KeyError:
+            return False
+        for k, dv in entity.navigation_items():
+            if dv.bindings:
+                return False
+        for f in self.auto_fields(entity):
+            return False
+        return True
+
+    def insert_batch(self, query, batch, transaction):
+        """Inserts a batch of entities
+
+        query
+            The INSERT statement
+
+        batch
+            A list of (entity, params) tuples.  The entities are marked
+            as existing if the insert succeeds.
+
+        transaction
+            The transaction in which to execute the statement.  Errors
+            are not handled, the caller is responsible for rolling back
+            the transaction."""
+        if not batch:
+            return
+        params_list = [b[1] for b in batch]
+        logging.info("%s; %i rows", query, len(params_list))
+        transaction.executemany(query, params_list)
+        for entity, _ in batch:
+            entity.exists = True
+
     def new_stream(self, src, sinfo=None, key=None):
         e = self.new_entity()
         if key is None:
@@ -3063,14 +3698,110 @@ class SQLEntityCollection(SQLCollectionBase):
         query.append(')')
         return ''.join(query), params
 
+    def index_list(self):
+        """Returns a list of the indexes declared for this entity set
+
+        Indexes are declared in the metadata model using the
+        :py:data:`INDEX` attribute.  Each index in the resulting list is
+        a list of (source path, descending) tuples where source path is
+        a tuple of property names, suitable for looking up the mangled
+        column name, and descending is a boolean flag.  Indexes declared
+        on the entity type come first, followed by indexes on individual
+        properties in the order they are declared."""
+        result = []
+        entity_type = self.entity_set.entityType
+        try:
+            declaration = entity_type.get_attribute(INDEX)
+        except KeyError:
+            declaration = ''
+        for idef in declaration.split(';'):
+            index = []
+            for cdef in idef.split(','):
+                cdef = cdef.split()
+                if not cdef:
+                    continue
+                if len(cdef) > 2 or (len(cdef) == 2 and
+                                     cdef[1].lower() not in ('asc', 'desc')):
+                    raise edm.ModelConstraintError(
+                        "Bad index declaration for %s: %s" %
+                        (entity_type.name, idef))
+                path = (self.entity_set.name, ) + tuple(cdef[0].split('/'))
+                if path not in self.container.mangled_names:
+                    raise edm.ModelConstraintError(
+                        "Bad index declaration for %s: no property %s" %
+                        (entity_type.name, cdef[0]))
+                index.append(
+                    (path, len(cdef) == 2 and cdef[1].lower() == 'desc'))
+            if index:
+                result.append(index)
+        for path in self._indexed_properties(entity_type):
+            result.append([((self.entity_set.name, ) + path, False)])
+        return result
+
+    def _indexed_properties(self, type_def):
+        for p in type_def.Property:
+            if p.complexType is not None:
+                for path in self._indexed_properties(p.complexType):
+                    yield (p.name, ) + path
+            else:
+                try:
+                    if p.get_attribute(INDEX) == "true":
+                        yield (p.name, )
+                except KeyError:
+                    pass
+
+    def create_index_queries(self):
+        """Returns a list of SQL statements for creating indexes
+
+        The indexes are taken from :py:meth:`index_list`.  Each index is
+        extended with any key columns that it does not already contain
+        making it suitable for ordering results consistently, as
+        required by skiptoken-based paging.  For example, an index
+        declared on the property Name creates an index on the columns
+        (Name, Key).  Indexes that only contain key columns are
+        redundant and are ignored.
+
+        Indexes are named by appending _idx1, _idx2, etc. to the name of
+        the table, see :py:meth:`SQLEntityContainer.mangle_index_name`."""
+        result = []
+        key_names = [
+            self.container.mangled_names[(self.entity_set.name, k)]
+            for k in self.entity_set.keys]
+        i = 0
+        for index in self.index_list():
+            cols = []
+            cnames = set()
+            for path, descending in index:
+                cname = self.container.mangled_names[path]
+                if cname in cnames:
+                    continue
+                cnames.add(cname)
+                cols.append("%s DESC" % cname if descending else cname)
+            if cnames.issubset(key_names):
+                continue
+            for cname in key_names:
+                if cname not in cnames:
+                    cols.append(cname)
+            i += 1
+            result.append("CREATE INDEX %s ON %s (%s)" % (
+                self.container.mangle_index_name(self.entity_set.name, i),
+                self.table_name, ', '.join(cols)))
+        return result
+
     def create_table(self):
-        """Executes the SQL statement :py:meth:`create_table_query`"""
+        """Executes the SQL statement :py:meth:`create_table_query`
+
+        Any indexes returned by :py:meth:`create_index_queries` are
+        created in the same transaction."""
         query, params = self.create_table_query()
         transaction = SQLTransaction(self.container, self.connection)
         try:
             transaction.begin()
             logging.info("%s; %s", query, to_text(params.params))
             transaction.execute(query, params)
+            for query in self.create_index_queries():
+                logging.info("%s;", query)
+                transaction.execute(query, self.container.ParamsClass())
             transaction.commit()
         except Exception as e:
             transaction.rollback(e)
@@ -3110,8 +3841,125 @@ class SQLNavigationCollection(SQLCollectionBase, core.NavigationCollection):
 
     def __init__(self, aset_name, **kwargs):
         self.aset_name = aset_name
+        #: an optional list of source entities used when expanding
+        self.from_entities = None
         super(SQLNavigationCollection, self).__init__(**kwargs)
 
+    def query_shape(self):
+        """Extended to include the navigation property
+
+        The key values of *from_entity* are added to the values."""
+        shape, values = super(SQLNavigationCollection, self).query_shape()
+        from_set = self.from_entity.entity_set
+        shape = shape + (from_set.name, self.name)
+        for k in from_set.keys:
+            values.append(self.from_entity[k])
+        return shape, values
+
+    def from_key_cols(self):
+        """Returns the columns containing the keys of *from_entity*
+
+        Returns a list of (key name, column expression) tuples, one for
+        each key property of the entity set containing *from_entity*.
+        The column expressions can be used to constrain (or select) the
+        source entity in queries on this collection.
+
+        Must be overridden by derived classes."""
+        raise NotImplementedError
+
+    def where_from_clause(self, where, params):
+        """Adds the constraint for entities linked from *from_entity*
+
+        where
+            A list of strings to be joined with AND to make the WHERE
+            clause
+
+        params
+            The :py:class:`SQLParams` object to add parameters to.
+
+        If :py:attr:`from_entities` is not None then the constraint is
+        widened to include entities linked from any of the entities in
+        the list, see :py:meth:`expansion_generator` for details."""
+        cols = self.from_key_cols()
+        if self.from_entities is None:
+            for k, col in cols:
+                where.append("%s=%s" % (
+                    col, self.sql_param(params, self.from_entity[k])))
+        elif len(cols) == 1:
+            k, col = cols[0]
+            in_list = []
+            for e in self.from_entities:
+                in_list.append(params.add_param(
+                    self.container.prepare_sql_value(e[k])))
+            where.append("%s IN (%s)" % (col, ", ".join(in_list)))
+        else:
+            or_list = []
+            for e in self.from_entities:
+                and_list = []
+                for k, col in cols:
+                    and_list.append("%s=%s" % (col, params.add_param(
+                        self.container.prepare_sql_value(e[k]))))
+                or_list.append("(%s)" % ' AND '.join(and_list))
+            where.append("(%s)" % ' OR '.join(or_list))
+
+    def expansion_generator(self, from_entities):
+        """Generates the entities linked from a list of source entities
+
+        from_entities
+            A list of entities from the same entity set as
+            *from_entity*.
+
+        The entities are read with a single query and yielded as tuples
+        of (key, entity) where key is the key of the entity in
+        *from_entities* that the entity is linked from.  Entities that
+        are linked from more than one source entity are yielded
+        multiple times, once for each link.
+
+        This method is used to implement batched expansion of
+        navigation properties, see
+        :py:meth:`SQLCollectionBase.expand_batch`.  No expansion is
+        applied to the yielded entities."""
+        query = ["SELECT "]
+        params = self.container.ParamsClass()
+        column_names = [f[0] for f in self.select_fields(self.new_entity())]
+        cols = self.from_key_cols()
+        for k, col in cols:
+            column_names.append(col)
+        self.orderby_cols(column_names, params)
+        query.append(", ".join(column_names))
+        query.append(' FROM ')
+        query.append(self.table_name)
+        self.from_entities = from_entities
+        try:
+            where = self.where_clause(None, params, use_filter=True,
+                                      use_skip=False)
+        finally:
+            self.from_entities = None
+        orderby = self.orderby_clause()
+        query.append(self.join_clause())
+        query.append(where)
+        query.append(orderby)
+        query = ''.join(query)
+        source = core.Entity(self.from_entity.entity_set)
+        key_values = [source[k] for k, col in cols]
+        transaction = SQLTransaction(self.container, self.connection)
+        try:
+            transaction.begin()
+            logging.info("%s; %s", query, to_text(params.params))
+            transaction.execute(query, params)
+            plan = self.select_plan()
+            nvalues = len(plan)
+            for row in self.fetch_rows(transaction):
+                for value, new_value in zip(
+                        key_values, row[nvalues:nvalues + len(cols)]):
+                    self.container.read_sql_value(value, new_value)
+                yield source.key(), self.read_row(plan, row)
+            transaction.commit()
+        except Exception as e:
+            transaction.rollback(e)
+        finally:
+            transaction.close()
+
     def __setitem__(self, key, entity):
         # sanity check entity to check it can be inserted here
         if (not isinstance(entity, edm.Entity) or
@@ -3250,6 +4098,18 @@ class SQLForeignKeyCollection(SQLNavigationCollection):
         self._joins[nav_name] = (alias, join)
         self._source_alias = alias
 
+    def from_key_cols(self):
+        """The keys of *from_entity* are taken from the aliased table
+
+        The alias is the one introduced by :py:meth:`reset_joins`."""
+        if self._joins is None:
+            self.reset_joins()
+        from_set = self.from_entity.entity_set
+        return [(k, "%s.%s" % (self._source_alias,
+                               self.container.mangled_names[
+                                   (from_set.name, k)]))
+                for k in from_set.keys]
+
     def where_clause(self, entity, params, use_filter=True, use_skip=False):
         """Adds the constraint for entities linked from *from_entity* only.
 
@@ -3258,12 +4118,7 @@ class SQLForeignKeyCollection(SQLNavigationCollection):
         if self._joins is None:
             self.reset_joins()
         where = []
-        for k, v in dict_items(self.from_entity.key_dict()):
-            where.append(
-                "%s.%s=%s" %
-                (self._source_alias, self.container.mangled_names[
-                    (self.from_entity.entity_set.name, k)], params.add_param(
-                    self.container.prepare_sql_value(v))))
+        self.where_from_clause(where, params)
         if entity is not None:
             self.where_entity_clause(where, entity, params)
         if self.filter is not None and use_filter:
@@ -3370,14 +4225,17 @@ class SQLReverseKeyCollection(SQLNavigationCollection):
         super(SQLReverseKeyCollection, self).__init__(**kwargs)
         self.keyCollection = self.entity_set.open()
 
+    def from_key_cols(self):
+        """The keys of *from_entity* are the foreign key columns"""
+        return [(k, "%s.%s" % (self.table_name,
+                               self.container.mangled_names[
+                                   (self.entity_set.name, self.aset_name, k)]))
+                for k in self.from_entity.entity_set.keys]
+
     def where_clause(self, entity, params, use_filter=True, use_skip=False):
         """Adds the constraint to entities linked from *from_entity* only."""
         where = []
-        for k, v in dict_items(self.from_entity.key_dict()):
-            where.append("%s=%s" % (
-                self.container.mangled_names[
-                    (self.entity_set.name, self.aset_name, k)],
-                params.add_param(self.container.prepare_sql_value(v))))
+        self.where_from_clause(where, params)
         if entity is not None:
             self.where_entity_clause(where, entity, params)
         if self.filter is not None and use_filter:
@@ -3654,20 +4512,19 @@ class SQLAssociationCollection(SQLNavigationCollection):
         self._aliases.add(alias)
         return alias
 
+    def from_key_cols(self):
+        """The keys of *from_entity* are read from the auxiliary table"""
+        from_set = self.from_entity.entity_set
+        return [(k, "%s.%s" % (self.atable_name,
+                               self.container.mangled_names[
+                                   (self.aset_name, from_set.name,
+                                    self.from_nav_name, k)]))
+                for k in from_set.keys]
+
     def where_clause(self, entity, params, use_filter=True, use_skip=False):
         """Provides the *from_entity* constraint in the auxiliary table."""
         where = []
-        for k, v in dict_items(self.from_entity.key_dict()):
-            where.append(
-                "%s.%s=%s" %
-                (self.atable_name,
-                 self.container.mangled_names[
-                     (self.aset_name,
-                      self.from_entity.entity_set.name,
-                      self.from_nav_name,
-                      k)],
-                    params.add_param(
-                     self.container.prepare_sql_value(v))))
+        self.where_from_clause(where, params)
         if entity is not None:
             for k, v in dict_items(entity.key_dict()):
                 where.append(
@@ -4061,6 +4918,78 @@ class SQLConnection(object):
         self.locked = 0
         self.last_seen = 0
         self.dbc = None
+        #: the time at which dbc was opened
+        self.opened = 0
+        #: the transaction of any :py:class:`SQLChangeset` in progress
+        self.transaction = None
+        #: True if data has been modified since the last commit
+        self.modified = False
+        #: the number of times this connection has been acquired from
+        #: a queue pool without waiting
+        self.nacquired = 0
+
+
+class SQLChangeset(object):
+
+    """Groups a sequence of operations into a single transaction
+
+    container
+        A :py:class:`SQLEntityContainer` instance.
+
+    Changesets are context managers, you don't create them directly but
+    obtain them from :py:meth:`SQLEntityContainer.changeset`::
+
+        with container.changeset():
+            with entity_set.open() as collection:
+                collection.insert_entity(e1)
+                collection.insert_entity(e2)
+
+    The changeset holds the calling thread's database connection for
+    the duration of the with statement.  Any :py:class:`SQLTransaction`
+    created on the same connection (i.e., by collections opened by the
+    same thread) is enclosed by the changeset's transaction, their
+    commits are deferred and their rollbacks are ignored.  The changeset
+    is committed when the with statement exits normally and rolled back
+    if it exits with an exception, the exception is then re-raised.
+
+    Changesets do not nest, if a changeset is already in progress on
+    the thread's connection then the inner changeset does nothing."""
+
+    def __init__(self, container):
+        self.container = container
+        self.connection = None
+        self.transaction = None
+
+    def __enter__(self):
+        self.connection = self.container.acquire_connection(SQL_TIMEOUT)
+        if self.connection is None:
+            raise DatabaseBusy(
+                "Failed to acquire connection after %is" % SQL_TIMEOUT)
+        if self.connection.transaction is None:
+            self.transaction = SQLTransaction(self.container,
+                                              self.connection)
+            self.transaction.begin()
+            self.connection.transaction = self.transaction
+        return self
+
+    def __exit__(self, type, value, tb):
+        try:
+            if self.transaction is not None:
+                self.connection.transaction = None
+                try:
+                    if value is None:
+                        self.transaction.commit()
+                    else:
+                        self.transaction.rollback(value, swallow=True)
+                except Exception as e:
+                    self.transaction.rollback(e)
+                finally:
+                    self.transaction.close()
+                    self.transaction = None
+        finally:
+            self.container.release_connection(self.connection)
+            self.connection = None
+        return False
 
 
 class SQLEntityContainer(object):
@@ -4121,6 +5050,46 @@ class SQLEntityContainer(object):
         of 3600 (1 hour) will result in a pool cleaner call every 12
         minutes.
 
+    count_cache_ttl (optional)
+        The number of seconds for which the results of COUNT queries
+        are cached, see :py:meth:`cached_count`.  Defaults to None,
+        meaning that counts are not cached.
+
+    approximate_counts (optional)
+        A flag (defaults to False) indicating that the number of
+        entities in an unfiltered entity set may be estimated using
+        :py:meth:`approximate_count` rather than counted exactly.
+
+    sql_cache_size (optional)
+        The maximum number of generated queries to keep in the cache
+        used by :py:meth:`cached_sql`.  Defaults to 256, set to 0 to
+        disable the cache.
+
+    pool_type (optional)
+        The type of connection pool to use.  The default, "thread",
+        is a pool in which connections have an affinity for the
+        thread that last used them.  The alternative, "queue", uses a
+        bounded queue of connections shared by all threads: a thread
+        that releases its last lock on a connection returns it to the
+        back of the queue and threads waiting for a connection are
+        served in turn.  Acquiring and releasing a connection only
+        synchronises on the queue itself, the connection held by each
+        thread is tracked using thread-local storage.  The queue pool
+        is not available for modules with thread-safety level 0.
+
+    max_lifetime (optional)
+        The maximum number of seconds a database connection is used
+        for before it is closed and replaced with a new one.  The
+        check is made when a thread acquires a connection from the
+        pool.  Defaults to None, meaning connections are reused
+        indefinitely.
+
+    pre_ping (optional)
+        A flag (defaults to False) indicating that each connection
+        should be tested with :py:meth:`ping` when it is acquired from
+        the pool.  Connections that fail the test are closed and
+        replaced with a new one.
+
     This class is designed to work with diamond inheritance and super.
     All derived classes must call __init__ through super and pass all
     unused keyword arguments.  For example::
@@ -4131,7 +5100,10 @@ class SQLEntityContainer(object):
                         # do something with myDBConfig...."""
 
     def __init__(self, container, dbapi, streamstore=None, max_connections=10,
-                 field_name_joiner="_", max_idle=None, **kwargs):
+                 field_name_joiner="_", max_idle=None, sql_cache_size=256,
+                 count_cache_ttl=None, approximate_counts=False,
+                 pool_type="thread", max_lifetime=None, pre_ping=False,
+                 **kwargs):
         if kwargs:
             logging.debug(
                 "Unabsorbed kwargs in SQLEntityContainer constructor")
@@ -4158,7 +5130,49 @@ class SQLEntityContainer(object):
         self.cpool_unlocked = {}
         self.cpool_idle = []
         self.cpool_size = 0
+        if pool_type == "queue":
+            if self.dbapi.threadsafety == 0:
+                raise ValueError(
+                    "queue pool requires a module with threadsafety > 0")
+            self.cpool_queue = queue.Queue(self.cpool_max)
+            # the connection held by each thread
+            self.cpool_local = threading.local()
+            # all the connections created by the queue pool
+            self.cpool_items = []
+            # draws tickets that allow up to cpool_max connections to be
+            # created without locking
+            self.cpool_tickets = itertools.count()
+        elif pool_type == "thread":
+            self.cpool_queue = None
+        else:
+            raise ValueError("Unknown pool_type: %s" % repr(pool_type))
+        #: the type of connection pool: "thread" or "queue"
+        self.pool_type = pool_type
+        #: the maximum lifetime of a connection in seconds (or None)
+        self.max_lifetime = max_lifetime
+        #: True if connections are tested before use
+        self.pre_ping = pre_ping
+        self.cpool_nacquired = 0
+        self.cpool_nwaits = 0
+        self.cpool_ntimeouts = 0
+        self.cpool_nreopened = 0
+        self.cpool_wait_time = 0.0
+        self.cpool_max_wait = 0.0
         self.closing = threading.Event()
+        #: the maximum number of queries in the SQL cache
+        self.sql_cache_size = sql_cache_size
+        self.sql_cache_lock = threading.Lock()
+        self.sql_cache = collections.OrderedDict()
+        self.sql_cache_hits = 0
+        self.sql_cache_misses = 0
+        #: the time, in seconds, for which counts are cached
+        self.count_cache_ttl = count_cache_ttl
+        self.count_cache = {}
+        self.count_cache_lock = threading.Lock()
+        #: incremented each time the cached counts are invalidated
+        self.count_generation = 0
+        #: True if approximate entity set counts are allowed
+        self.approximate_counts = approximate_counts
         # set up the parameter style
         if self.dbapi.paramstyle == "qmark":
             self.ParamsClass = QMarkParams
@@ -4331,6 +5345,31 @@ class SQLEntityContainer(object):
         return self.quote_identifier(
             self.field_name_joiner.join(source_path))
 
+    def mangle_index_name(self, entity_set_name, i):
+        """Returns a quoted SQL name for an index
+
+        entity_set_name
+            The name of the entity set whose table is being indexed
+
+        i
+            The (1-based) number of the index on the table
+
+        Index names must be unique within the database (or schema) so
+        they are derived from the mangled name of the table, ensuring
+        that any prefix or other changes made to the table name by
+        :py:meth:`mangle_name` apply to its indexes too.  The default
+        implementation removes the quotes added by
+        :py:meth:`quote_identifier` from the table name, appends _idx
+        and the index number and quotes the result again, e.g.,
+        "Customers_idx1"."""
+        table_name = self.mangled_names[(entity_set_name, )]
+        quotes = self.quote_identifier('')
+        nquote = len(quotes) // 2
+        if (nquote and table_name.startswith(quotes[:nquote]) and
+                table_name.endswith(quotes[nquote:])):
+            table_name = table_name[nquote:-nquote]
+        return self.quote_identifier("%s_idx%i" % (table_name, i))
+
     def ro_name(self, source_path):
         """Test if a source_path identifies a read-only property
 
@@ -4516,7 +5555,10 @@ class SQLEntityContainer(object):
         Table A -> Table B with a foreign key and Table B -> Table A
         with a foreign key.  Such databases will have to be created by
         hand. You can use the create_table_query methods to act as a
-        starting point for your script."""
+        starting point for your script.
+
+        Indexes declared in the metadata model are created with each
+        table, see :py:data:`INDEX` for details."""
         visited = set()
         create_list = []
         for es in self.container.EntitySet:
@@ -4533,6 +5575,9 @@ class SQLEntityContainer(object):
                     if params.params:
                         logging.warning("Ignoring params to CREATE TABLE: %s",
                                         to_text(params.params))
+                    for query in collection.create_index_queries():
+                        out.write(query)
+                        out.write(ul(";\n\n"))
         # we now need to go through the aux_table and create them
         for aset_name in self.aux_table:
             nav_class = self.get_symmetric_navigation_class()
@@ -4619,23 +5664,28 @@ class SQLEntityContainer(object):
                     out.write(ul(";\n\n"))
 
     def acquire_connection(self, timeout=None):
+        if self.cpool_queue is not None:
+            return self._acquire_queued_connection(timeout)
         # block on the module for threadsafety==0 case
         thread = threading.current_thread()
         thread_id = thread.ident
         now = start = time.time()
         cpool_item = None
         close_flag = False
+        waited = False
         with self.cpool_lock:
             if self.closing.is_set():
                 # don't open connections when we are trying to close them
                 return None
             while not self.module_lock.acquire(False):
+                waited = True
                 self.cpool_lock.wait(timeout)
                 now = time.time()
                 if timeout is not None and now > start + timeout:
                     logging.warning(
                         "Thread[%i] timed out waiting for the the database "
                         "module lock", thread_id)
+                    self._count_acquire(start, waited, False)
                     return None
             # we have the module lock
             cpool_item = self.cpool_locked.get(thread_id, None)
@@ -4683,6 +5733,7 @@ class SQLEntityContainer(object):
                     logging.debug(
                         "Thread[%i] forced to wait for a database connection",
                         thread_id)
+                    waited = True
                     self.cpool_lock.wait(timeout)
                     logging.debug(
                         "Thread[%i] resuming search for database connection",
@@ -4693,19 +5744,152 @@ class SQLEntityContainer(object):
                 cpool_item.thread_id = thread_id
                 cpool_item.last_seen = time.time()
                 self.cpool_locked[thread_id] = cpool_item
+            self._count_acquire(start, waited, cpool_item is not None)
         if cpool_item:
             if close_flag:
                 self.close_connection(cpool_item.dbc)
                 cpool_item.dbc = None
-            if cpool_item.dbc is None:
-                cpool_item.dbc = self.open()
+            if cpool_item.locked == 1 or cpool_item.dbc is None:
+                self.check_connection(cpool_item)
             return cpool_item
         # we are defeated, no database connection for the caller
         # release lock on the module as there is no connection to release
         self.module_lock.release()
         return None
 
+    def _acquire_queued_connection(self, timeout):
+        if self.closing.is_set():
+            return None
+        thread = threading.current_thread()
+        cpool_item = getattr(self.cpool_local, 'item', None)
+        if (cpool_item is not None and cpool_item.locked and
+                cpool_item.thread is thread):
+            # connections are always shared within the same thread
+            cpool_item.locked += 1
+            cpool_item.last_seen = time.time()
+            return cpool_item
+        try:
+            cpool_item = self.cpool_queue.get_nowait()
+        except queue.Empty:
+            if next(self.cpool_tickets) < self.cpool_max:
+                # the connection is opened by check_connection
+                cpool_item = SQLConnection()
+                self.cpool_items.append(cpool_item)
+        if cpool_item is None:
+            # wait for another thread to put a connection back
+            logging.debug(
+                "Thread[%i] forced to wait for a database connection",
+                thread.ident)
+            start = time.time()
+            try:
+                cpool_item = self.cpool_queue.get(True, timeout)
+            except queue.Empty:
+                logging.warning(
+                    "Thread[%i] timed out waiting for a database "
+                    "connection", thread.ident)
+            with self.cpool_lock:
+                self._count_acquire(start, True, cpool_item is not None)
+            if cpool_item is None:
+                return None
+        else:
+            cpool_item.nacquired += 1
+        if self.closing.is_set():
+            # put it back for close to find
+            self.cpool_queue.put(cpool_item)
+            return None
+        cpool_item.locked = 1
+        cpool_item.thread = thread
+        cpool_item.thread_id = thread.ident
+        cpool_item.last_seen = time.time()
+        self.cpool_local.item = cpool_item
+        try:
+            self.check_connection(cpool_item)
+        except BaseException:
+            # return the (closed) connection to the queue and re-raise,
+            # even on KeyboardInterrupt, otherwise the pool loses it
+            self.cpool_local.item = None
+            self._requeue(cpool_item)
+            raise
+        return cpool_item
+
+    def _requeue(self, cpool_item):
+        cpool_item.locked = 0
+        cpool_item.thread = None
+        cpool_item.thread_id = None
+        self.cpool_queue.put(cpool_item)
+
+    def _count_acquire(self, start, waited, acquired):
+        # must be called with cpool_lock held
+        if acquired:
+            self.cpool_nacquired += 1
+        else:
+            self.cpool_ntimeouts += 1
+        if waited:
+            wait_time = time.time() - start
+            self.cpool_nwaits += 1
+            self.cpool_wait_time += wait_time
+            if wait_time > self.cpool_max_wait:
+                self.cpool_max_wait = wait_time
+
+    def check_connection(self, cpool_item):
+        """Checks a connection that is being acquired from the pool
+
+        cpool_item
+            The :py:class:`SQLConnection` being acquired.
+
+        Called when a thread acquires a connection that it does not
+        already hold.  If the connection has exceeded
+        :py:attr:`max_lifetime`, or if :py:attr:`pre_ping` is True and
+        :py:meth:`ping` fails, the underlying database connection is
+        closed.  A new database connection is opened if required."""
+        now = time.time()
+        if cpool_item.dbc is not None:
+            if (self.max_lifetime is not None and
+                    now - cpool_item.opened > self.max_lifetime):
+                logging.debug("Closing database connection after %is",
+                              int(now - cpool_item.opened))
+                self._discard_dbc(cpool_item)
+            elif self.pre_ping and not self.ping(cpool_item.dbc):
+                logging.warning(
+                    "Database connection failed health check: reopening")
+                self._discard_dbc(cpool_item)
+        if cpool_item.dbc is None:
+            cpool_item.dbc = self.open()
+            cpool_item.opened = now
+
+    def _discard_dbc(self, cpool_item):
+        dbc = cpool_item.dbc
+        cpool_item.dbc = None
+        with self.cpool_lock:
+            self.cpool_nreopened += 1
+        try:
+            self.close_connection(dbc)
+        except self.dbapi.Error as e:
+            logging.warning("Error closing database connection: %s", str(e))
+
+    def ping(self, connection):
+        """Tests a database connection
+
+        connection
+            A connection object returned by :py:meth:`open`
+
+        Returns True if the connection is usable, False otherwise. The
+        default implementation executes "SELECT 1", you may need to
+        override it if your database requires a different test
+        query."""
+        try:
+            c = connection.cursor()
+            try:
+                c.execute("SELECT 1")
+            finally:
+                c.close()
+            return True
+        except self.dbapi.Error:
+            return False
+
     def release_connection(self, release_item):
+        if self.cpool_queue is not None:
+            return self._release_queued_connection(release_item)
         thread_id = threading.current_thread().ident
         close_flag = False
         with self.cpool_lock:
@@ -4766,9 +5950,206 @@ class SQLEntityContainer(object):
         if close_flag:
             self.close_connection(release_item.dbc)
 
-    def connection_stats(self):
+    def _release_queued_connection(self, release_item):
+        thread = threading.current_thread()
+        if release_item.thread is not thread or not release_item.locked:
+            if not release_item.locked or release_item.thread is None:
+                logging.error(
+                    "Thread[%i] attempted to unlock un unknown database "
+                    "connection: %s", thread.ident, repr(release_item))
+                return
+            logging.error(
+                "Thread[%i] released database connection originally "
+                "acquired by Thread[%i]", thread.ident,
+                release_item.thread_id)
+        release_item.locked -= 1
+        release_item.last_seen = time.time()
+        if not release_item.locked:
+            if getattr(self.cpool_local, 'item', None) is release_item:
+                self.cpool_local.item = None
+            self._requeue(release_item)
+
+    def changeset(self):
+        """Returns a new :py:class:`SQLChangeset` for this container
+
+        Used to group a sequence of operations made by the current
+        thread into a single database transaction, typically to
+        implement the changesets in an OData batch request."""
+        return SQLChangeset(self)
+
+    def cached_sql(self, key):
+        """Returns a cached query
+
+        key
+            A hashable object that identifies the query, see
+            :py:meth:`SQLCollectionBase.cached_query` for details.
+
+        Returns a tuple of (query string, :py:class:`SQLBindingPlan`)
+        or None if there is no query with this key in the cache.  The
+        cache is managed on a least-recently-used basis."""
+        with self.sql_cache_lock:
+            result = self.sql_cache.pop(key, None)
+            if result is None:
+                self.sql_cache_misses += 1
+            else:
+                # re-insert to make this the most recently used
+                self.sql_cache[key] = result
+                self.sql_cache_hits += 1
+            return result
+
+    def cache_sql(self, key, query, plan):
+        """Adds a query to the cache
+
+        key
+            A hashable object that identifies the query
+
+        query
+            The query string
+
+        plan
+            The :py:class:`SQLBindingPlan` used to bind new parameter
+            values to the query.
+
+        If the cache is full the least recently used query is
+        discarded."""
+        if not self.sql_cache_size:
+            return
+        with self.sql_cache_lock:
+            self.sql_cache[key] = (query, plan)
+            while len(self.sql_cache) > self.sql_cache_size:
+                self.sql_cache.popitem(last=False)
+
+    def cached_count(self, query, params):
+        """Returns a cached count
+
+        query
+            A COUNT query string
+
+        params
+            The :py:class:`SQLParams` instance containing the query
+            parameters.
+
+        Returns the result of a previous execution of the same query
+        with the same parameters, provided it has not expired or been
+        invalidated, otherwise None."""
+        if not self.count_cache_ttl:
+            return None
+        key = self.count_key(query, params)
+        if key is None:
+            return None
+        with self.count_cache_lock:
+            result = self.count_cache.get(key, None)
+            if result is None:
+                return None
+            expires, count = result
+            if expires < time.time():
+                del self.count_cache[key]
+                return None
+            return count
+
+    def cache_count(self, query, params, count, generation=None):
+        """Adds the result of a COUNT query to the cache
+
+        query
+            The query string
+
+        params
+            The :py:class:`SQLParams` instance used to execute the query
+
+        count
+            The result of the query
+
+        generation (optional)
+            The value of :py:attr:`count_generation` read before the
+            query was executed.  If the counts have been invalidated
+            since then the count may be stale and it is not cached.
+
+        The count is cached for :py:attr:`count_cache_ttl` seconds."""
+        if not self.count_cache_ttl:
+            return
+        key = self.count_key(query, params)
+        if key is None:
+            return
+        with self.count_cache_lock:
+            if generation is not None and generation != self.count_generation:
+                return
+            self.count_cache[key] = (time.time() + self.count_cache_ttl,
+                                     count)
+
+    def count_key(self, query, params):
+        """Returns a hashable key for a query and its parameters
+
+        Returns None if the parameter values are not hashable."""
+        if isinstance(params.params, dict):
+            values = tuple(sorted(dict_items(params.params)))
+        else:
+            values = tuple(params.params)
+        key = (query, values)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def invalidate_counts(self):
+        """Invalidates all cached counts
+
+        Called automatically by :py:class:`SQLTransaction` when a
+        statement that modifies the database is executed and again when
+        the transaction is committed.  Counts are not tracked on a per
+        table basis as the COUNT queries may involve joins to other
+        tables.  Changes made by other processes are not detected, the
+        cached values will only reflect these changes after they
+        expire.
+
+        :py:attr:`count_generation` is incremented so that counts
+        obtained by queries that were already running are not added to
+        the cache, see :py:meth:`cache_count`."""
+        if not self.count_cache_ttl:
+            return
+        with self.count_cache_lock:
+            self.count_generation += 1
+            self.count_cache.clear()
+
+    def approximate_count(self, table_name, transaction):
+        """Returns an estimate of the number of rows in a table
+
+        table_name
+            The (quoted) name of the table
+
+        transaction
+            The :py:class:`SQLTransaction` to use for any queries.
+
+        Used when the container was created with approximate_counts set.
+        The default implementation returns None, indicating that no
+        estimate is available and the rows must be counted instead.
+        Derived classes should override this method for databases that
+        maintain suitable table statistics."""
+        return None
+
+    def sql_cache_stats(self):
+        """Return information about the SQL cache
+
+        Returns a triple of:
+
+        size
+            the number of queries in the cache
+
+        hits
+            the number of queries that were found in the cache
+
+        misses
+            the number of queries that had to be generated"""
+        with self.sql_cache_lock:
+            return (len(self.sql_cache), self.sql_cache_hits,
+                    self.sql_cache_misses)
+
+    def connection_stats(self, metrics=False):
         """Return information about the connection pool
 
+        metrics (optional)
+            A flag, defaults to False.  See below.
+
         Returns a triple of:
 
         nlocked
@@ -4782,11 +6163,58 @@ class SQLEntityContainer(object):
 
         Connections are placed in the 'dead pool' when unexpected lock
         failures occur or if they are locked and the owning thread is
-        detected to have terminated without releasing them."""
+        detected to have terminated without releasing them.  When using
+        the queue pool, nunlocked is the number of connections in the
+        queue and nidle is always 0.
+
+        If metrics is True then a dictionary is returned instead.  In
+        addition to the above three values (keyed on their names) the
+        dictionary contains:
+
+        nacquired
+            the number of times a thread acquired a connection it did
+            not already hold
+
+        ntimeouts
+            the number of times a thread timed out waiting for a
+            connection
+
+        nwaits
+            the number of times a thread had to wait for a connection
+
+        wait_time
+            the total time, in seconds, spent waiting for connections
+
+        max_wait
+            the longest time, in seconds, a thread has waited for a
+            connection
+
+        nreopened
+            the number of connections closed and reopened by
+            :py:meth:`check_connection`"""
         with self.cpool_lock:
             # we have exclusive use of the cpool members
-            return (len(self.cpool_locked), len(self.cpool_unlocked),
-                    len(self.cpool_idle))
+            nacquired = self.cpool_nacquired
+            if self.cpool_queue is None:
+                result = (len(self.cpool_locked), len(self.cpool_unlocked),
+                          len(self.cpool_idle))
+            else:
+                cpool_items = list(self.cpool_items)
+                result = (len([i for i in cpool_items if i.locked]),
+                          self.cpool_queue.qsize(), 0)
+                nacquired += sum(i.nacquired for i in cpool_items)
+            if not metrics:
+                return result
+            return {
+                'nlocked': result[0],
+                'nunlocked': result[1],
+                'nidle': result[2],
+                'nacquired': nacquired,
+                'ntimeouts': self.cpool_ntimeouts,
+                'nwaits': self.cpool_nwaits,
+                'wait_time': self.cpool_wait_time,
+                'max_wait': self.cpool_max_wait,
+                'nreopened': self.cpool_nreopened}
 
     def _run_pool_cleaner(self, max_idle=SQL_TIMEOUT * 10.0):
         run_time = max_idle / 5.0
@@ -4806,6 +6234,9 @@ class SQLEntityContainer(object):
         now = time.time()
         old_time = now - max_idle
         to_close = []
+        if self.cpool_queue is not None:
+            self._queue_pool_cleaner(old_time)
+            return
         with self.cpool_lock:
             locked_list = list(dict_values(self.cpool_locked))
             for cpool_item in locked_list:
@@ -4848,6 +6279,34 @@ class SQLEntityContainer(object):
             if dbc is not None:
                 self.close_connection(dbc)
 
+    def _queue_pool_cleaner(self, old_time):
+        to_close = []
+        for cpool_item in list(self.cpool_items):
+            thread = cpool_item.thread
+            if (cpool_item.locked and thread is not None and
+                    not thread.is_alive()):
+                logging.error(
+                    "Thread[%i] failed to release database connection "
+                    "before terminating", cpool_item.thread_id)
+                to_close.append(cpool_item.dbc)
+                cpool_item.dbc = None
+                self._requeue(cpool_item)
+        # cycle through the queue once, closing idle connections
+        for i in range3(self.cpool_queue.qsize()):
+            try:
+                cpool_item = self.cpool_queue.get_nowait()
+            except queue.Empty:
+                break
+            if (cpool_item.dbc is not None and
+                    cpool_item.last_seen <= old_time):
+                logging.info("pool_cleaner removed idle connection")
+                to_close.append(cpool_item.dbc)
+                cpool_item.dbc = None
+            self.cpool_queue.put(cpool_item)
+        for dbc in to_close:
+            if dbc is not None:
+                self.close_connection(dbc)
+
     def open(self):
         """Creates and returns a new connection object.
 
@@ -4903,6 +6362,8 @@ class SQLEntityContainer(object):
         thread_id = threading.current_thread().ident
         to_close = []
         self.closing.set()
+        if self.cpool_queue is not None:
+            return self._close_queue_pool(timeout)
         with self.cpool_lock:
             nlocked = None
             while True:
@@ -4958,6 +6419,67 @@ class SQLEntityContainer(object):
             if dbc is not None:
                 self.close_connection(dbc)
 
+    def _close_queue_pool(self, timeout):
+        thread = threading.current_thread()
+        to_close = []
+        closed = set()
+        nlocked = None
+        while True:
+            while True:
+                try:
+                    cpool_item = self.cpool_queue.get_nowait()
+                except queue.Empty:
+                    break
+                closed.add(cpool_item)
+                to_close.append(cpool_item.dbc)
+            locked_list = []
+            for cpool_item in list(self.cpool_items):
+                if cpool_item in closed:
+                    continue
+                owner = cpool_item.thread
+                if owner is thread:
+                    logging.error(
+                        "Thread[%i] failed to release database connection "
+                        "before closing container", cpool_item.thread_id)
+                elif owner is not None and not owner.is_alive():
+                    logging.error(
+                        "Thread[%i] failed to release database connection "
+                        "before terminating", cpool_item.thread_id)
+                else:
+                    if owner is not None:
+                        # thread is alive, try and interrupt it if it is
+                        # stuck in a slow query
+                        self.break_connection(cpool_item.dbc)
+                    locked_list.append(cpool_item)
+                    continue
+                closed.add(cpool_item)
+                to_close.append(cpool_item.dbc)
+            if locked_list and (nlocked is None or
+                                nlocked > len(locked_list)):
+                # wait while the number of locked connections is
+                # shrinking
+                nlocked = len(locked_list)
+                logging.warning(
+                    "Waiting to break unreleased database connections")
+                try:
+                    cpool_item = self.cpool_queue.get(True, timeout)
+                    closed.add(cpool_item)
+                    to_close.append(cpool_item.dbc)
+                except queue.Empty:
+                    pass
+                continue
+            # we're not getting anywhere, force-close these connections
+            for cpool_item in locked_list:
+                logging.error(
+                    "Thread[%i] failed to release database connection: "
+                    "forcing it to close", cpool_item.thread_id)
+                to_close.append(cpool_item.dbc)
+            break
+        self.cpool_items = []
+        for dbc in to_close:
+            if dbc is not None:
+                self.close_connection(dbc)
+
     def quote_identifier(self, identifier):
         """Given an *identifier* returns a safely quoted form of it.
 
@@ -5413,6 +6935,25 @@ class SQLiteEntityContainer(SQLEntityContainer):
         """Calls the underlying interrupt method."""
         connection.interrupt()
 
+    def approximate_count(self, table_name, transaction):
+        """Uses the statistics gathered by SQLite's ANALYZE command
+
+        The number of rows is read from the sqlite_stat1 table.  If the
+        table has not been analyzed then None is returned."""
+        params = self.ParamsClass()
+        transaction.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND "
+            "name='sqlite_stat1'", params)
+        if transaction.cursor.fetchone() is None:
+            return None
+        transaction.execute(
+            "SELECT stat FROM sqlite_stat1 WHERE tbl=%s" %
+            params.add_param(table_name[1:-1]), params)
+        row = transaction.cursor.fetchone()
+        if row is None or not row[0]:
+            return None
+        return int(row[0].split()[0])
+
     def close_connection(self, connection):
         """Calls the underlying close method."""
         if self.sqlite_memdbc is None:
@@ -2,15 +2,12 @@
 """Creates an OData in-memory cache of key value pairs"""
 
 import logging
-import threading
 import time
 
 from wsgiref.simple_server import make_server
 
 from pyslet import iso8601 as iso
 from pyslet.odata2 import metadata as edmx
-from pyslet.odata2 import core as core
-from pyslet.odata2 import csdl as edm
 from pyslet.odata2.memds import InMemoryEntityContainer
 from pyslet.odata2.server import Server
 from pyslet.py2 import character, output, range3
@@ -18,7 +15,6 @@ from pyslet.py2 import character, output, range3
 
 SERVICE_PORT = 8080
 SERVICE_ROOT = "http://localhost:%i/" % SERVICE_PORT
-CLEANUP_SLEEP = 10
 
 
 cache_app = None       #: our Server instance
@@ -63,45 +59,22 @@ def run_cache_server():
     server.serve_forever()
 
 
-def cleanup_forever(mem_cache):
-    """Runs a loop continuously cleaning up expired items"""
-    now = edm.DateTimeValue()
-    expires = core.PropertyExpression("Expires")
-    t = core.LiteralExpression(now)
-    filter = core.BinaryExpression(core.Operator.lt)
-    filter.operands.append(expires)
-    filter.operands.append(t)
-    while True:
-        now.set_from_value(iso.TimePoint.from_now_utc())
-        logging.info("Cleanup thread running at %s", str(now.value))
-        with mem_cache.open() as cacheEntries:
-            cacheEntries.set_filter(filter)
-            expired_list = list(cacheEntries)
-            if expired_list:
-                logging.info("Cleaning %i cache entries", len(expired_list))
-                for expired in expired_list:
-                    del cacheEntries[expired]
-            cacheEntries.set_filter(None)
-            logging.info(
-                "Cleanup complete, %i cache entries remain", len(cacheEntries))
-        time.sleep(CLEANUP_SLEEP)
-
-
 def main():
     """Executed when we are launched"""
     doc = load_metadata()
-    InMemoryEntityContainer(doc.root.DataServices['MemCacheSchema.MemCache'])
+    container = InMemoryEntityContainer(
+        doc.root.DataServices['MemCacheSchema.MemCache'], row_view=True)
+    # entries are deleted automatically when they expire
+    container.entityStorage['KeyValuePairs'].set_expiry(pname='Expires')
     server = Server(serviceRoot=SERVICE_ROOT)
     server.set_model(doc)
+    # memory use can be monitored at <service root>/$diagnostics
+    server.set_diagnostics(container.stats)
     # The server is now ready to serve forever
     global cache_app
     cache_app = server
-    t = threading.Thread(target=run_cache_server)
-    t.setDaemon(True)
-    t.start()
     logging.info("MemCache starting HTTP server on %s" % SERVICE_ROOT)
-    cleanup_forever(
-        doc.root.DataServices['MemCacheSchema.MemCache.KeyValuePairs'])
+    run_cache_server()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,157 @@
+#! /usr/bin/env python
+"""Benchmarks for the in-memory data layer
+
+These tests are not part of the main test suite as they take some time
+to run.  Run this module directly to see the results, e.g.::
+
+    python bench_odata2_memds.py
+
+Reading an entity by key is pure Python and holds the GIL throughout
+so the reader/writer lock makes little difference to test_readers, it
+is there to measure the overhead.  The reader/writer lock pays off when
+readers hold the lock while doing something that releases the GIL,
+test_dump_readers streams the container to a slow output and checks
+that concurrent dumps are not serialised."""
+
+import logging
+import threading
+import time
+import unittest
+
+from pyslet.odata2 import memds
+from pyslet.odata2 import metadata as edmx
+from pyslet.py2 import range3
+from pyslet.vfs import OSFilePath as FilePath
+
+
+TEST_DATA_DIR = FilePath(
+    FilePath(__file__).abspath().split()[0],
+    'data_odatav2')
+
+#: the number of rows in the benchmark entity set
+NROWS = 1000
+
+#: the number of reads made by each thread
+NREADS = 2000
+
+#: the number of dumps made by each thread
+NDUMPS = 5
+
+#: the delay, in seconds, for each write to a slow output
+WRITE_DELAY = 0.005
+
+
+def suite():
+    loader = unittest.TestLoader()
+    loader.testMethodPrefix = 'test'
+    return unittest.TestSuite((
+        loader.loadTestsFromTestCase(ConcurrencyBenchmarks),
+    ))
+
+
+def load_tests(loader, tests, pattern):
+    return suite()
+
+
+class ConcurrencyBenchmarks(unittest.TestCase):
+
+    def setUp(self):  # noqa
+        self.doc = edmx.Document()
+        md_path = TEST_DATA_DIR.join('sample_server', 'metadata.xml')
+        with md_path.open('rb') as f:
+            self.doc.read(f)
+        self.container = self.doc.root.DataServices[
+            "SampleModel.SampleEntities"]
+
+    def load(self, **kwargs):
+        db = memds.InMemoryEntityContainer(self.container, **kwargs)
+        with self.container['Employees'].open() as collection:
+            for i in range3(NROWS):
+                e = collection.new_entity()
+                e.set_key('%05i' % i)
+                e["EmployeeName"].set_from_value('Employee %i' % i)
+                e["Address"]["Street"].set_from_value('%i Factory Lane' % i)
+                e["Address"]["City"].set_from_value('Chunton')
+                collection.insert_entity(e)
+        return db
+
+    def report(self, name, nreads, elapsed):
+        rate = nreads / elapsed if elapsed else 0.0
+        logging.warning("%s: %i reads in %.3fs (%.0f reads/s)", name,
+                        nreads, elapsed, rate)
+        return rate
+
+    def report_ratios(self, name, rates, rw_rates):
+        for nthreads in sorted(rates):
+            ratio = rw_rates[nthreads] / rates[nthreads]
+            logging.warning("%s (%i threads): rw_lock/lock = %.2f", name,
+                            nthreads, ratio)
+
+    def read_worker(self, writes=False):
+        with self.container['Employees'].open() as collection:
+            for i in range3(NREADS):
+                e = collection['%05i' % (i % NROWS)]
+                if writes and i % 100 == 0:
+                    collection.update_entity(e)
+
+    def dump_worker(self, db):
+        for i in range3(NDUMPS):
+            db.dump(SlowOutput())
+
+    def run_threads(self, name, nthreads, target=None, nreads=NREADS,
+                    **kwargs):
+        if target is None:
+            target = self.read_worker
+        threads = [threading.Thread(target=target, kwargs=kwargs)
+                   for i in range3(nthreads)]
+        t = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report("%s (%i threads)" % (name, nthreads),
+                           nthreads * nreads, time.time() - t)
+
+    def test_readers(self):
+        rates = {}
+        for rw_lock in (False, True):
+            self.load(rw_lock=rw_lock)
+            name = "rw_lock" if rw_lock else "lock"
+            rates[rw_lock] = {}
+            for nthreads in (1, 2, 4, 8):
+                rates[rw_lock][nthreads] = self.run_threads(name, nthreads)
+            for nthreads in (1, 2, 4, 8):
+                self.run_threads(name + " with 1% writes", nthreads,
+                                 writes=True)
+        self.report_ratios("readers", rates[False], rates[True])
+
+    def test_dump_readers(self):
+        rates = {}
+        for rw_lock in (False, True):
+            db = self.load(rw_lock=rw_lock)
+            name = "dump with rw_lock" if rw_lock else "dump with lock"
+            rates[rw_lock] = {}
+            for nthreads in (1, 2, 4, 8):
+                rates[rw_lock][nthreads] = self.run_threads(
+                    name, nthreads, self.dump_worker, NDUMPS, db=db)
+        self.report_ratios("dump", rates[False], rates[True])
+        # the slow writes are made holding the read lock, with a plain
+        # lock the dumps are serialised
+        self.assertTrue(rates[True][8] > 2 * rates[False][8])
+
+
+class SlowOutput(object):
+
+    """A binary output that waits before each write
+
+    Simulates a slow consumer, such as a network connection, sleeping
+    releases the GIL just like real I/O."""
+
+    def write(self, data):
+        time.sleep(WRITE_DELAY)
+        return len(data)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    unittest.main()
@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+"""Benchmarks for the SQL data layer
+
+These tests are not part of the main test suite as they take some time
+to run.  Run this module directly to see the results, e.g.::
+
+    python bench_odata2_sqlds.py"""
+
+import logging
+import time
+import unittest
+
+from pyslet.odata2 import metadata as edmx
+from pyslet.odata2 import sqlds
+from pyslet.py2 import range3
+from pyslet.vfs import OSFilePath as FilePath
+
+
+TEST_DATA_DIR = FilePath(
+    FilePath(__file__).abspath().split()[0],
+    'data_odatav2')
+
+#: the number of rows in the benchmark table
+NROWS = 100000
+
+
+def suite():
+    loader = unittest.TestLoader()
+    loader.testMethodPrefix = 'test'
+    return unittest.TestSuite((
+        loader.loadTestsFromTestCase(ReadBenchmarks),
+    ))
+
+
+def load_tests(loader, tests, pattern):
+    return suite()
+
+
+class ReadBenchmarks(unittest.TestCase):
+
+    def setUp(self):  # noqa
+        self.doc = edmx.Document()
+        md_path = TEST_DATA_DIR.join('sample_server', 'metadata.xml')
+        with md_path.open('rb') as f:
+            self.doc.read(f)
+        self.container = self.doc.root.DataServices[
+            "SampleModel.SampleEntities"]
+        self.d = FilePath.mkdtemp('.d', 'pyslet-bench_odata2_sqlds-')
+        self.db = sqlds.SQLiteEntityContainer(
+            file_path=self.d.join('bench.db'),
+            container=self.container)
+        es = self.container['Employees']
+        with es.open() as collection:
+            collection.create_table()
+            employees = []
+            for i in range3(NROWS):
+                e = collection.new_entity()
+                e.set_key('%05i' % i)
+                e["EmployeeName"].set_from_value('Employee %i' % i)
+                e["Address"]["Street"].set_from_value('%i Factory Lane' % i)
+                e["Address"]["City"].set_from_value('Chunton')
+                employees.append(e)
+            t = time.time()
+            collection.insert_entities(employees, batch_size=1000)
+            self.report("insert_entities", NROWS, time.time() - t)
+
+    def tearDown(self):  # noqa
+        self.db.close()
+        self.d.rmtree(True)
+
+    def report(self, name, nrows, elapsed):
+        logging.warning("%s: %i rows in %.3fs (%.0f rows/s)", name, nrows,
+                        elapsed, nrows / elapsed if elapsed else 0.0)
+
+    def test_read_rows(self):
+        es = self.container['Employees']
+        for fetch_size in (1, 100, 1000):
+            with es.open() as collection:
+                collection.FETCH_SIZE = fetch_size
+                t = time.time()
+                n = 0
+                for e in collection.itervalues():
+                    n += 1
+                self.report("itervalues (FETCH_SIZE=%i)" % fetch_size, n,
+                            time.time() - t)
+                self.assertTrue(n == NROWS)
+        with es.open() as collection:
+            collection.set_page(None)
+            collection.set_topmax(NROWS)
+            t = time.time()
+            n = 0
+            for e in collection.iterpage():
+                n += 1
+            self.report("iterpage", n, time.time() - t)
+            self.assertTrue(n == NROWS)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    unittest.main()
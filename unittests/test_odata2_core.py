@@ -48,7 +48,20 @@ class CommonExpressionTests(unittest.TestCase):
     def evaluate_common(self, expr_string):
         p = odata.Parser(expr_string)
         e = p.parse_common_expression()
-        return e.evaluate(None)
+        result = e.evaluate(None)
+        # cross check with the compiled form of the expression
+        try:
+            f, type_code = e.compile(lambda path: None)
+        except NotImplementedError:
+            return result
+        if isinstance(result, edm.SimpleValue):
+            value = f(None)
+            self.assertTrue(value == result.value,
+                            "compiled %s: %s" % (expr_string, repr(value)))
+            if result:
+                self.assertTrue(type_code == result.type_code,
+                                "compiled type of %s" % expr_string)
+        return result
 
     def test_confusing_identifiers(self):
         p = odata.Parser("X and binary and Binary")
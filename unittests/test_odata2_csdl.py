@@ -608,6 +608,63 @@ class EntityTests(unittest.TestCase):
         # doesn't touch the key!
         self.assertTrue(e.key() == "abc")
 
+    def test_order_entities(self):
+        entities = []
+        for key, name, region in (
+                ('a', 'Widget Co', 1), ('b', 'Gadget Co', 2),
+                ('c', 'Widget Co', None), ('d', 'Gadget Co', 2),
+                ('e', 'Widget Co', 3), ('f', None, 1)):
+            e = edm.Entity(self.es)
+            e.set_key(key)
+            e['Name'].set_from_value(name)
+            e['Region'].set_from_value(region)
+            entities.append(e)
+        sorted_lists = []
+
+        class MockCollection(edm.EntityCollection):
+
+            def itervalues(self):
+                return self.order_entities(iter(entities[::-1]))
+
+            def calculate_order_key(self, entity, order_object):
+                return entity[order_object].value
+
+            def order_entities(self, entity_iterable):
+                sorted_lists.append(self.page_limit)
+                return super(MockCollection, self).order_entities(
+                    entity_iterable)
+
+        coll = MockCollection(entity_set=self.es)
+        # no ordering, no sort
+        self.assertTrue([e.key() for e in coll.itervalues()] ==
+                        ['f', 'e', 'd', 'c', 'b', 'a'])
+        coll.set_orderby([('Name', 1), ('Region', -1)])
+        # sort is stable when not paging, NULLs sort first
+        self.assertTrue([e.key() for e in coll.itervalues()] ==
+                        ['f', 'd', 'b', 'e', 'a', 'c'])
+        coll.set_orderby([('Region', -1)])
+        self.assertTrue([e.key() for e in coll.itervalues()] ==
+                        ['e', 'd', 'b', 'f', 'a', 'c'])
+        # paging adds the key to the sort order
+        coll.set_page(3, 1)
+        self.assertTrue([e.key() for e in coll.iterpage()] ==
+                        ['b', 'd', 'a'])
+        # we needed 5 entities to fill the page
+        self.assertTrue(sorted_lists[-1] == 5)
+        coll.set_orderby(None)
+        coll.set_page(2)
+        self.assertTrue([e.key() for e in coll.iterpage()] == ['a', 'b'])
+        coll.set_page(None)
+        self.assertTrue([e.key() for e in coll.iterpage()] ==
+                        ['a', 'b', 'c', 'd', 'e', 'f'])
+        self.assertTrue(sorted_lists[-1] is None)
+        self.assertTrue(edm.OrderKey([1, None], [1, 1]) <
+                        edm.OrderKey([1, 2], [1, 1]))
+        self.assertFalse(edm.OrderKey([1, None], [1, -1]) <
+                         edm.OrderKey([1, 2], [1, -1]))
+        self.assertFalse(edm.OrderKey([1, 2], [1, 1]) <
+                         edm.OrderKey([1, 2], [1, 1]))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,12 +1,17 @@
 #! /usr/bin/env python
 
+import io
+import threading
+import time
 import unittest
 
+import pyslet.iso8601 as iso
+import pyslet.odata2.core as odata
 import pyslet.odata2.csdl as edm
 import pyslet.odata2.edmx as edmx
 
 from pyslet.odata2 import memds
-from pyslet.py2 import ul
+from pyslet.py2 import range3, ul
 from pyslet.vfs import OSFilePath as FilePath
 
 from test_odata2_core import DataServiceRegressionTests
@@ -17,7 +22,10 @@ def suite():
     loader.testMethodPrefix = 'test'
     return unittest.TestSuite((
         loader.loadTestsFromTestCase(MemDSTests),
-        loader.loadTestsFromTestCase(RegressionTests)
+        loader.loadTestsFromTestCase(RegressionTests),
+        loader.loadTestsFromTestCase(IndexedRegressionTests),
+        loader.loadTestsFromTestCase(RowViewRegressionTests),
+        loader.loadTestsFromTestCase(RWLockRegressionTests)
     ))
 
 
@@ -69,6 +77,644 @@ class MemDSTests(unittest.TestCase):
         self.employees.data["FGHIJ"] = (ul("FGHIJ"), ul("Jane Smith"), None,
                                         None)
 
+    def test_index(self):
+        es = self.schema['SampleEntities.Employees']
+        with es.open() as collection:
+            for i in range3(20):
+                e = collection.new_entity()
+                e.set_key('%05i' % i)
+                e['EmployeeName'].set_from_value(
+                    ul('Employee %i') % (i % 5))
+                e['Address']['City'].set_from_value(ul('Chunton'))
+                collection.insert_entity(e)
+        # add the index after some data exists
+        index = self.employees.add_index('EmployeeName')
+        self.assertTrue(self.employees.add_index('EmployeeName') is index)
+        try:
+            self.employees.add_index('Address')
+            self.fail("Index on complex property")
+        except ValueError:
+            pass
+        self.assertTrue(index.lookup(odata.Operator.eq, 'Employee 3') ==
+                        ['00003', '00008', '00013', '00018'])
+        self.assertTrue(len(index.lookup(odata.Operator.lt,
+                                         'Employee 3')) == 12)
+        self.assertTrue(len(index.lookup(odata.Operator.ge,
+                                         'Employee 3')) == 8)
+        with es.open() as collection:
+            e = collection.new_entity()
+            e.set_key('00020')
+            e['EmployeeName'].set_from_value(ul('Employee 3'))
+            collection.insert_entity(e)
+            e = collection['00003']
+            e['EmployeeName'].set_from_value(ul('Employee X'))
+            collection.update_entity(e)
+            del collection['00008']
+            self.assertTrue(index.lookup(odata.Operator.eq, 'Employee 3') ==
+                            ['00013', '00018', '00020'])
+            collection.set_filter(odata.CommonExpression.from_str(
+                "'Employee 3' eq EmployeeName and "
+                "substringof('1', EmployeeID)"))
+            self.assertTrue(list(collection) == ['00013', '00018'])
+            self.assertTrue(len(collection) == 2)
+            collection.set_filter(odata.CommonExpression.from_str(
+                "EmployeeName gt 'Employee 3'"))
+            self.assertTrue(len(collection) == 5)
+            collection.set_filter(None)
+            collection.set_orderby(
+                odata.CommonExpression.orderby_from_str("EmployeeName desc"))
+            result = list(collection)
+            self.assertTrue(result[:5] == ['00003', '00004', '00009',
+                                           '00014', '00019'], result)
+            # the index is used to generate the first page
+            collection.set_topmax(3)
+            collection.set_page(None)
+            self.assertTrue([e.key() for e in collection.iterpage()] ==
+                            ['00003', '00004', '00009'])
+            collection.set_orderby(
+                odata.CommonExpression.orderby_from_str("EmployeeName"))
+            collection.set_page(None)
+            self.assertTrue([e.key() for e in collection.iterpage()] ==
+                            ['00000', '00005', '00010'])
+
+    def test_compiled_filter(self):
+        es = self.schema['SampleEntities.Employees']
+        with es.open() as collection:
+            for i in range3(20):
+                e = collection.new_entity()
+                e.set_key('%05i' % i)
+                e['EmployeeName'].set_from_value(
+                    ul('Employee %i') % (i % 5))
+                if i % 3:
+                    e['Address']['City'].set_from_value(ul('Chunton'))
+                collection.insert_entity(e)
+            for f, compiled, n in (
+                    ("EmployeeName eq 'Employee 3'", True, 4),
+                    ("Address/City eq 'Chunton'", True, 13),
+                    ("Address/City eq null", True, 7),
+                    ("startswith(EmployeeID, '0001') and "
+                     "not endswith(EmployeeName, '1')", True, 8),
+                    ("length(EmployeeName) add 1 gt 10 or "
+                     "tolower(Address/City) eq 'chunton'", True, 20),
+                    ("Address/City lt 'D'", True, 13),
+                    ("EmployeeName", False, None),
+                    ("substring(EmployeeName, 9) eq '3'", False, 4),
+                    ("isof('SampleModel.Employee')", False, 20)):
+                filter = odata.CommonExpression.from_str(f)
+                collection.set_filter(filter)
+                self.assertTrue(
+                    (collection.filter_function is not None) == compiled, f)
+                if n is None:
+                    continue
+                self.assertTrue(len(collection) == n, f)
+                result = list(collection)
+                self.assertTrue(len(result) == n, f)
+                for k in result:
+                    self.assertTrue(collection[k].key() == k)
+                # compare with the uncompiled filter
+                collection.filter_function = None
+                self.assertTrue(len(collection) == n, f)
+                self.assertTrue(sorted(collection) == sorted(result), f)
+
+    def test_row_view(self):
+        container = memds.InMemoryEntityContainer(self.containerDef,
+                                                  row_view=True)
+        employees = container.entityStorage['Employees']
+        self.assertTrue(employees.row_view)
+        es = self.containerDef['Employees']
+        with es.open() as collection:
+            for i in range3(3):
+                e = collection.new_entity()
+                e.set_key('%05i' % i)
+                e['EmployeeName'].set_from_value(ul('Employee %i') % i)
+                e['Address']['City'].set_from_value(ul('Chunton'))
+                collection.insert_entity(e)
+            e = collection['00001']
+            self.assertTrue(isinstance(e, memds.RowEntity))
+            self.assertTrue(e.exists)
+            # no values are created to obtain the key
+            self.assertTrue(e.key() == '00001')
+            self.assertTrue(len(e.data) == 0)
+            self.assertTrue(e['EmployeeName'].value == 'Employee 1')
+            self.assertTrue(e['Address']['City'].value == 'Chunton')
+            self.assertTrue(len(e.data) == 2)
+            self.assertTrue(e['EmployeeName'] is e['EmployeeName'])
+            # modify and commit as normal
+            e['EmployeeName'].set_from_value(ul('Employee X'))
+            collection.update_entity(e)
+            self.assertTrue(collection['00001']['EmployeeName'].value ==
+                            'Employee X')
+            # unselected values are NULL
+            collection.set_expand(None, {'EmployeeName': None})
+            e = collection['00002']
+            self.assertTrue(e['EmployeeName'].value == 'Employee 2')
+            self.assertFalse(e['Address']['City'])
+            self.assertTrue(e['EmployeeID'].value == '00002')
+            e = collection['00000']
+            e.expand(None, {'Address': None})
+            self.assertFalse(e['EmployeeName'])
+            self.assertTrue(e['Address']['City'].value == 'Chunton')
+            self.assertTrue(sorted(e.key() for e in collection.values()) ==
+                            ['00000', '00001', '00002'])
+
+    def test_snapshot(self):
+        es = self.schema['SampleEntities.Employees']
+        with es.open() as collection:
+            for i in range3(5):
+                e = collection.new_entity()
+                e.set_key('%05i' % i)
+                e['EmployeeName'].set_from_value(ul('Employee %i') % i)
+                collection.insert_entity(e)
+            data = self.employees.data
+            segments = list(data._segments)
+            # no snapshot in use, writers don't copy
+            e = collection['00000']
+            collection.update_entity(e)
+            self.assertTrue(all(a is b for a, b in
+                                zip(data._segments, segments)))
+            snapshot = self.employees.snapshot()
+            result = []
+            for e in collection.itervalues():
+                if not result:
+                    # changes made during the iteration are not seen
+                    del collection['00003']
+                    # only the segment that was changed is copied
+                    copied = [i for i, segment in enumerate(segments)
+                              if data._segments[i] is not segment]
+                    self.assertTrue(len(copied) == 1)
+                    new_e = collection.new_entity()
+                    new_e.set_key('00005')
+                    collection.insert_entity(new_e)
+                    e4 = collection['00004']
+                    e4['EmployeeName'].set_from_value(ul('Employee X'))
+                    collection.update_entity(e4)
+                result.append((e.key(), e['EmployeeName'].value))
+            self.assertTrue(len(result) == 5)
+            self.assertTrue(('00003', 'Employee 3') in result)
+            self.assertTrue(('00004', 'Employee 4') in result)
+            # the snapshot was not modified
+            self.assertTrue(len(snapshot) == 5)
+            self.assertTrue(sorted(snapshot) ==
+                            ['00000', '00001', '00002', '00003', '00004'])
+            self.assertTrue(snapshot['00004'][1] == 'Employee 4')
+            try:
+                snapshot['00006'] = snapshot['00004']
+                self.fail("snapshots are read only")
+            except TypeError:
+                pass
+            self.assertTrue(sorted(collection) ==
+                            ['00000', '00001', '00002', '00004', '00005'])
+            # once copied, a segment is modified in place
+            collection.update_entity(e4)
+            segments = list(data._segments)
+            collection.update_entity(e4)
+            self.assertTrue(all(a is b for a, b in
+                                zip(data._segments, segments)))
+
+    def test_segmented_dict(self):
+        data = memds.SegmentedDict()
+        for i in range3(1000):
+            data[i] = str(i)
+        self.assertTrue(len(data) == 1000)
+        # segments are split as the dictionary grows
+        nsegments = len(data._segments)
+        self.assertTrue(nsegments > memds.SegmentedDict.MIN_SEGMENTS)
+        self.assertTrue(1000 <= memds.SegmentedDict.SEGMENT_SIZE * nsegments)
+        snapshot = data.snapshot()
+        data[1000] = '1000'
+        self.assertTrue(data.pop(0) == '0')
+        self.assertTrue(data.pop(0, None) is None)
+        del data[1]
+        # a write copies at most one segment
+        self.assertTrue(len([i for i in range3(nsegments)
+                             if data._segments[i] is not
+                             snapshot._segments[i]]) <= 3)
+        self.assertTrue(len(data) == 999)
+        self.assertTrue(len(snapshot) == 1000)
+        self.assertTrue(0 in snapshot and 0 not in data)
+        self.assertTrue(1000 in data and 1000 not in snapshot)
+        self.assertTrue(sorted(data) == list(range3(2, 1001)))
+        self.assertTrue(sorted(snapshot.values(), key=int) ==
+                        [str(i) for i in range3(1000)])
+        self.assertTrue(dict(data.items()) ==
+                        dict((i, str(i)) for i in range3(2, 1001)))
+        self.assertTrue(memds.SegmentedDict(data) == data)
+        self.assertFalse(snapshot == data)
+        self.assertTrue(data.get(1) is None)
+        self.assertTrue(snapshot.get(1) == '1')
+
+    def test_dump_restore(self):
+        employees = self.containerDef['Employees']
+        with employees.open() as collection:
+            for i in range3(3):
+                e = collection.new_entity()
+                e.set_key('%05i' % i)
+                e['EmployeeName'].set_from_value(ul('Employee %i') % i)
+                collection.insert_entity(e)
+        with self.containerDef['Customers'].open() as collection:
+            customer = collection.new_entity()
+            customer.set_key('ALFKI')
+            customer['CompanyName'].set_from_value(ul('Widget Inc'))
+            collection.insert_entity(customer)
+        with self.containerDef['Orders'].open() as collection:
+            for i in range3(2):
+                order = collection.new_entity()
+                order.set_key(i)
+                collection.insert_entity(order)
+                with customer['Orders'].open() as orders:
+                    orders[i] = order
+        documents = self.container.entityStorage['Documents']
+        documents.update_entity_stream(1, b'Hello', odata.StreamInfo())
+        self.employees.add_index('EmployeeName')
+        snapshot = io.BytesIO()
+        self.container.dump(snapshot)
+        log = io.BytesIO()
+        self.container.set_log(log)
+        with employees.open() as collection:
+            e = collection.new_entity()
+            e.set_key('00003')
+            e['EmployeeName'].set_from_value(ul('Employee 3'))
+            collection.insert_entity(e)
+            del collection['00000']
+            e = collection['00001']
+            e['EmployeeName'].set_from_value(ul('Employee X'))
+            collection.update_entity(e)
+        with customer['Orders'].open() as orders:
+            del orders[1]
+        documents.update_entity_stream(1, b'World', odata.StreamInfo())
+        self.container.set_log(None)
+        # create a new container, rebinding the entity sets
+        container = memds.InMemoryEntityContainer(self.containerDef)
+        new_employees = container.entityStorage['Employees']
+        index = new_employees.add_index('EmployeeName')
+        snapshot.seek(0)
+        container.restore(snapshot)
+        self.assertTrue(sorted(new_employees.data) ==
+                        ['00000', '00001', '00002'])
+        self.assertTrue(index.lookup(odata.Operator.eq, 'Employee 0') ==
+                        ['00000'])
+        with customer['Orders'].open() as orders:
+            self.assertTrue(sorted(orders) == [0, 1])
+        log.seek(0)
+        self.assertTrue(container.replay_log(log) == 5)
+        self.assertTrue(new_employees.data == self.employees.data)
+        self.assertTrue(index.lookup(odata.Operator.eq, 'Employee 0') == [])
+        self.assertTrue(index.lookup(odata.Operator.eq, 'Employee X') ==
+                        ['00001'])
+        with employees.open() as collection:
+            self.assertTrue(sorted(collection) ==
+                            ['00001', '00002', '00003'])
+            self.assertTrue(collection['00001']['EmployeeName'].value ==
+                            'Employee X')
+        with customer['Orders'].open() as orders:
+            self.assertTrue(sorted(orders) == [0])
+        for name, aindex in container.associationStorage.items():
+            old_aindex = self.container.associationStorage[name]
+            self.assertTrue(aindex.index == old_aindex.index)
+            self.assertTrue(aindex.reverseIndex == old_aindex.reverseIndex)
+        stream, sinfo = container.entityStorage['Documents'].streams[1]
+        self.assertTrue(stream == b'World')
+        # a truncated final record is ignored
+        container = memds.InMemoryEntityContainer(self.containerDef)
+        snapshot.seek(0)
+        container.restore(snapshot)
+        log = io.BytesIO(log.getvalue()[:-1])
+        self.assertTrue(container.replay_log(log) == 4)
+        stream, sinfo = container.entityStorage['Documents'].streams[1]
+        self.assertTrue(stream == b'Hello')
+        # unsupported versions are rejected
+        container.DUMP_VERSION = 2
+        snapshot.seek(0)
+        try:
+            container.restore(snapshot)
+            self.fail("restore with bad version")
+        except ValueError:
+            pass
+
+    def test_expiry(self):
+        orders = self.container.entityStorage['Orders']
+        try:
+            orders.set_expiry(pname='OrderID')
+            self.fail("Expiry on Int32 property")
+        except ValueError:
+            pass
+        orders.set_expiry(ttl=60, pname='ShippedDate')
+        now = time.time()
+        with self.containerDef['Orders'].open() as collection:
+            for i in range3(4):
+                order = collection.new_entity()
+                order.set_key(i)
+                if i < 2:
+                    # order 0 has expired already
+                    order['ShippedDate'].set_from_value(
+                        iso.TimePoint.from_unix_time(now - 10 + i * 100))
+                collection.insert_entity(order)
+            # expired entities are removed automatically
+            self.assertTrue(len(collection) == 3)
+            self.assertTrue(orders.nexpired == 1)
+            self.assertTrue(orders.expire(now + 30) == 0)
+            self.assertTrue(orders.expire(now + 61) == 2)
+            self.assertTrue(sorted(collection) == [1])
+            # updating an entity changes the expiry time
+            order = collection[1]
+            order['ShippedDate'].set_from_value(
+                iso.TimePoint.from_unix_time(now + 1000))
+            collection.update_entity(order)
+            self.assertTrue(orders.expire(now + 200) == 0)
+            self.assertTrue(orders.expire(now + 1001) == 1)
+            self.assertTrue(len(collection) == 0)
+            self.assertTrue(orders.nexpired == 4)
+        orders.set_expiry()
+        self.assertTrue(orders.expire(now + 10000) == 0)
+
+    def test_bounds(self):
+        es = self.schema['SampleEntities.Employees']
+        self.employees.set_bounds(max_entries=3)
+        with es.open() as collection:
+            for i in range3(3):
+                e = collection.new_entity()
+                e.set_key('%05i' % i)
+                e['EmployeeName'].set_from_value(ul('Employee %i') % i)
+                collection.insert_entity(e)
+            # use 00000 so that 00001 is least recently used
+            collection['00000']
+            e = collection.new_entity()
+            e.set_key('00003')
+            e['EmployeeName'].set_from_value(ul('Employee 3'))
+            collection.insert_entity(e)
+            self.assertTrue(sorted(collection) ==
+                            ['00000', '00002', '00003'])
+            self.assertTrue(self.employees.nevicted == 1)
+            # iteration doesn't count as use
+            self.assertTrue(self.employees.nbytes > 0)
+            size = self.employees.nbytes // 3
+            self.employees.set_bounds(max_bytes=2 * size + 1)
+            self.assertTrue(sorted(collection) == ['00000', '00003'])
+            self.employees.set_bounds()
+            self.assertTrue(self.employees.nbytes == 0)
+            self.assertTrue(len(collection) == 2)
+            # an entity that exceeds the bounds on its own is rejected
+            self.employees.set_bounds(max_bytes=size // 2)
+            self.assertTrue(len(collection) == 0)
+            e = collection.new_entity()
+            e.set_key('00004')
+            e['EmployeeName'].set_from_value(ul('Employee 4'))
+            try:
+                collection.insert_entity(e)
+                self.fail("insert exceeds max_bytes")
+            except edm.ConstraintError:
+                pass
+            self.assertFalse(e.exists)
+            self.assertTrue(len(collection) == 0)
+        # the entity being inserted is never evicted, even when
+        # inserted through a navigation property
+        orders = self.container.entityStorage['Orders']
+        orders.set_bounds(max_entries=1)
+        with self.containerDef['Customers'].open() as collection:
+            customer = collection.new_entity()
+            customer.set_key('C0')
+            customer['CompanyName'].set_from_value(ul('Company 0'))
+            collection.insert_entity(customer)
+        with self.containerDef['Orders'].open() as collection:
+            for i in range3(2):
+                order = collection.new_entity()
+                order.set_key(i)
+                with customer['Orders'].open() as nav:
+                    nav.insert_entity(order)
+                    self.assertTrue(list(nav) == [i])
+            self.assertTrue(list(collection) == [1])
+        # ...or by a deep insert
+        with self.containerDef['Customers'].open() as collection:
+            customer = collection.new_entity()
+            customer.set_key('C1')
+            customer['CompanyName'].set_from_value(ul('Company 1'))
+            with self.containerDef['Orders'].open() as orders_coll:
+                order = orders_coll.new_entity()
+                order.set_key(2)
+            customer['Orders'].bind_entity(order)
+            collection.insert_entity(customer)
+            with customer['Orders'].open() as nav:
+                self.assertTrue(list(nav) == [2])
+        with self.containerDef['Orders'].open() as collection:
+            self.assertTrue(list(collection) == [2])
+            orders.set_bounds(max_entries=0)
+            self.assertTrue(len(collection) == 0)
+            order = collection.new_entity()
+            order.set_key(3)
+            with customer['Orders'].open() as nav:
+                try:
+                    nav.insert_entity(order)
+                    self.fail("insert exceeds max_entries")
+                except edm.ConstraintError:
+                    pass
+                self.assertTrue(len(nav) == 0)
+        # a media resource is rejected before it is inserted if its
+        # stream exceeds the bounds
+        documents = self.container.entityStorage['Documents']
+        documents.set_bounds(max_bytes=1024)
+        nchanges = self.container.nchanges
+        with self.containerDef['Documents'].open() as collection:
+            try:
+                collection.new_stream(io.BytesIO(b'x' * 2048), key=1)
+                self.fail("stream exceeds max_bytes")
+            except edm.ConstraintError:
+                pass
+            self.assertTrue(len(collection) == 0)
+            self.assertTrue(self.container.nchanges == nchanges)
+            e = collection.new_stream(io.BytesIO(b'Hello'), key=1)
+            self.assertTrue(e.key() == 1)
+            self.assertTrue(documents.read_stream(1)[0] == b'Hello')
+
+    def test_bulk_links(self):
+        with self.containerDef['Customers'].open() as collection:
+            for i in range3(3):
+                customer = collection.new_entity()
+                customer.set_key('C%i' % i)
+                customer['CompanyName'].set_from_value(ul('Company %i') % i)
+                collection.insert_entity(customer)
+        with self.containerDef['Orders'].open() as collection:
+            for i in range3(6):
+                order = collection.new_entity()
+                order.set_key(i)
+                collection.insert_entity(order)
+        aindex = self.container.associationStorage['Orders_Customers']
+        if aindex.from_store.entity_set.name == 'Customers':
+            links = [('C%i' % (i % 2), i) for i in range3(6)]
+        else:
+            links = [(i, 'C%i' % (i % 2)) for i in range3(6)]
+        aindex.add_links(links)
+        with self.containerDef['Customers'].open() as collection:
+            collection.set_expand({'Orders': None})
+            collection.EXPAND_BATCH = 2
+            result = {}
+            for customer in collection.itervalues():
+                self.assertTrue(customer['Orders'].isExpanded)
+                with customer['Orders'].open() as orders:
+                    result[customer.key()] = sorted(orders)
+            self.assertTrue(result == {'C0': [0, 2, 4], 'C1': [1, 3, 5],
+                                       'C2': []})
+            # nested expansion shares the customer entities
+            customer = collection['C0']
+            with customer['Orders'].open() as orders:
+                orders.set_expand({'Customer': None})
+                for order in orders.itervalues():
+                    with order['Customer'].open() as customers:
+                        self.assertTrue(list(customers) == ['C0'])
+        with self.containerDef['Orders'].open() as collection:
+            collection.set_expand({'Customer': {'Orders': None}})
+            for order in collection.itervalues():
+                with order['Customer'].open() as customers:
+                    customer = customers.values()[0]
+                    with customer['Orders'].open() as orders:
+                        self.assertTrue(order.key() in orders)
+        # a missing key aborts bulk deletion before anything changes
+        nlinks = len(aindex.index)
+        try:
+            self.container.entityStorage['Orders'].delete_entities(
+                [0, 1, 99])
+            self.fail("delete_entities with missing key")
+        except KeyError:
+            pass
+        self.assertTrue(len(aindex.index) == nlinks)
+        self.assertTrue(self.container.entityStorage['Orders'].test_key(0))
+        # bulk deletion removes all the links in one pass
+        self.container.entityStorage['Orders'].delete_entities([0, 1, 2])
+        self.assertTrue(aindex.get_links_from_keys([]) == {})
+        if aindex.from_store.entity_set.name == 'Customers':
+            links = aindex.get_links_from_keys(['C0', 'C1', 'C2'])
+        else:
+            links = aindex.get_links_to_keys(['C0', 'C1', 'C2'])
+        self.assertTrue(dict((k, sorted(v)) for k, v in links.items()) ==
+                        {'C0': [4], 'C1': [3, 5], 'C2': []})
+        self.container.entityStorage['Customers'].delete_entities(['C1'])
+        self.assertTrue(len(aindex.index) == 1)
+        self.assertTrue(len(aindex.reverseIndex) == 1)
+
+    def test_stats(self):
+        container = memds.InMemoryEntityContainer(self.containerDef,
+                                                  lock_stats=True)
+        self.assertTrue(isinstance(container.lock, memds.InstrumentedLock))
+        employees = container.entityStorage['Employees']
+        employees.add_index('EmployeeName')
+        with self.containerDef['Employees'].open() as collection:
+            for i in range3(3):
+                e = collection.new_entity()
+                e.set_key('%05i' % i)
+                e['EmployeeName'].set_from_value(ul('Employee %i') % i)
+                collection.insert_entity(e)
+        container.entityStorage['Documents'].update_entity_stream(
+            1, b'Hello', odata.StreamInfo())
+        stats = container.stats()
+        estats = stats['entity_sets']['Employees']
+        self.assertTrue(estats['entities'] == 3)
+        self.assertTrue(estats['data_bytes'] > 0)
+        self.assertTrue(estats['indexes'] == {'EmployeeName': 3})
+        dstats = stats['entity_sets']['Documents']
+        self.assertTrue(dstats['streams'] == 1)
+        self.assertTrue(dstats['stream_bytes'] == 5)
+        self.assertTrue(stats['bytes'] == estats['data_bytes'] + 5)
+        self.assertTrue(stats['association_sets']['Orders_Customers'] ==
+                        {'links': 0, 'sources': 0, 'targets': 0})
+        lstats = stats['lock']
+        self.assertTrue(lstats['nacquired'] > 0)
+        self.assertTrue(lstats['hold_time'] >= lstats['max_hold'] >= 0)
+        self.assertTrue(lstats['wait_time'] >= lstats['max_wait'] >= 0)
+        # the default lock is not instrumented
+        self.assertTrue(self.container.stats()['lock'] is None)
+
+    def test_change_token(self):
+        employees = self.containerDef['Employees']
+        with employees.open() as collection:
+            token = collection.change_token()
+            self.assertTrue(token is not None)
+            self.assertTrue(collection.change_token() == token)
+            e = collection.new_entity()
+            e.set_key('00001')
+            e['EmployeeName'].set_from_value(ul('Joe Bloggs'))
+            collection.insert_entity(e)
+            new_token = collection.change_token()
+            self.assertFalse(new_token == token)
+        # tokens are not shared by different containers
+        container = memds.InMemoryEntityContainer(self.containerDef)
+        with employees.open() as collection:
+            self.assertFalse(collection.change_token() in (token, new_token))
+        self.assertTrue(container.nchanges == 0)
+
+    def test_rw_lock(self):
+        lock = memds.ReadWriteLock()
+        # re-entrant for writing, a writer may also read
+        with lock:
+            with lock:
+                with lock.reader:
+                    pass
+        # read locks nest but can't be upgraded
+        with lock.reader:
+            with lock.reader:
+                pass
+            try:
+                lock.acquire()
+                self.fail("Upgraded read lock")
+            except RuntimeError:
+                pass
+        # readers share the lock
+        events = []
+        inside = threading.Event()
+        go = threading.Event()
+
+        def read():
+            with lock.reader:
+                inside.set()
+                go.wait(5)
+                events.append('read')
+
+        def write():
+            with lock:
+                events.append('write')
+
+        t = threading.Thread(target=read)
+        t.start()
+        inside.wait(5)
+        with lock.reader:
+            # a second reader gets in while the first holds the lock
+            events.append('shared')
+        w = threading.Thread(target=write)
+        w.start()
+        # the writer must wait for the first reader to finish
+        time.sleep(0.1)
+        self.assertTrue(events == ['shared'])
+        go.set()
+        t.join()
+        w.join()
+        self.assertTrue(events == ['shared', 'read', 'write'])
+        # the container exposes the lock
+        container = memds.InMemoryEntityContainer(self.containerDef,
+                                                  rw_lock=True)
+        self.assertTrue(isinstance(container.lock, memds.ReadWriteLock))
+        self.assertTrue(container.read_lock is container.lock.reader)
+        self.assertTrue(self.container.read_lock is self.container.lock)
+        # reads from a bounded entity set only need the shared lock
+        employees = container.entityStorage['Employees']
+        employees.set_bounds(max_entries=2)
+        with self.containerDef['Employees'].open() as collection:
+            for i in range3(2):
+                e = collection.new_entity()
+                e.set_key('%05i' % i)
+                e['EmployeeName'].set_from_value(ul('Employee %i') % i)
+                collection.insert_entity(e)
+            with container.read_lock:
+                self.assertTrue(employees.read_entity('00000') is not None)
+            e = collection.new_entity()
+            e.set_key('00002')
+            e['EmployeeName'].set_from_value(ul('Employee 2'))
+            collection.insert_entity(e)
+            self.assertTrue(sorted(collection) == ['00000', '00002'])
+        try:
+            memds.InMemoryEntityContainer(self.containerDef, rw_lock=True,
+                                          lock_stats=True)
+            self.fail("rw_lock with lock_stats")
+        except ValueError:
+            pass
+
 
 class RegressionTests(DataServiceRegressionTests):
 
@@ -81,5 +727,32 @@ class RegressionTests(DataServiceRegressionTests):
         self.run_combined()
 
 
+class IndexedRegressionTests(RegressionTests):
+
+    def setUp(self):        # noqa
+        RegressionTests.setUp(self)
+        # index every simple property to exercise the index code
+        for store in self.container.entityStorage.values():
+            for p in store.entity_set.entityType.Property:
+                if p.simpleTypeCode is not None:
+                    store.add_index(p.name)
+
+
+class RowViewRegressionTests(RegressionTests):
+
+    def setUp(self):        # noqa
+        DataServiceRegressionTests.setUp(self)
+        self.container = memds.InMemoryEntityContainer(
+            self.ds['RegressionModel.RegressionContainer'], row_view=True)
+
+
+class RWLockRegressionTests(RegressionTests):
+
+    def setUp(self):        # noqa
+        DataServiceRegressionTests.setUp(self)
+        self.container = memds.InMemoryEntityContainer(
+            self.ds['RegressionModel.RegressionContainer'], rw_lock=True)
+
+
 if __name__ == "__main__":
     unittest.main()
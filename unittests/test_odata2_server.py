@@ -1,6 +1,7 @@
 #! /usr/bin/env python
 
 import decimal
+import gzip
 import hashlib
 import io
 import json
@@ -13,6 +14,7 @@ import time
 import traceback
 import uuid
 import unittest
+import zlib
 
 from threading import Thread
 
@@ -21,6 +23,7 @@ from pyslet import rfc2396 as uri
 from pyslet import rfc4287 as atom
 from pyslet import rfc5023 as app
 from pyslet.http import messages
+from pyslet.http import multipart
 from pyslet.http import params
 from pyslet.odata2 import core
 from pyslet.odata2 import csdl as edm
@@ -2636,14 +2639,16 @@ class SampleServerTests(unittest.TestCase):
 
         ...If a data service does not implement support for a Batch
         Request, it must return a 4xx response code in the response to
-        any Batch Request sent to it."""
+        any Batch Request sent to it.
+
+        We support batch requests but they must be POSTed."""
         request = MockRequest("/service.svc/$batch")
         request.send(self.svc)
-        self.assertTrue(request.responseCode == 404)
+        self.assertTrue(request.responseCode == 400)
         base_uri = "/service.svc/$batch?"
         request = MockRequest(base_uri)
         request.send(self.svc)
-        self.assertTrue(request.responseCode == 404)
+        self.assertTrue(request.responseCode == 400)
         for x in ["$expand=Orders",
                   "$filter=substringof(CompanyName,%20'bikes')",
                   "$format=xml",
@@ -3329,6 +3334,440 @@ class SampleServerTests(unittest.TestCase):
         doc.read(request.wfile.getvalue())
         self.assertTrue(len(doc.root.Entry) == 0, "Expected 0 Orders")
 
+    def test_diagnostics(self):
+        request = MockRequest("/service.svc/$diagnostics")
+        request.send(self.svc)
+        # disabled by default
+        self.assertTrue(request.responseCode == 400)
+        self.svc.set_diagnostics(self.container.stats)
+        request = MockRequest("/service.svc/$diagnostics")
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 200)
+        self.assertTrue(
+            request.responseHeaders['CONTENT-TYPE'] == "application/json")
+        stats = json.loads(request.wfile.getvalue().decode('utf-8'))
+        self.assertTrue(stats['entity_sets']['Customers']['entities'] == 91)
+        self.assertTrue(
+            stats['association_sets']['Orders_Customers']['links'] == 3)
+        self.assertTrue(stats['bytes'] > 0)
+        request = MockRequest("/service.svc/$diagnostics", "DELETE")
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 400)
+        self.svc.set_diagnostics(None, "$diagnostics")
+        request = MockRequest("/service.svc/$diagnostics")
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 400)
+
+    def test_cached_documents(self):
+        for path, accept, name in (
+                ("$metadata", "application/xml", "metadata"),
+                ("$metadata", "text/plain", "metadata"),
+                ("", "application/atomsvc+xml", "service"),
+                ("", "application/json", "service_json")):
+            request = MockRequest("/service.svc/" + path)
+            request.set_header('Accept', accept)
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 200)
+            data = request.wfile.getvalue()
+            self.assertTrue(data == self.svc.document_cache[name][0])
+            self.assertFalse("CONTENT-ENCODING" in request.responseHeaders)
+            request = MockRequest("/service.svc/" + path)
+            request.set_header('Accept', accept)
+            request.set_header('Accept-Encoding', 'gzip, deflate')
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 200)
+            self.assertTrue(
+                request.responseHeaders['CONTENT-ENCODING'] == "gzip")
+            self.assertTrue(
+                request.responseHeaders['VARY'] == "Accept-Encoding")
+            gzip_data = request.wfile.getvalue()
+            self.assertTrue(len(gzip_data) < len(data))
+            self.assertTrue(
+                int(request.responseHeaders['CONTENT-LENGTH']) ==
+                len(gzip_data))
+            with gzip.GzipFile(fileobj=io.BytesIO(gzip_data)) as f:
+                self.assertTrue(f.read() == data)
+            # gzip refused
+            request = MockRequest("/service.svc/" + path)
+            request.set_header('Accept', accept)
+            request.set_header('Accept-Encoding', 'gzip;q=0, identity')
+            request.send(self.svc)
+            self.assertTrue(request.wfile.getvalue() == data)
+        # the cache is refreshed by set_model
+        self.assertTrue(b'Customers' in self.svc.document_cache['service'][0])
+        doc = edmx.Document()
+        with self.sampleServerData.join('metadata.xml').open('rb') as f:
+            doc.read(f)
+        self.svc.set_model(doc)
+        self.assertTrue(
+            self.svc.document_cache['metadata'][0] == str(doc).encode('utf-8'))
+
+    def test_compression(self):
+        request = MockRequest('/service.svc/Customers')
+        request.send(self.svc)
+        data = request.wfile.getvalue()
+        self.assertFalse("CONTENT-ENCODING" in request.responseHeaders)
+        for encoding, wbits in (('gzip', 31), ('deflate', 15)):
+            request = MockRequest('/service.svc/Customers')
+            request.set_header('Accept-Encoding', encoding)
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 200)
+            self.assertTrue(
+                request.responseHeaders['CONTENT-ENCODING'] == encoding)
+            self.assertTrue(
+                request.responseHeaders['VARY'] == "Accept-Encoding")
+            zdata = request.wfile.getvalue()
+            self.assertTrue(
+                int(request.responseHeaders['CONTENT-LENGTH']) == len(zdata))
+            self.assertTrue(len(zdata) < len(data) // 4)
+            self.assertTrue(zlib.decompress(zdata, wbits) == data)
+        # streamed responses are compressed as they are generated
+        self.svc.stream_threshold = 1024
+        request = MockRequest('/service.svc/Customers')
+        request.set_header('Accept-Encoding', 'gzip')
+        request.send(self.svc)
+        self.assertFalse("CONTENT-LENGTH" in request.responseHeaders)
+        self.assertTrue(
+            request.responseHeaders['CONTENT-ENCODING'] == 'gzip')
+        self.assertTrue(zlib.decompress(request.wfile.getvalue(), 31) == data)
+        # small responses are not compressed
+        request = MockRequest('/service.svc/Customers/$count')
+        request.set_header('Accept-Encoding', 'gzip')
+        request.send(self.svc)
+        self.assertFalse("CONTENT-ENCODING" in request.responseHeaders)
+        self.assertTrue(request.wfile.getvalue() == b"91")
+        # compression can be disabled
+        self.svc.compress_threshold = None
+        request = MockRequest('/service.svc/Customers')
+        request.set_header('Accept-Encoding', 'gzip')
+        request.send(self.svc)
+        self.assertFalse("CONTENT-ENCODING" in request.responseHeaders)
+        self.assertTrue(request.wfile.getvalue() == data)
+        # strong ETags are weakened when the response is compressed
+        responses = []
+
+        def start_response(status, response_headers, exc_info=None):
+            responses.append((status, dict(response_headers)))
+
+        def app(environ, start_response):
+            start_response(status, [
+                ("Content-Type", "application/json"),
+                ("Content-Length", str(len(data))),
+                ("ETag", '"strong"')])
+            return [data] if status.startswith('200') else []
+
+        for status, threshold, etag in (
+                ("200 OK", 1024, 'W/"strong"'),
+                ("200 OK", len(data) + 1, '"strong"'),
+                ("304 Not Modified", 1024, 'W/"strong"')):
+            encoder = server.ResponseEncoder(start_response, 'gzip',
+                                             threshold, 6)
+            b''.join(encoder.call(app, {}))
+            self.assertTrue(responses[-1][0] == status)
+            self.assertTrue(responses[-1][1]['ETag'] == etag)
+        # a generated body with a Content-Length (e.g., a media stream)
+        # is not read into memory in one go
+        chunks = []
+
+        def gen_data():
+            for i in range3(0, len(data), 1024):
+                chunks.append(i)
+                yield data[i:i + 1024]
+
+        def stream_app(environ, start_response):
+            start_response("200 OK", [
+                ("Content-Type", "text/plain"),
+                ("Content-Length", str(len(data)))])
+            return gen_data()
+
+        encoder = server.ResponseEncoder(start_response, 'gzip', 1024, 6)
+        result = encoder.call(stream_app, {})
+        self.assertFalse(isinstance(result, list))
+        self.assertTrue(chunks == [])
+        self.assertFalse('Content-Length' in responses[-1][1])
+        self.assertTrue(zlib.decompress(b''.join(result), 31) == data)
+
+    def test_request_compression(self):
+        customers = self.ds['SampleModel.SampleEntities.Customers']
+        with customers.open() as collection:
+            customer = collection['ALFKI']
+        customer['CompanyName'].set_from_value("Example Inc Compressed")
+        doc = core.Document(root=core.Entry)
+        doc.root.set_value(customer, True)
+        data = str(doc).encode('utf-8')
+        for encoding, wbits in (('gzip', 31), ('deflate', 15)):
+            request = MockRequest("/service.svc/Customers('ALFKI')", "PUT")
+            encoder = zlib.compressobj(6, zlib.DEFLATED, wbits)
+            zdata = encoder.compress(data) + encoder.flush()
+            request.set_header('Content-Type', core.ODATA_RELATED_ENTRY_TYPE)
+            request.set_header('Content-Encoding', encoding)
+            request.set_header('Content-Length', str(len(zdata)))
+            request.rfile.write(zdata)
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 204)
+            with customers.open() as collection:
+                customer = collection['ALFKI']
+                self.assertTrue(
+                    customer['CompanyName'] == "Example Inc Compressed")
+        # unsupported encoding
+        request = MockRequest("/service.svc/Customers('ALFKI')", "PUT")
+        request.set_header('Content-Type', core.ODATA_RELATED_ENTRY_TYPE)
+        request.set_header('Content-Encoding', 'br')
+        request.set_header('Content-Length', str(len(data)))
+        request.rfile.write(data)
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 415)
+        # corrupt data
+        request = MockRequest("/service.svc/Customers('ALFKI')", "PUT")
+        request.set_header('Content-Type', core.ODATA_RELATED_ENTRY_TYPE)
+        request.set_header('Content-Encoding', 'gzip')
+        request.set_header('Content-Length', str(len(data)))
+        request.rfile.write(data)
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 400)
+        # truncated data
+        request = MockRequest("/service.svc/Customers('ALFKI')", "PUT")
+        request.set_header('Content-Type', core.ODATA_RELATED_ENTRY_TYPE)
+        request.set_header('Content-Encoding', 'gzip')
+        request.set_header('Content-Length', str(len(zdata) // 2))
+        request.rfile.write(zdata[:len(zdata) // 2])
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 400)
+        # a body that decompresses to more than max_decoded_size
+        encoder = zlib.compressobj(9, zlib.DEFLATED, 31)
+        zdata = encoder.compress(b' ' * 1048576) + encoder.flush()
+        self.assertTrue(len(zdata) < 2048)
+        self.svc.max_decoded_size = 65536
+        request = MockRequest("/service.svc/Customers('ALFKI')", "PUT")
+        request.set_header('Content-Type', core.ODATA_RELATED_ENTRY_TYPE)
+        request.set_header('Content-Encoding', 'gzip')
+        request.set_header('Content-Length', str(len(zdata)))
+        request.rfile.write(zdata)
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 413)
+        # the limit can be removed
+        self.svc.max_decoded_size = None
+        decoded = self.svc.decode_request({
+            'HTTP_CONTENT_ENCODING': 'gzip',
+            'CONTENT_LENGTH': str(len(zdata)),
+            'wsgi.input': io.BytesIO(zdata)})
+        self.assertTrue(decoded['CONTENT_LENGTH'] == '1048576')
+        self.assertTrue(decoded['wsgi.input'].read() == b' ' * 1048576)
+
+    def test_uri_cache(self):
+        path = ("/service.svc/Customers?$filter=substringof('Inc',"
+                "CompanyName)&$orderby=CustomerID%20desc&$top=5")
+        request = MockRequest(path)
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 200)
+        data = request.wfile.getvalue()
+        stats = self.svc.uri_cache_stats()
+        self.assertTrue(stats['size'] == 1)
+        self.assertTrue(stats['hits'] == 0)
+        self.assertTrue(stats['misses'] == 1)
+        request = MockRequest(path)
+        request.send(self.svc)
+        self.assertTrue(request.wfile.getvalue() == data)
+        stats = self.svc.uri_cache_stats()
+        self.assertTrue(stats['hits'] == 1)
+        self.assertTrue(stats['hit_rate'] == 0.5)
+        # the protocol version is part of the key
+        request = MockRequest(path)
+        request.set_header('DataServiceVersion', "1.0; old request")
+        request.send(self.svc)
+        self.assertTrue(self.svc.uri_cache_stats()['size'] == 2)
+        # clones don't share lists and dictionaries
+        uri = self.svc.parse_uri(
+            "/service.svc/Customers?$top=5&custom=1", 2)
+        uri.sys_query_options.clear()
+        uri.query_options.append('x=1')
+        uri = self.svc.parse_uri(
+            "/service.svc/Customers?$top=5&custom=1", 2)
+        self.assertTrue(uri.sys_query_options[core.SystemQueryOption.top] ==
+                        5)
+        self.assertTrue(uri.query_options == ['custom=1'])
+        # least recently used URIs are discarded
+        self.svc.uri_cache_size = 2
+        request = MockRequest("/service.svc/Orders")
+        request.send(self.svc)
+        stats = self.svc.uri_cache_stats()
+        self.assertTrue(stats['size'] == 2)
+        request = MockRequest(path)
+        request.send(self.svc)
+        stats = self.svc.uri_cache_stats()
+        self.assertTrue(stats['misses'] == 5)
+        # errors are not cached
+        request = MockRequest("/service.svc/Customers?$top=-1")
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 400)
+        self.assertFalse(
+            ("/service.svc/Customers?$top=-1", 2) in self.svc.uri_cache)
+        # the cache can be disabled
+        self.svc.uri_cache_size = 0
+        request = MockRequest("/service.svc/Orders")
+        request.send(self.svc)
+        self.assertTrue(self.svc.uri_cache_stats()['misses'] == 6)
+
+    def test_instrumentation(self):
+        results = []
+        request = MockRequest('/service.svc/Customers')
+        request.send(self.svc)
+        data = request.wfile.getvalue()
+        self.assertFalse("SERVER-TIMING" in request.responseHeaders)
+        self.svc.set_instrumentation(results.append, server_timing=True)
+        request = MockRequest('/service.svc/Customers')
+        request.send(self.svc)
+        self.assertTrue(request.wfile.getvalue() == data)
+        timing = request.responseHeaders['SERVER-TIMING']
+        for metric in ('parse;dur=', 'resource;dur=', 'serialise;dur=',
+                       'total;dur='):
+            self.assertTrue(metric in timing, timing)
+        self.assertTrue(len(results) == 1)
+        stats = results[0]
+        self.assertTrue(stats.status.startswith('200'))
+        self.assertTrue(stats.counters['bytes'] == len(data))
+        self.assertTrue(stats.elapsed >= stats.timers['parse'])
+        # the stats are unbound at the end of the request
+        self.assertTrue(core.get_request_stats() is None)
+        # bytes are counted after compression, the callback is made
+        # after the last chunk of a streamed response
+        self.svc.stream_threshold = 1024
+        request = MockRequest('/service.svc/Customers')
+        request.set_header('Accept-Encoding', 'gzip')
+        request.send(self.svc)
+        self.assertTrue(len(results) == 2)
+        self.assertTrue(results[1].counters['bytes'] ==
+                        len(request.wfile.getvalue()))
+        # batch requests are included in the statistics of the batch
+        self.svc.set_instrumentation(results.append)
+        request = MockRequest('/service.svc/$batch', 'POST')
+        body = (b"--batch_1\r\n"
+                b"Content-Type: application/http\r\n"
+                b"Content-Transfer-Encoding: binary\r\n\r\n"
+                b"GET Customers('ALFKI') HTTP/1.1\r\n"
+                b"Host: host\r\n\r\n\r\n"
+                b"--batch_1--\r\n")
+        request.set_header('Content-Type',
+                           'multipart/mixed; boundary=batch_1')
+        request.set_header('Content-Length', str(len(body)))
+        request.rfile.write(body)
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 202)
+        self.assertFalse("SERVER-TIMING" in request.responseHeaders)
+        self.assertTrue(len(results) == 3)
+        self.assertTrue(results[2].timers['resource'] >= 0)
+        # disable
+        self.svc.set_instrumentation(None)
+        request = MockRequest('/service.svc/Customers')
+        request.send(self.svc)
+        self.assertTrue(len(results) == 3)
+
+    def test_conditional_get(self):
+        # the metadata document is always given a validator
+        request = MockRequest("/service.svc/$metadata")
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 200)
+        etag = request.responseHeaders['ETAG']
+        self.assertTrue(
+            request.responseHeaders['CACHE-CONTROL'] == "no-cache")
+        request = MockRequest("/service.svc/$metadata")
+        request.set_header('If-None-Match', etag)
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 304)
+        self.assertTrue(request.wfile.getvalue() == b'')
+        self.assertTrue(request.responseHeaders['ETAG'] == etag)
+        self.assertFalse("CONTENT-TYPE" in request.responseHeaders)
+        request = MockRequest("/service.svc/$metadata")
+        request.set_header('If-None-Match', 'W/"other", %s' % etag)
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 304)
+        request = MockRequest("/service.svc/$metadata")
+        request.set_header('If-None-Match', 'W/"other"')
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 200)
+        # entities, values and media streams with concurrency tokens
+        for path in ("Customers('ALFKI')", "Customers('ALFKI')/CompanyName",
+                     "Customers('ALFKI')/CompanyName/$value",
+                     "Documents(301)/$value"):
+            request = MockRequest("/service.svc/" + path)
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 200)
+            etag = request.responseHeaders['ETAG']
+            request = MockRequest("/service.svc/" + path)
+            request.set_header('If-None-Match', etag)
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 304, path)
+            request = MockRequest("/service.svc/" + path)
+            request.set_header('If-None-Match', '*')
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 304, path)
+        # the concurrency token doesn't cover expanded entities
+        request = MockRequest("/service.svc/Customers('ALFKI')"
+                              "?$expand=Orders")
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 200)
+        self.assertFalse("ETAG" in request.responseHeaders)
+        # entity sets only get validators from the change token
+        request = MockRequest('/service.svc/Customers')
+        request.send(self.svc)
+        self.assertFalse("ETAG" in request.responseHeaders)
+        self.svc.change_etags = True
+        request = MockRequest("/service.svc/Customers('ALFKI')"
+                              "?$expand=Orders")
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 200)
+        expand_etag = request.responseHeaders['ETAG']
+        self.assertTrue(expand_etag.startswith('W/'))
+        request = MockRequest("/service.svc/Customers('ALFKI')"
+                              "?$expand=Orders")
+        request.set_header('If-None-Match', expand_etag)
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 304)
+        request = MockRequest('/service.svc/Customers')
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 200)
+        etag = request.responseHeaders['ETAG']
+        self.assertTrue(etag.startswith('W/'))
+        request = MockRequest('/service.svc/Customers')
+        request.set_header('If-None-Match', etag)
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 304)
+        self.assertTrue(request.wfile.getvalue() == b'')
+        # each representation has its own validator
+        request = MockRequest('/service.svc/Customers')
+        request.set_header('Accept', 'application/json')
+        request.set_header('If-None-Match', etag)
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 200)
+        self.assertFalse(request.responseHeaders['ETAG'] == etag)
+        # a change to the data invalidates the validator
+        with self.container.entityStorage['Orders'].entity_set.open() as \
+                collection:
+            order = collection[1]
+            order['ShippedDate'].set_from_value(
+                iso.TimePoint.from_str('2013-08-01T11:05:00'))
+            collection.update_entity(order)
+        request = MockRequest('/service.svc/Customers')
+        request.set_header('If-None-Match', etag)
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 200)
+        self.assertFalse(request.responseHeaders['ETAG'] == etag)
+        # ...including the validator of an entity with the order expanded
+        request = MockRequest("/service.svc/Customers('ALFKI')"
+                              "?$expand=Orders")
+        request.set_header('If-None-Match', expand_etag)
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 200)
+        self.assertFalse(request.responseHeaders['ETAG'] == expand_etag)
+        # Orders have no concurrency token, fall back to the change token
+        request = MockRequest('/service.svc/Orders(1)/ShippedDate')
+        request.send(self.svc)
+        etag = request.responseHeaders['ETAG']
+        request = MockRequest('/service.svc/Orders(1)/ShippedDate')
+        request.set_header('If-None-Match', etag)
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 304)
+
     def test_inline_count(self):
         """A data service URI with an $inlinecount System Query Option
         specifies that the response to the request MUST include the
@@ -3937,6 +4376,200 @@ class SampleServerTests(unittest.TestCase):
         self.assertTrue(isinstance(obj, list), "Expected list of entities")
         self.assertTrue(len(obj) == 91, "Sample server has 91 Customers")
 
+    def test_retrieve_entity_set_streamed(self):
+        # the default threshold buffers the small sample set
+        request = MockRequest('/service.svc/Customers')
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 200)
+        clen = int(request.responseHeaders['CONTENT-LENGTH'])
+        buffered_data = request.wfile.getvalue()
+        self.assertTrue(len(buffered_data) == clen)
+        # now force streaming
+        self.svc.stream_threshold = 1024
+        self.svc.stream_chunk = 512
+        request = MockRequest('/service.svc/Customers')
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 200)
+        self.assertFalse("CONTENT-LENGTH" in request.responseHeaders)
+        self.assertTrue(params.MediaType.from_str(
+            request.responseHeaders['CONTENT-TYPE']) == "application/atom+xml")
+        doc = app.Document()
+        doc.read(request.wfile.getvalue())
+        self.assertTrue(isinstance(doc.root, atom.Feed))
+        self.assertTrue(len(doc.root.Entry) == 91)
+        # check that the entities are read lazily
+        request = MockRequest('/service.svc/Customers')
+        request.set_header('Accept', 'application/json')
+        chunks = []
+        response = self.svc(request.environ, request.start_response)
+        self.assertTrue(request.responseCode == 200)
+        self.assertFalse("CONTENT-LENGTH" in request.responseHeaders)
+        self.assertFalse(isinstance(response, list))
+        for chunk in response:
+            self.assertTrue(isinstance(chunk, bytes))
+            chunks.append(chunk)
+        self.assertTrue(len(chunks) > 2)
+        obj = json.loads(b''.join(chunks).decode('utf-8'))
+        self.assertTrue(len(obj["d"]["results"]) == 91)
+        # None disables streaming altogether
+        self.svc.stream_threshold = None
+        request = MockRequest('/service.svc/Customers')
+        request.send(self.svc)
+        clen = int(request.responseHeaders['CONTENT-LENGTH'])
+        self.assertTrue(request.wfile.getvalue() == buffered_data)
+
+    def read_batch_response(self, request):
+        mtype = params.MediaType.from_str(
+            request.responseHeaders['CONTENT-TYPE'])
+        self.assertTrue(mtype.type == "multipart")
+        self.assertTrue(mtype.subtype == "mixed")
+        return self.read_batch_parts(multipart.MultipartRecvWrapper(
+            io.BytesIO(request.wfile.getvalue()), mtype))
+
+    def read_batch_parts(self, mstream):
+        result = []
+        for part in mstream.read_parts():
+            ptype = part.message.get_content_type()
+            if ptype.type == "multipart":
+                result.append(self.read_batch_parts(
+                    multipart.MultipartRecvWrapper(part, ptype)))
+            else:
+                self.assertTrue(ptype.type == "application")
+                self.assertTrue(ptype.subtype == "http")
+                rstream = messages.RecvWrapper(part, messages.Response)
+                response = rstream.read_message_header()
+                result.append((part.message, response, rstream.read()))
+        return result
+
+    def test_batch(self):
+        customers = self.ds['SampleModel.SampleEntities.Customers'].open()
+        customer = customers.new_entity()
+        customer['CustomerID'].set_from_value('STEVE')
+        customer['CompanyName'].set_from_value("Steve's Inc")
+        customer['Address']['City'].set_from_value('Cambridge')
+        new_data = ' '.join(customer.generate_entity_type_in_json(False, 1))
+        new_data = new_data.encode('utf-8')
+        customer['CompanyName'].set_from_value("Steve's Widgets")
+        put_data = ' '.join(customer.generate_entity_type_in_json(True))
+        put_data = put_data.encode('utf-8')
+        data = b"\r\n".join([
+            b"--batch_36522ad7",
+            b"Content-Type: application/http",
+            b"Content-Transfer-Encoding: binary",
+            b"",
+            b"GET Customers('ALFKI') HTTP/1.1",
+            b"Accept: application/json",
+            b"",
+            b"",
+            b"--batch_36522ad7",
+            b"Content-Type: multipart/mixed; boundary=changeset_77162fcd",
+            b"",
+            b"--changeset_77162fcd",
+            b"Content-Type: application/http",
+            b"Content-Transfer-Encoding: binary",
+            b"Content-ID: 1",
+            b"",
+            b"POST /service.svc/Customers HTTP/1.1",
+            b"Content-Type: application/json",
+            b"Accept: application/json",
+            b"Content-Length: " + str(len(new_data)).encode('ascii'),
+            b"",
+            new_data,
+            b"--changeset_77162fcd",
+            b"Content-Type: application/http",
+            b"Content-Transfer-Encoding: binary",
+            b"",
+            b"PUT $1 HTTP/1.1",
+            b"Content-Type: application/json",
+            b"Content-Length: " + str(len(put_data)).encode('ascii'),
+            b"",
+            put_data,
+            b"--changeset_77162fcd--",
+            b"",
+            b"--batch_36522ad7",
+            b"Content-Type: application/http",
+            b"Content-Transfer-Encoding: binary",
+            b"",
+            b"GET http://host/service.svc/Customers('STEVE') HTTP/1.1",
+            b"Accept: application/json",
+            b"",
+            b"",
+            b"--batch_36522ad7--"])
+        request = MockRequest("/service.svc/$batch", "POST")
+        request.set_header('Content-Type',
+                           'multipart/mixed; boundary=batch_36522ad7')
+        request.set_header('Content-Length', str(len(data)))
+        request.rfile.write(data)
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 202)
+        parts = self.read_batch_response(request)
+        self.assertTrue(len(parts) == 3)
+        part, response, body = parts[0]
+        self.assertTrue(response.status == 200)
+        obj = json.loads(body.decode('utf-8'))
+        self.assertTrue(obj["d"]["CustomerID"] == 'ALFKI')
+        changeset = parts[1]
+        self.assertTrue(isinstance(changeset, list))
+        self.assertTrue(len(changeset) == 2)
+        part, response, body = changeset[0]
+        self.assertTrue(response.status == 201)
+        self.assertTrue(part.get_header('Content-ID') == b'1')
+        self.assertTrue(response.get_header('Location') ==
+                        b"http://host/service.svc/Customers('STEVE')")
+        part, response, body = changeset[1]
+        self.assertTrue(response.status == 204)
+        part, response, body = parts[2]
+        self.assertTrue(response.status == 200)
+        obj = json.loads(body.decode('utf-8'))
+        self.assertTrue(obj["d"]["CompanyName"] == "Steve's Widgets")
+        # a failed changeset returns a single response
+        data = b"\r\n".join([
+            b"--batch_36522ad7",
+            b"Content-Type: multipart/mixed; boundary=changeset_77162fcd",
+            b"",
+            b"--changeset_77162fcd",
+            b"Content-Type: application/http",
+            b"Content-Transfer-Encoding: binary",
+            b"",
+            b"POST Customers HTTP/1.1",
+            b"Content-Type: application/json",
+            b"Content-Length: " + str(len(new_data)).encode('ascii'),
+            b"",
+            new_data,
+            b"--changeset_77162fcd--",
+            b"",
+            b"--batch_36522ad7",
+            b"Content-Type: application/http",
+            b"Content-Transfer-Encoding: binary",
+            b"",
+            b"DELETE Customers('STEVE') HTTP/1.1",
+            b"",
+            b"",
+            b"--batch_36522ad7--"])
+        request = MockRequest("/service.svc/$batch", "POST")
+        request.set_header('Content-Type',
+                           'multipart/mixed; boundary=batch_36522ad7')
+        request.set_header('Content-Length', str(len(data)))
+        request.rfile.write(data)
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 202)
+        parts = self.read_batch_response(request)
+        self.assertTrue(len(parts) == 2)
+        part, response, body = parts[0]
+        # duplicate key
+        self.assertTrue(response.status == 403)
+        part, response, body = parts[1]
+        # only query operations outside changesets
+        self.assertTrue(response.status == 400)
+        self.assertTrue('STEVE' in customers)
+        # a malformed batch
+        request = MockRequest("/service.svc/$batch", "POST")
+        request.set_header('Content-Type', 'application/json')
+        request.set_header('Content-Length', '2')
+        request.rfile.write(b"{}")
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 400)
+
     def test_retrieve_entity(self):
         request = MockRequest("/service.svc/Customers('ALFKI')")
         request.send(self.svc)
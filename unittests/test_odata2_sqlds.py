@@ -1,6 +1,7 @@
 #! /usr/bin/env python
 
 import decimal
+import io
 import logging
 import random
 import sqlite3
@@ -13,6 +14,7 @@ from pyslet.http import params
 from pyslet.odata2 import core
 from pyslet.odata2 import csdl as edm
 from pyslet.odata2 import metadata as edmx
+from pyslet.odata2 import server
 from pyslet.odata2 import sqlds
 from pyslet.py2 import (
     long2,
@@ -21,6 +23,7 @@ from pyslet.py2 import (
 from pyslet.vfs import OSFilePath as FilePath
 
 from test_odata2_core import DataServiceRegressionTests
+from test_rfc5023 import MockRequest
 
 
 TEST_DATA_DIR = FilePath(
@@ -439,6 +442,118 @@ class ContainerTests(unittest.TestCase):
         # success criteria?  that we survived
         pass
 
+    def test_queue_pool(self):
+        container = MockContainer(container=self.container, dbapi=MockAPI(1),
+                                  max_connections=2, pool_type="queue")
+        c1 = container.acquire_connection()
+        self.assertTrue(isinstance(c1.dbc, MockConnection))
+        # connections are shared within the same thread
+        c2 = container.acquire_connection()
+        self.assertTrue(c2 is c1, "Must be the same connection")
+        container.release_connection(c2)
+        # a different thread gets a different connection
+        container.acquired = None
+        t = threading.Thread(target=mock_runner, args=(container,))
+        t.start()
+        t.join()
+        self.assertTrue(container.acquired is not None)
+        self.assertTrue(container.acquired is not c1.dbc)
+        # the double runner must now time out in the inner thread
+        container.acquired = None
+        container.acquired2 = None
+        t = threading.Thread(target=mock_runner2, args=(container,))
+        t.start()
+        t.join()
+        self.assertTrue(container.acquired2 is not None)
+        self.assertTrue(container.acquired is None)
+        container.release_connection(c1)
+        self.assertTrue(container.connection_stats() == (0, 2, 0))
+        stats = container.connection_stats(metrics=True)
+        self.assertTrue(stats['nlocked'] == 0)
+        self.assertTrue(stats['nunlocked'] == 2)
+        self.assertTrue(stats['nacquired'] == 3, stats)
+        self.assertTrue(stats['ntimeouts'] == 1, stats)
+        self.assertTrue(stats['nwaits'] == 1, stats)
+        self.assertTrue(stats['max_wait'] >= 0.9, stats)
+        self.assertTrue(stats['wait_time'] >= stats['max_wait'])
+        # a thread that dies holding a connection is cleaned up
+        t = threading.Thread(target=container.acquire_connection)
+        t.start()
+        t.join()
+        self.assertTrue(container.connection_stats() == (1, 1, 0))
+        container.pool_cleaner()
+        self.assertTrue(container.connection_stats() == (0, 2, 0))
+        # ...and the nesting count is per thread, not per connection
+        c1 = container.acquire_connection()
+        c2 = container.acquire_connection()
+        self.assertTrue(c2 is c1)
+        container.release_connection(c2)
+        self.assertTrue(container.connection_stats() == (1, 1, 0))
+        container.release_connection(c1)
+        # the pool cleaner closes idle connections but keeps them queued
+        container.pool_cleaner(max_idle=0)
+        self.assertTrue(container.connection_stats() == (0, 2, 0))
+        threads = []
+        for i in range3(50):
+            threads.append(
+                threading.Thread(target=deep_runner, args=(container,)))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(container.connection_stats() == (0, 2, 0))
+        container.close()
+        self.assertTrue(container.acquire_connection() is None)
+        self.assertTrue(container.connection_stats() == (0, 0, 0))
+        try:
+            MockContainer(container=self.container, dbapi=MockAPI(0),
+                          pool_type="queue")
+            self.fail("queue pool with threadsafety 0")
+        except ValueError:
+            pass
+        try:
+            MockContainer(container=self.container, dbapi=MockAPI(1),
+                          pool_type="unknown")
+            self.fail("unknown pool type")
+        except ValueError:
+            pass
+
+    def test_pool_health(self):
+        for pool_type in ("thread", "queue"):
+            container = MockContainer(
+                container=self.container, dbapi=MockAPI(1),
+                max_connections=2, pool_type=pool_type, pre_ping=True)
+            container.bad_count = 1
+            c = container.acquire_connection()
+            bad_dbc = c.dbc
+            self.assertTrue(bad_dbc.bad)
+            container.release_connection(c)
+            c = container.acquire_connection()
+            # the bad connection fails the ping and is replaced
+            self.assertFalse(c.dbc.bad)
+            good_dbc = c.dbc
+            container.release_connection(c)
+            c = container.acquire_connection()
+            self.assertTrue(c.dbc is good_dbc)
+            container.release_connection(c)
+            self.assertTrue(
+                container.connection_stats(metrics=True)['nreopened'] == 1)
+            container.close()
+            container = MockContainer(
+                container=self.container, dbapi=MockAPI(1),
+                max_connections=2, pool_type=pool_type, max_lifetime=0)
+            c = container.acquire_connection()
+            dbc = c.dbc
+            # nested acquisition does not recycle the connection
+            c2 = container.acquire_connection()
+            self.assertTrue(c2.dbc is dbc)
+            container.release_connection(c2)
+            container.release_connection(c)
+            c = container.acquire_connection()
+            self.assertFalse(c.dbc is dbc, "max_lifetime exceeded")
+            container.release_connection(c)
+            container.close()
+
     def test_retry(self):
         dbapi = MockAPI(1)
         for i in range3(5):
@@ -458,6 +573,50 @@ class ContainerTests(unittest.TestCase):
             container.release_connection(c)
 
 
+class FlakyCursor(object):
+
+    def __init__(self, container, cursor):
+        self.container = container
+        self.cursor = cursor
+
+    def execute(self, query, params=None):
+        if query.startswith("INSERT") and self.container.fail_inserts:
+            self.container.fail_inserts -= 1
+            if not self.container.fail_inserts:
+                raise sqlite3.OperationalError("database is locked")
+        if params is None:
+            return self.cursor.execute(query)
+        else:
+            return self.cursor.execute(query, params)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class FlakyConnection(object):
+
+    def __init__(self, container, dbc):
+        self.container = container
+        self.dbc = dbc
+
+    def cursor(self):
+        return FlakyCursor(self.container, self.dbc.cursor())
+
+    def __getattr__(self, name):
+        return getattr(self.dbc, name)
+
+
+class FlakyContainer(sqlds.SQLiteEntityContainer):
+
+    def __init__(self, **kwargs):
+        super(FlakyContainer, self).__init__(**kwargs)
+        #: the INSERT that fails is the fail_inserts'th one from now
+        self.fail_inserts = 0
+
+    def open(self):
+        return FlakyConnection(self, super(FlakyContainer, self).open())
+
+
 class SQLDSTests(unittest.TestCase):
 
     def setUp(self):  # noqa
@@ -804,6 +963,323 @@ class SQLDSTests(unittest.TestCase):
             self.assertTrue(len(collection) == 1)
             self.assertTrue(order.key() in collection)
 
+    def test_insert_entities(self):
+        self.db.create_all_tables()
+        es = self.schema['SampleEntities.Employees']
+        with es.open() as collection:
+            employees = []
+            for i in range3(25):
+                e = collection.new_entity()
+                e.set_key('%05i' % i)
+                e["EmployeeName"].set_from_value('Joe %i' % i)
+                e["Address"]["City"].set_from_value('Chunton')
+                employees.append(e)
+            collection.insert_entities(employees, batch_size=10)
+            for e in employees:
+                self.assertTrue(e.exists)
+            self.assertTrue(len(collection) == 25)
+            e = collection['00007']
+            self.assertTrue(e["EmployeeName"].value == 'Joe 7')
+            self.assertTrue(e["Address"]["City"].value == 'Chunton')
+            # concurrency tokens are set on insert
+            self.assertTrue(e["Version"])
+            # a duplicate key fails the whole transaction
+            employees = []
+            for i in range3(25, 30):
+                e = collection.new_entity()
+                e.set_key('%05i' % i)
+                e["EmployeeName"].set_from_value('Jane %i' % i)
+                employees.append(e)
+            e = collection.new_entity()
+            e.set_key('00000')
+            e["EmployeeName"].set_from_value('Joe Duplicate')
+            employees.append(e)
+            try:
+                collection.insert_entities(employees)
+                self.fail("Expected ConstraintError")
+            except edm.ConstraintError:
+                pass
+            self.assertTrue(len(collection) == 25)
+            self.assertFalse('00025' in collection)
+            self.assertFalse(employees[0].exists)
+        # entities with bindings fall back to single inserts
+        with self.schema['SampleEntities.Customers'].open() as collection:
+            customer = collection.new_entity()
+            customer.set_key('ALFKI')
+            customer["CompanyName"].set_from_value('Widget Inc')
+            collection.insert_entity(customer)
+        with self.schema['SampleEntities.Orders'].open() as collection:
+            orders = []
+            for i in range3(5):
+                order = collection.new_entity()
+                order.set_key(i)
+                if i % 2:
+                    order['Customer'].bind_entity(customer)
+                orders.append(order)
+            collection.insert_entities(orders, batch_size=2)
+            self.assertTrue(len(collection) == 5)
+        with customer['Orders'].open() as collection:
+            self.assertTrue(sorted(collection.keys()) == [1, 3])
+
+    def test_count_cache(self):
+        self.db.count_cache_ttl = 60
+        es = self.schema['SampleEntities.Employees']
+        with es.open() as collection:
+            collection.create_table()
+            for i in range3(3):
+                e = collection.new_entity()
+                e.set_key('%05i' % i)
+                e["EmployeeName"].set_from_value('Joe %i' % i)
+                collection.insert_entity(e)
+        with es.open() as collection:
+            self.assertTrue(len(collection) == 3)
+            self.assertTrue(len(self.db.count_cache) == 1)
+            # a second count is answered from the cache
+            query, params = collection._sqlLen
+            key = self.db.count_key(query, params)
+            self.db.count_cache[key] = (self.db.count_cache[key][0], 42)
+            self.assertTrue(len(collection) == 42)
+            # expired counts are not used
+            self.db.count_cache[key] = (0, 42)
+            self.assertTrue(len(collection) == 3)
+            collection.set_filter(core.CommonExpression.from_str(
+                "EmployeeName eq 'Joe 1'"))
+            self.assertTrue(len(collection) == 1)
+            self.assertTrue(len(self.db.count_cache) == 2)
+        # modifications invalidate the cache
+        with es.open() as collection:
+            e = collection.new_entity()
+            e.set_key('00003')
+            e["EmployeeName"].set_from_value('Joe 1')
+            collection.insert_entity(e)
+            self.assertTrue(len(self.db.count_cache) == 0)
+            self.assertTrue(len(collection) == 4)
+            e["EmployeeName"].set_from_value('Joe 3')
+            collection.update_entity(e)
+            self.assertTrue(len(self.db.count_cache) == 0)
+            self.assertTrue(len(collection) == 4)
+            del collection['00003']
+            self.assertTrue(len(collection) == 3)
+            # a count read before an invalidation is not cached
+            query, params = collection._sqlLen
+            generation = self.db.count_generation
+            self.db.invalidate_counts()
+            self.db.cache_count(query, params, 4, generation)
+            self.assertTrue(self.db.cached_count(query, params) is None)
+            self.db.cache_count(query, params, 3, self.db.count_generation)
+            self.assertTrue(self.db.cached_count(query, params) == 3)
+        # counts within a changeset are not cached
+        with self.db.changeset():
+            with es.open() as collection:
+                e = collection.new_entity()
+                e.set_key('00004')
+                e["EmployeeName"].set_from_value('Joe 4')
+                collection.insert_entity(e)
+                self.assertTrue(len(collection) == 4)
+                self.assertTrue(len(self.db.count_cache) == 0)
+        with es.open() as collection:
+            self.assertTrue(len(collection) == 4)
+        # approximate counts
+        self.db.count_cache_ttl = None
+        self.db.approximate_counts = True
+        with es.open() as collection:
+            # no statistics, exact count is used
+            self.assertTrue(len(collection) == 4)
+            t = sqlds.SQLTransaction(self.db, collection.connection)
+            try:
+                t.begin()
+                t.execute("ANALYZE", self.db.ParamsClass())
+                t.commit()
+            except Exception as e:
+                t.rollback(e)
+            finally:
+                t.close()
+            e = collection.new_entity()
+            e.set_key('00005')
+            e["EmployeeName"].set_from_value('Joe 5')
+            collection.insert_entity(e)
+            # statistics are out of date
+            self.assertTrue(len(collection) == 4)
+            collection.set_filter(core.CommonExpression.from_str(
+                "EmployeeName ne 'Joe 1'"))
+            self.assertTrue(len(collection) == 4)
+
+    def test_iterkeyset(self):
+        es = self.schema['SampleEntities.Employees']
+        with es.open() as collection:
+            collection.create_table()
+            employees = []
+            for i in range3(25):
+                e = collection.new_entity()
+                e.set_key('%05i' % i)
+                e["EmployeeName"].set_from_value('Joe %i' % (i % 5))
+                employees.append(e)
+            collection.insert_entities(employees)
+        with es.open() as collection:
+            collection.set_page(3, 1)
+            keys = []
+            for e in collection.iterkeyset(chunk_size=7):
+                # the connection is released between chunks
+                self.assertTrue(self.db.connection_stats()[0] == 0)
+                keys.append(e.key())
+            self.assertTrue(keys == ['%05i' % i for i in range3(25)])
+            # page settings are restored
+            self.assertTrue(collection.top == 3)
+            self.assertTrue(collection.skip == 1)
+            self.assertTrue(collection.connection is not None)
+            self.assertTrue(len(list(collection.iterpage())) == 3)
+            # filter and orderby are honoured
+            collection.set_filter(core.CommonExpression.from_str(
+                "EmployeeName ne 'Joe 0'"))
+            collection.set_orderby(
+                core.CommonExpression.orderby_from_str(
+                    "EmployeeName desc"))
+            names = []
+            for e in collection.iterkeyset(chunk_size=3):
+                names.append((e['EmployeeName'].value, e.key()))
+            self.assertTrue(len(names) == 20)
+            self.assertTrue(names == sorted(
+                names, key=lambda x: (x[0], -int(x[1])), reverse=True))
+            # stopping early is OK
+            for e in collection.iterkeyset(chunk_size=3):
+                break
+            self.assertTrue(collection.connection is not None)
+        self.assertTrue(self.db.connection_stats()[0] == 0)
+
+    def test_expand(self):
+        self.db.create_all_tables()
+        with self.schema['SampleEntities.Customers'].open() as collection:
+            for i in range3(3):
+                customer = collection.new_entity()
+                customer.set_key('C%04i' % i)
+                customer["CompanyName"].set_from_value('Widget %i' % i)
+                customer["Address"]["City"].set_from_value('Chunton')
+                collection.insert_entity(customer)
+        with self.schema['SampleEntities.Orders'].open() as collection:
+            for i in range3(10):
+                order = collection.new_entity()
+                order.set_key(i)
+                order["ShippedDate"].set_from_literal('2013-10-02T10:20:59')
+                if i % 4 < 3:
+                    # every fourth order has no customer
+                    order['Customer'].bind_entity(
+                        self.schema['SampleEntities.Customers'].open()[
+                            'C%04i' % (i % 4)])
+                collection.insert_entity(order)
+        # expansion via foreign key, nested with a reverse key
+        with self.schema['SampleEntities.Orders'].open() as collection:
+            collection.EXPAND_BATCH_SIZE = 3
+            collection.set_expand({'Customer': {'Orders': None}})
+            n = 0
+            for order in collection.itervalues():
+                n += 1
+                i = order.key()
+                customer = order['Customer'].get_entity()
+                if i % 4 < 3:
+                    self.assertTrue(customer is not None)
+                    self.assertTrue(customer.key() == 'C%04i' % (i % 4))
+                    self.assertTrue(customer['Orders'].isExpanded)
+                    with customer['Orders'].open() as orders:
+                        self.assertTrue(
+                            sorted(orders.keys()) ==
+                            [j for j in range3(10) if j % 4 == i % 4])
+                else:
+                    self.assertTrue(customer is None)
+            self.assertTrue(n == 10)
+        # expansion via reverse key with select, filter and orderby
+        with self.schema['SampleEntities.Customers'].open() as collection:
+            collection.set_expand({'Orders': None}, {'CustomerID': None,
+                                                     'Orders': None})
+            collection.set_orderby(
+                core.CommonExpression.orderby_from_str("CustomerID desc"))
+            customers = collection.values()
+            self.assertTrue(len(customers) == 3)
+            self.assertTrue(customers[0].key() == 'C0002')
+            for customer in customers:
+                self.assertFalse(customer['CompanyName'].value)
+                self.assertTrue(customer['Orders'].isExpanded)
+                i = int(customer.key()[1:])
+                with customer['Orders'].open() as orders:
+                    self.assertTrue(
+                        sorted(orders.keys()) ==
+                        [j for j in range3(10) if j % 4 == i])
+                # results must match navigation without expansion
+                with self.schema['SampleEntities.Customers'].open_navigation(
+                        'Orders', customer) as nav:
+                    self.assertTrue(
+                        sorted(orders.keys()) == sorted(nav.keys()))
+
+    def test_sql_cache(self):
+        self.db.create_all_tables()
+        with self.schema['SampleEntities.Customers'].open() as collection:
+            for i in range3(5):
+                customer = collection.new_entity()
+                customer.set_key('C%04i' % i)
+                customer["CompanyName"].set_from_value('Widget %i' % i)
+                customer["Address"]["City"].set_from_value(
+                    'City%i' % (i % 2))
+                collection.insert_entity(customer)
+        size, hits, misses = self.db.sql_cache_stats()
+        for city, n in (('City0', 3), ('City1', 2), ('City0', 3)):
+            with self.schema['SampleEntities.Customers'].open() as \
+                    collection:
+                collection.set_filter(core.CommonExpression.from_str(
+                    "Address/City eq '%s'" % city))
+                collection.set_orderby(
+                    core.CommonExpression.orderby_from_str(
+                        "CompanyName desc"))
+                self.assertTrue(len(collection) == n)
+                customers = collection.values()
+                self.assertTrue(len(customers) == n)
+                for c in customers:
+                    self.assertTrue(c["Address"]["City"].value == city)
+        new_size, new_hits, new_misses = self.db.sql_cache_stats()
+        # one count and one select query, each hit twice
+        self.assertTrue(new_size == size + 2)
+        self.assertTrue(new_hits == hits + 4)
+        self.assertTrue(new_misses == misses + 2)
+        # different literal types result in different queries
+        with self.schema['SampleEntities.Customers'].open() as collection:
+            collection.set_filter(core.CommonExpression.from_str(
+                "Address/City eq null"))
+            self.assertTrue(len(collection) == 0)
+        self.assertTrue(self.db.sql_cache_stats()[0] == new_size + 1)
+        # navigation collections bind the source entity's key
+        with self.schema['SampleEntities.Customers'].open() as collection:
+            for k in ('C0000', 'C0001'):
+                with collection[k]['Orders'].open() as orders:
+                    self.assertTrue(len(orders) == 0)
+        # the least recently used queries are discarded
+        self.db.sql_cache_size = 2
+        with self.schema['SampleEntities.Customers'].open() as collection:
+            self.assertTrue(len(collection) == 5)
+        self.assertTrue(self.db.sql_cache_stats()[0] == 2)
+
+    def test_request_stats(self):
+        self.db.create_all_tables()
+        with self.schema['SampleEntities.Customers'].open() as collection:
+            for i in range3(5):
+                customer = collection.new_entity()
+                customer.set_key('C%04i' % i)
+                customer["CompanyName"].set_from_value('Widget %i' % i)
+                collection.insert_entity(customer)
+        # nothing is recorded unless stats are bound to the thread
+        self.assertTrue(core.get_request_stats() is None)
+        stats = core.RequestStats()
+        core.set_request_stats(stats)
+        try:
+            with self.schema['SampleEntities.Customers'].open() as \
+                    collection:
+                customers = collection.values()
+                self.assertTrue(len(customers) == 5)
+        finally:
+            core.set_request_stats(None)
+        self.assertTrue(stats.counters['queries'] >= 1)
+        self.assertTrue(stats.counters['rows'] == 5)
+        self.assertTrue(stats.timers['sql'] >= 0)
+        stats.stop()
+        self.assertTrue(stats.elapsed >= stats.timers['sql'])
+
     def test_all_tables(self):
         self.db.create_all_tables()
         # run through each entity set and check there is no data in it
@@ -815,6 +1291,91 @@ class SQLDSTests(unittest.TestCase):
                     "No data in %s" %
                     es.name)
 
+    def test_changeset(self):
+        es = self.schema['SampleEntities.Employees']
+        with es.open() as collection:
+            collection.create_table()
+        # a successful changeset commits all changes
+        with self.db.changeset():
+            with es.open() as collection:
+                for i in range3(3):
+                    e = collection.new_entity()
+                    e.set_key('%05i' % i)
+                    e["EmployeeName"].set_from_value('Joe %i' % i)
+                    collection.insert_entity(e)
+        with es.open() as collection:
+            self.assertTrue(len(collection) == 3)
+        # a failed changeset rolls back all changes
+        try:
+            with self.db.changeset():
+                with es.open() as collection:
+                    e = collection.new_entity()
+                    e.set_key('00003')
+                    e["EmployeeName"].set_from_value('Jane Doe')
+                    collection.insert_entity(e)
+                    self.assertTrue(len(collection) == 4)
+                    # duplicate key
+                    e = collection.new_entity()
+                    e.set_key('00000')
+                    e["EmployeeName"].set_from_value('Joe Duplicate')
+                    collection.insert_entity(e)
+            self.fail("Expected ConstraintError")
+        except edm.ConstraintError:
+            pass
+        with es.open() as collection:
+            self.assertTrue(len(collection) == 3)
+            self.assertFalse('00003' in collection)
+        # the connection is released on exit
+        self.assertTrue(self.db.connection_stats()[0] == 0)
+
+    def test_changeset_retry(self):
+        self.db.close()
+        self.db = FlakyContainer(file_path=self.d.join('flaky.db'),
+                                 container=self.container)
+        es = self.schema['SampleEntities.Employees']
+        with es.open() as collection:
+            collection.create_table()
+            e = collection.new_entity()
+        svc = server.Server('http://host/service.svc')
+        svc.set_model(self.doc)
+        parts = []
+        for i in range3(2):
+            e.set_key('%05i' % i)
+            e["EmployeeName"].set_from_value('Joe %i' % i)
+            data = ' '.join(e.generate_entity_type_in_json(False, 1))
+            data = data.encode('utf-8')
+            parts += [
+                b"--changeset_77162fcd",
+                b"Content-Type: application/http",
+                b"Content-Transfer-Encoding: binary",
+                b"",
+                b"POST Employees HTTP/1.1",
+                b"Content-Type: application/json",
+                b"Content-Length: " + str(len(data)).encode('ascii'),
+                b"",
+                data]
+        data = b"\r\n".join([
+            b"--batch_36522ad7",
+            b"Content-Type: multipart/mixed; boundary=changeset_77162fcd",
+            b""] + parts + [
+            b"--changeset_77162fcd--",
+            b"",
+            b"--batch_36522ad7--"])
+        # the second INSERT fails with an OperationalError, the
+        # connection must not be reopened part way through the changeset
+        self.db.fail_inserts = 2
+        request = MockRequest("/service.svc/$batch", "POST")
+        request.set_header('Content-Type',
+                           'multipart/mixed; boundary=batch_36522ad7')
+        request.set_header('Content-Length', str(len(data)))
+        request.rfile.write(data)
+        request.send(svc)
+        self.assertTrue(request.responseCode == 202)
+        self.assertTrue(self.db.fail_inserts == 0)
+        self.assertFalse(b"201 Created" in request.wfile.getvalue())
+        with es.open() as collection:
+            self.assertTrue(len(collection) == 0)
+
 
 class CustomisedContainer(sqlds.SQLiteEntityContainer):
 
@@ -878,6 +1439,41 @@ class AutoFieldTests(unittest.TestCase):
             self.assertTrue(len(query.split('"hash" TEXT')) == 2,
                             "Expected 1 FK definition")
 
+    def test_indexes(self):
+        files = self.container['Files']
+        with files.open() as collection:
+            self.assertTrue(collection.index_list() == [
+                [(('Files', 'mime', 'type'), False),
+                 (('Files', 'mime', 'subtype'), True)],
+                [(('Files', 'path'), False)],
+                [(('Files', 'hash'), False)]])
+            queries = collection.create_index_queries()
+            # the index on the key alone is redundant
+            self.assertTrue(len(queries) == 2, queries)
+            self.assertTrue(
+                queries[0] == 'CREATE INDEX "prefix_Files_idx1" ON '
+                '"prefix_Files" ("type", "subtype" DESC, "fPath")', queries[0])
+            self.assertTrue(
+                queries[1] == 'CREATE INDEX "prefix_Files_idx2" ON '
+                '"prefix_Files" ("hash", "fPath")', queries[1])
+            self.assertTrue(self.db.mangle_index_name('Blobs', 3) ==
+                            '"prefix_Blobs_idx3"')
+        blobs = self.container['Blobs']
+        with blobs.open() as collection:
+            self.assertTrue(collection.create_index_queries() == [])
+        out = io.StringIO()
+        self.db.create_all_tables(out=out)
+        self.assertTrue('CREATE INDEX "prefix_Files_idx2"' in out.getvalue())
+        self.db.create_all_tables()
+        dbc = sqlite3.connect(str(self.d.join('test.db')))
+        c = dbc.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type='index' AND "
+                  "tbl_name='prefix_Files' AND sql IS NOT NULL")
+        names = sorted(row[0] for row in c.fetchall())
+        dbc.close()
+        self.assertTrue(names == ['prefix_Files_idx1', 'prefix_Files_idx2'],
+                        names)
+
     def test_exposed_fk(self):
         # see
         # http://stackoverflow.com/questions/3296040/why-arent-my-sqlite3-foreign-keys-working